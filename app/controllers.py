@@ -1,21 +1,69 @@
+import time
+import random
 import asyncio
 import typing as tp
 
 from PIL.Image import Image
+from functools import partial
 from asyncio import CancelledError
 
 from backend.logger import get_logger
-from backend.transfer import StyleTransferProcessor
-from app.websocket_protocols import StartStyleTransferRequest, StyleTransferResponse
+from backend.config import Config
+from backend.transfer import StyleTransferProcessor, TiledStyleTransferProcessor, FastStyleTransferProcessor, AdaINStyleTransferProcessor
+from backend.transfer import LossRecord, JobProfiler
+from app.exceptions import QueueIsFullException
+from app.metrics import register_job_metrics, time_to_first_preview_seconds, job_latency_seconds
+from app.previews import PreviewChangeDetector
+from app.scheduler import ScheduledJob, job_scheduler
+from app.websocket_protocols import StartStyleTransferRequest, StyleTransferResponse, QueueStatusResponse, negotiate_image_format
 
 
 event_loop = asyncio.get_event_loop()
 logger = get_logger(__name__)
+AnyStyleTransferProcessor = tp.Union[StyleTransferProcessor, TiledStyleTransferProcessor, FastStyleTransferProcessor, AdaINStyleTransferProcessor]
+# Processors of running jobs by job id, so their losses can be queried
+running_processors: dict[int, AnyStyleTransferProcessor] = {}
+register_job_metrics(running_processors)
+
+
+def get_job_loss_history(job_id: int, since_iteration: int = 0) -> tp.Optional[list[LossRecord]]:
+    """
+    :param job_id: id of the job sent in QueueStatusResponse
+    :param since_iteration: only losses of later iterations are returned
+    :return: losses read back so far or None if the job isn't running
+    """
+    processor: tp.Optional[AnyStyleTransferProcessor] = running_processors.get(job_id)
+    if processor is None:
+        return None
+    return processor.get_loss_history(since_iteration)
+
+
+def to_loss_values(records: list[LossRecord]) -> list[list[float]]:
+    return [[record.iteration, record.content_loss, record.style_loss, record.total_loss] for record in records]
 
 
 def configure_style_transfer_processor(username: str, content_image: Image, style_image: Image, num_iteration: int,
-                                       content_loss_layers_id: list[int], style_loss_layers_id: list[int], alpha: float) -> StyleTransferProcessor:
-    processor = StyleTransferProcessor()
+                                       content_loss_layers_id: list[int], style_loss_layers_id: list[int], alpha: float,
+                                       optimizer: str, engine: str = "optimization", fast_style: str = "",
+                                       preview_max_size: int = Config.preview_max_size,
+                                       preview_fps: float = Config.preview_fps,
+                                       profiler: tp.Optional[JobProfiler] = None,
+                                       precision: tp.Optional[str] = None,
+                                       content_layer_weights: tp.Optional[list[float]] = None,
+                                       style_layer_weights: tp.Optional[list[float]] = None) -> AnyStyleTransferProcessor:
+    try:
+        assert preview_max_size > 0 and preview_fps > 0, "Preview size and frame rate have to be positive!"
+        assert engine in Config.available_engines, f"Only {Config.available_engines} engines are available!"
+        if engine == "fast_style":
+            return FastStyleTransferProcessor().configure(username, content_image, fast_style, profiler=profiler)
+        if engine == "adain":
+            return AdaINStyleTransferProcessor().configure(username, content_image, style_image, profiler=profiler)
+    except AssertionError as exc:
+        logger.warning(f"Tried to configure {engine} engine with incorrect params.", exc_info=exc, extra={"username": username})
+        raise
+
+    is_large_image: bool = content_image.height > Config.working_image_size[0] or content_image.width > Config.working_image_size[1]
+    processor = TiledStyleTransferProcessor() if Config.tiled_transfer and is_large_image else StyleTransferProcessor()
     try:
         processor.configure(
             username=username,
@@ -25,37 +73,65 @@ def configure_style_transfer_processor(username: str, content_image: Image, styl
             collect_content_loss_layers=content_loss_layers_id,
             collect_style_loss_layers=style_loss_layers_id,
             alpha=alpha,
+            optimizer_type=optimizer,
+            state_interval=1 / min(preview_fps, Config.max_preview_fps),
+            preview_max_size=min(preview_max_size, Config.max_preview_size),
+            profiler=profiler,
+            precision=precision,
+            content_layer_weights=content_layer_weights,
+            style_layer_weights=style_layer_weights,
         )
     except AssertionError as exc:
-        logger.warning("Tried to configure processor with incorrect params.", exc_info=exc)
+        logger.warning("Tried to configure processor with incorrect params.", exc_info=exc, extra={"username": username})
         raise
     return processor
 
 
-async def current_states_generator(
-        style_transfer_task: asyncio.Task,
-        processor: StyleTransferProcessor,
-        username: str,
-        sleep_time: int) -> tp.AsyncGenerator[StyleTransferResponse, None]:
-    while (not style_transfer_task.done() or not style_transfer_task.cancelled()) and processor.is_transferring():
-        try:
-            response: StyleTransferResponse = StyleTransferResponse.from_pil_image(
-                processor.get_current_image(),
-                processor.get_current_transfer_status(),
+async def current_states_generator(processor: AnyStyleTransferProcessor, username: str, image_format: str, image_quality: int,
+                                   profiler: tp.Optional[JobProfiler] = None) -> tp.AsyncGenerator[StyleTransferResponse, None]:
+    profiler = profiler if profiler is not None else JobProfiler()
+    change_detector = PreviewChangeDetector()
+    last_loss_iteration: int = 0
+    async for state in processor.get_transfer_states():
+        logger.debug("Got current style transfer result.", extra={"username": username})
+        if not await event_loop.run_in_executor(None, change_detector.is_changed, state.image):
+            logger.debug("Skipped preview, since it hasn't changed.", extra={"username": username})
+            continue
+        losses: list[LossRecord] = processor.get_loss_history(last_loss_iteration)
+        if losses:
+            last_loss_iteration = losses[-1].iteration
+        with profiler.timer("encode_preview"):
+            response: StyleTransferResponse = await StyleTransferResponse.encode(
+                state.image, image_format, image_quality, state.completeness, state.num_iterations, losses=to_loss_values(losses),
             )
-            yield response
-        except AssertionError as exc:
-            logger.warning("Tried to get current style transfer result, but there's no transfer.",
-                           extra={"username": username}, exc_info=exc)
-            style_transfer_task.cancel()
-            raise
-        await asyncio.sleep(sleep_time)
+        yield response
 
 
-def get_style_transfer_task_result(username: str, style_transfer_task: asyncio.Task) -> tp.Optional[StyleTransferResponse]:
+async def get_style_transfer_task_result(username: str, style_transfer_task: asyncio.Task, processor: AnyStyleTransferProcessor,
+                                         image_format: str, image_quality: int,
+                                         profiler: tp.Optional[JobProfiler] = None) -> tp.Optional[StyleTransferResponse]:
+    """
+    Final response carries the whole loss history of the transfer, peak memory usage of the job and per-stage timings,
+    if the job was profiled
+    """
+    profiler = profiler if profiler is not None else JobProfiler()
     try:
         result: Image = style_transfer_task.result()
-        return StyleTransferResponse.from_pil_image(result, completeness=100)
+        with profiler.timer("encode_result"):
+            response: StyleTransferResponse = await StyleTransferResponse.encode(
+                result,
+                image_format,
+                image_quality,
+                completeness=100,
+                num_iterations=processor.get_num_completed_iterations(),
+                stop_reason=processor.get_stop_reason(),
+                losses=to_loss_values(processor.get_loss_history()),
+            )
+        response.stage_timings = profiler.get_summary()
+        response.peak_memory_bytes = processor.get_peak_memory_usage()
+        if profiler.is_enabled():
+            logger.info(f"Stage timings: {response.stage_timings}.", extra={"username": username})
+        return response
     except CancelledError:
         logger.warning("Failed to get transfer style task result, since task was cancelled.", extra={"username": username})
         raise
@@ -65,28 +141,72 @@ def get_style_transfer_task_result(username: str, style_transfer_task: asyncio.T
 
 
 async def style_transfer_ws_controller(request: StartStyleTransferRequest) \
-        -> tp.AsyncGenerator[tp.Union[asyncio.Task, StyleTransferResponse], None]:
-    processor: StyleTransferProcessor = configure_style_transfer_processor(
-        username=request.username,
-        content_image=request.content_image.to_pil_image(),
-        style_image=request.style_image.to_pil_image(),
-        num_iteration=request.num_iteration,
-        content_loss_layers_id=request.content_loss_layers_id,
-        style_loss_layers_id=request.style_loss_layers_id,
-        alpha=request.alpha,
-    )
-
-    style_transfer_task: asyncio.Task = event_loop.create_task(processor.transfer_style())
-    logger.debug("Started style transfer task.", extra={"username": request.username})
-    yield style_transfer_task
-
-    await asyncio.sleep(0)
-
-    async for response in current_states_generator(style_transfer_task, processor, request.username, 1):
-        yield response
-        logger.debug(f"Sent response with completeness = {response.completeness}%.", extra={"username": request.username})
+        -> tp.AsyncGenerator[tp.Union[QueueStatusResponse, StyleTransferResponse], None]:
+    request_time: float = time.monotonic()
+    try:
+        job: ScheduledJob = job_scheduler.enqueue(request.username)
+    except QueueIsFullException as exc:
+        logger.warning("Style transfer request was rejected.", exc_info=exc, extra={"username": request.username})
+        yield QueueStatusResponse("rejected")
+        return
 
-    final_response: tp.Optional[StyleTransferResponse] = get_style_transfer_task_result(request.username, style_transfer_task)
-    if final_response:
-        yield final_response
-        logger.debug("Sent final response.", extra={"username": request.username})
+    style_transfer_task: tp.Optional[asyncio.Task] = None
+    try:
+        async for position in job_scheduler.wait_for_start(job):
+            yield QueueStatusResponse("queued", position)
+            logger.debug(f"Job {job.job_id} is waiting in queue at position {position}.", extra={"username": request.username})
+        yield QueueStatusResponse("started", job_id=job.job_id)
+
+        image_format: str = negotiate_image_format(request.image_format)
+        profiler = JobProfiler(enabled=request.profile or random.random() < Config.profiling_sample_rate, name=f"job_{job.job_id}_{int(time.time())}")
+        with profiler.timer("decode"):
+            content_image, style_image = await asyncio.gather(request.content_image.decode(), request.style_image.decode())
+        processor: AnyStyleTransferProcessor = await event_loop.run_in_executor(None, partial(
+            configure_style_transfer_processor,
+            username=request.username,
+            content_image=content_image,
+            style_image=style_image,
+            num_iteration=request.num_iteration,
+            content_loss_layers_id=request.content_loss_layers_id,
+            style_loss_layers_id=request.style_loss_layers_id,
+            alpha=request.alpha,
+            optimizer=request.optimizer,
+            engine=request.engine,
+            fast_style=request.fast_style,
+            preview_max_size=request.preview_max_size,
+            preview_fps=request.preview_fps,
+            profiler=profiler,
+            precision=request.precision or None,
+            content_layer_weights=request.content_layer_weights or None,
+            style_layer_weights=request.style_layer_weights or None,
+        ))
+        running_processors[job.job_id] = processor
+        metric_labels: dict[str, str] = processor.get_metric_labels()
+
+        style_transfer_task = event_loop.create_task(processor.transfer_style())
+        transfer_start_time: float = time.monotonic()
+        logger.debug("Started style transfer task.", extra={"username": request.username})
+
+        is_preview_sent: bool = False
+        async for response in current_states_generator(processor, request.username, image_format, request.image_quality, profiler):
+            yield response
+            if not is_preview_sent:
+                time_to_first_preview_seconds.observe(time.monotonic() - transfer_start_time, **metric_labels)
+                is_preview_sent = True
+            logger.debug(f"Sent response with completeness = {response.completeness}%.", extra={"username": request.username})
+
+        await asyncio.wait([style_transfer_task])
+        final_response: tp.Optional[StyleTransferResponse] = await get_style_transfer_task_result(
+            request.username, style_transfer_task, processor, image_format, request.image_quality, profiler,
+        )
+        if final_response:
+            yield final_response
+            job_latency_seconds.observe(time.monotonic() - request_time, **metric_labels)
+            logger.debug(f"Sent final response after {final_response.num_iterations} iterations ({final_response.stop_reason}).",
+                         extra={"username": request.username})
+    finally:
+        if style_transfer_task and (not style_transfer_task.done()):
+            style_transfer_task.cancel()
+            logger.info("Style transfer task was cancelled.", extra={"username": request.username})
+        running_processors.pop(job.job_id, None)
+        job_scheduler.release(job)
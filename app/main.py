@@ -1,6 +1,14 @@
 from fastapi import FastAPI
 from app.routes import router
 
+from backend.config import Config
+from backend.transfer import backbone_registry
+
 
 app = FastAPI()
 app.include_router(router)
+
+
+@app.on_event("startup")
+def preload_base_models() -> None:
+    backbone_registry.preload(Config.preloaded_base_models)
@@ -0,0 +1,75 @@
+import typing as tp
+
+from backend.config import Config
+from backend.metrics import Counter, Gauge, Histogram, LabelValues, metrics_registry
+from backend.transfer.memory import get_rss_bytes
+from backend.transfer.gram_cache import gram_matrix_cache
+from app.scheduler import job_scheduler
+
+
+# Labels of job metrics, so capacity can be planned per base model and working size
+JOB_LABEL_NAMES: tuple[str, ...] = ("backbone", "working_size")
+
+active_jobs: Gauge = metrics_registry.gauge(
+    "nst_active_jobs", "Style transfer jobs started by the scheduler, including ones whose model is being built",
+)
+queued_jobs: Gauge = metrics_registry.gauge("nst_queued_jobs", "Style transfer jobs waiting in the queue")
+job_iterations_per_second: Gauge = metrics_registry.gauge(
+    "nst_job_iterations_per_second", "Average iterations per second of running style transfer job", ("job_id",) + JOB_LABEL_NAMES,
+)
+iterations_per_second: Gauge = metrics_registry.gauge(
+    "nst_iterations_per_second", "Total iterations per second of running style transfer jobs", JOB_LABEL_NAMES,
+)
+time_to_first_preview_seconds: Histogram = metrics_registry.histogram(
+    "nst_time_to_first_preview_seconds", "Time from start of the transfer to the first sent preview", JOB_LABEL_NAMES,
+    Config.latency_buckets,
+)
+job_latency_seconds: Histogram = metrics_registry.histogram(
+    "nst_job_latency_seconds", "Time from the request to the final response, including waiting in the queue", JOB_LABEL_NAMES,
+    Config.latency_buckets,
+)
+websocket_received_bytes: Counter = metrics_registry.counter("nst_websocket_received_bytes_total", "Bytes received by websockets")
+websocket_sent_bytes: Counter = metrics_registry.counter("nst_websocket_sent_bytes_total", "Bytes sent by websockets")
+resident_memory_bytes: Gauge = metrics_registry.gauge("process_resident_memory_bytes", "Resident set size of the process")
+gram_cache_hits: Counter = metrics_registry.counter("nst_gram_cache_hits_total", "Style Gram matrices found in the cache")
+gram_cache_misses: Counter = metrics_registry.counter("nst_gram_cache_misses_total", "Style Gram matrices not found in the cache")
+gram_cache_evictions: Counter = metrics_registry.counter(
+    "nst_gram_cache_evictions_total", "Style Gram matrices evicted from the full cache",
+)
+gram_cache_size_bytes: Gauge = metrics_registry.gauge("nst_gram_cache_size_bytes", "Total size of cached style Gram matrices")
+
+
+def register_job_metrics(running_processors: dict[int, tp.Any]) -> None:
+    """
+    Computes iterations per second of running jobs from their processors at collection time. Jobs are added to
+    running_processors only when their model is built, so number of active jobs is taken from the scheduler instead
+    :param running_processors: processors of running jobs by job id
+    """
+    def get_label_values(processor: tp.Any) -> LabelValues:
+        labels: dict[str, str] = processor.get_metric_labels()
+        return tuple(labels[label_name] for label_name in JOB_LABEL_NAMES)
+
+    def collect_job_iterations_per_second() -> dict[LabelValues, float]:
+        return {
+            (str(job_id),) + get_label_values(processor): processor.get_iterations_per_second()
+            for job_id, processor in list(running_processors.items())
+        }
+
+    def collect_iterations_per_second() -> dict[LabelValues, float]:
+        values: dict[LabelValues, float] = {}
+        for processor in list(running_processors.values()):
+            label_values: LabelValues = get_label_values(processor)
+            values[label_values] = values.get(label_values, 0.0) + processor.get_iterations_per_second()
+        return values
+
+    job_iterations_per_second.set_function(collect_job_iterations_per_second)
+    iterations_per_second.set_function(collect_iterations_per_second)
+
+
+active_jobs.set_function(lambda: {(): job_scheduler.get_num_running_jobs()})
+queued_jobs.set_function(lambda: {(): job_scheduler.get_num_queued_jobs()})
+resident_memory_bytes.set_function(lambda: {(): get_rss_bytes()})
+gram_cache_hits.set_function(lambda: {(): gram_matrix_cache.get_statistics()["hits"]})
+gram_cache_misses.set_function(lambda: {(): gram_matrix_cache.get_statistics()["misses"]})
+gram_cache_evictions.set_function(lambda: {(): gram_matrix_cache.get_statistics()["evictions"]})
+gram_cache_size_bytes.set_function(lambda: {(): gram_matrix_cache.get_statistics()["size_bytes"]})
@@ -0,0 +1,33 @@
+import typing as tp
+
+from PIL import Image, ImageChops, ImageStat
+
+from backend.config import Config
+
+
+class PreviewChangeDetector:
+    """
+    Detects whether preview changed enough since the last sent one to be worth sending. Previews are compared by small
+    thumbnails, so it's cheap and insensitive to noise
+    """
+    def __init__(self, min_change: float = Config.preview_min_change, thumbnail_size: int = Config.preview_thumbnail_size) -> None:
+        """
+        :param min_change: minimum mean absolute difference of thumbnails in [0, 1]
+        :param thumbnail_size: size of thumbnails
+        """
+        self._min_change: float = min_change
+        self._thumbnail_size: int = thumbnail_size
+        self._last_thumbnail: tp.Optional[Image.Image] = None
+
+    def is_changed(self, preview: Image.Image) -> bool:
+        """
+        :param preview: preview image
+        :return: True if preview has to be sent. Then it's remembered as the last sent preview
+        """
+        thumbnail: Image.Image = preview.convert("RGB").resize((self._thumbnail_size, self._thumbnail_size), Image.BILINEAR)
+        if self._last_thumbnail is not None:
+            channel_changes: list[float] = ImageStat.Stat(ImageChops.difference(thumbnail, self._last_thumbnail)).mean
+            if sum(channel_changes) / len(channel_changes) / 255 < self._min_change:
+                return False
+        self._last_thumbnail = thumbnail
+        return True
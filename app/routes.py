@@ -1,37 +1,71 @@
-import asyncio
 import typing as tp
 
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from contextlib import aclosing
+from fastapi import APIRouter, HTTPException, Response, WebSocket, WebSocketDisconnect
 
 from backend.logger import get_logger
-from app.websocket_protocols import StartStyleTransferRequest, StyleTransferResponse
-from app.controllers import style_transfer_ws_controller
+from backend.metrics import MetricsRegistry, metrics_registry
+from app.metrics import websocket_received_bytes, websocket_sent_bytes
+from app.websocket_protocols import StartStyleTransferRequest, HandshakeResponse, HANDSHAKE_PROTOCOL_VERSION, get_frame_protocol_version
+from app.controllers import style_transfer_ws_controller, get_job_loss_history, to_loss_values
 
 router = APIRouter()
 logger = get_logger(__name__)
 
 
+async def send_frame(websocket: WebSocket, frame: bytes) -> None:
+    await websocket.send_bytes(frame)
+    websocket_sent_bytes.inc(len(frame))
+
+
 @router.websocket("/style_transfer")
 async def style_transfer_ws(websocket: WebSocket) -> None:
     await websocket.accept()
     username: tp.Optional[str] = None
-    style_transfer_task: tp.Optional[asyncio.Task] = None
 
     try:
-        request = await StartStyleTransferRequest.from_websocket(websocket)
+        request_frame: bytes = await websocket.receive_bytes()
+        websocket_received_bytes.inc(len(request_frame))
+        client_protocol_version: int = get_frame_protocol_version(request_frame)
+        handshake = HandshakeResponse.from_client_protocol_version(client_protocol_version)
+        if not handshake.accepted:
+            # The rest of the request may have a layout unknown to the server, so only the version is read
+            logger.warning(f"Rejected request: {handshake.reason}", extra={"username": username})
+            await send_frame(websocket, handshake.to_frame(client_protocol_version))
+            return
+
+        request = StartStyleTransferRequest.from_frame(request_frame)
+        request.protocol_version = handshake.protocol_version
         username = request.username
-        logger.info("Got request for style transfer.", extra={"username": username})
+        logger.info(f"Got request for style transfer, protocol version {request.protocol_version}.", extra={"username": username})
+        if request.protocol_version >= HANDSHAKE_PROTOCOL_VERSION:
+            await send_frame(websocket, handshake.to_frame(request.protocol_version))
 
-        response_generator: tp.AsyncGenerator[tp.Optional[asyncio.Task, StyleTransferResponse], None] = style_transfer_ws_controller(request)
-        style_transfer_task: asyncio.Task = await anext(response_generator)
-        async for response in response_generator:
-            await response.to_websocket(websocket)
+        async with aclosing(style_transfer_ws_controller(request)) as response_generator:
+            async for response in response_generator:
+                await send_frame(websocket, response.to_frame(request.protocol_version))
     except AssertionError as exc:
         logger.warning("Style transfer failed with exception.", exc_info=exc, extra={"username": username})
     except WebSocketDisconnect:
         logger.info("User disconnected.", extra={"username": username})
     finally:
-        if style_transfer_task and (not style_transfer_task.done()):
-            style_transfer_task.cancel()
-            logger.info("Style transfer task was cancelled.", extra={"username": username})
         await websocket.close()
+
+
+@router.get("/jobs/{job_id}/losses")
+async def get_job_losses(job_id: int, since_iteration: int = 0) -> dict[str, tp.Any]:
+    """
+    Losses of running job as [iteration, content loss, style loss, total loss]. Job id is sent in QueueStatusResponse
+    """
+    losses = get_job_loss_history(job_id, since_iteration)
+    if losses is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} isn't running.")
+    return {"job_id": job_id, "losses": to_loss_values(losses)}
+
+
+@router.get("/metrics")
+async def get_metrics() -> Response:
+    """
+    Metrics of the server in Prometheus text format
+    """
+    return Response(metrics_registry.render(), media_type=MetricsRegistry.content_type)
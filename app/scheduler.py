@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import typing as tp
+
+from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+
+from backend.config import Config
+from backend.logger import get_logger
+from app.exceptions import QueueIsFullException
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(eq=False)
+class ScheduledJob:
+    job_id: int
+    username: str
+    started: bool = False
+    state_changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class JobScheduler:
+    """
+    Limits number of concurrently running style transfer jobs. Jobs that can't be started are kept in bounded queue.
+    Queued jobs of different users are started in round-robin order, so one user can't occupy the whole queue
+    """
+    def __init__(self, max_running_jobs: int = Config.max_running_jobs, max_queued_jobs: int = Config.max_queued_jobs) -> None:
+        """
+        :param max_running_jobs: maximum number of concurrently running jobs
+        :param max_queued_jobs: maximum number of jobs waiting in the queue
+        """
+        self._max_running_jobs: int = max_running_jobs
+        self._max_queued_jobs: int = max_queued_jobs
+        self._running_jobs: set[ScheduledJob] = set()
+        self._queued_jobs: OrderedDict[str, deque[ScheduledJob]] = OrderedDict()
+        self._num_queued_jobs: int = 0
+        self._job_ids: tp.Iterator[int] = itertools.count()
+
+    def enqueue(self, username: str) -> ScheduledJob:
+        """
+        Adds job to the queue or starts it immediately if there is a free slot
+        :param username: username
+        :return: scheduled job
+        """
+        if self._num_queued_jobs >= self._max_queued_jobs:
+            raise QueueIsFullException(f"Job queue is full: {self._num_queued_jobs} jobs are waiting.")
+
+        job = ScheduledJob(next(self._job_ids), username)
+        self._queued_jobs.setdefault(username, deque()).append(job)
+        self._num_queued_jobs += 1
+        self._start_queued_jobs()
+        self._notify_queued_jobs()
+        return job
+
+    def release(self, job: ScheduledJob) -> None:
+        """
+        Removes finished, failed or cancelled job and starts next queued jobs
+        :param job: scheduled job
+        """
+        if job in self._running_jobs:
+            self._running_jobs.remove(job)
+        elif job.username in self._queued_jobs and job in self._queued_jobs[job.username]:
+            self._queued_jobs[job.username].remove(job)
+            self._num_queued_jobs -= 1
+            if not self._queued_jobs[job.username]:
+                del self._queued_jobs[job.username]
+        self._start_queued_jobs()
+        self._notify_queued_jobs()
+
+    def get_queue_position(self, job: ScheduledJob) -> int:
+        """
+        :param job: scheduled job
+        :return: 1-based position of the job in the queue or 0 if it's already started
+        """
+        if job.started:
+            return 0
+        return self._get_queue_order().index(job) + 1
+
+    def get_num_running_jobs(self) -> int:
+        return len(self._running_jobs)
+
+    def get_num_queued_jobs(self) -> int:
+        return self._num_queued_jobs
+
+    async def wait_for_start(self, job: ScheduledJob) -> tp.AsyncGenerator[int, None]:
+        """
+        Yields queue position of the job every time it changes until the job is started
+        :param job: scheduled job
+        """
+        last_position: tp.Optional[int] = None
+        while True:
+            job.state_changed.clear()
+            if job.started:
+                return
+            position: int = self.get_queue_position(job)
+            if position != last_position:
+                last_position = position
+                yield position
+            await job.state_changed.wait()
+
+    def _get_queue_order(self) -> list[ScheduledJob]:
+        """
+        :return: queued jobs in order of starting. Users take turns, jobs of one user are started in FIFO order
+        """
+        user_queues: list[deque[ScheduledJob]] = list(self._queued_jobs.values())
+        return [job for jobs in itertools.zip_longest(*user_queues) for job in jobs if job is not None]
+
+    def _start_queued_jobs(self) -> None:
+        while self._queued_jobs and len(self._running_jobs) < self._max_running_jobs:
+            username, user_jobs = next(iter(self._queued_jobs.items()))
+            job: ScheduledJob = user_jobs.popleft()
+            self._num_queued_jobs -= 1
+            if user_jobs:
+                self._queued_jobs.move_to_end(username)
+            else:
+                del self._queued_jobs[username]
+
+            job.started = True
+            job.state_changed.set()
+            self._running_jobs.add(job)
+            logger.debug(f"Started job {job.job_id}.", extra={"username": job.username})
+
+    def _notify_queued_jobs(self) -> None:
+        for user_jobs in self._queued_jobs.values():
+            for job in user_jobs:
+                job.state_changed.set()
+
+
+job_scheduler: JobScheduler = JobScheduler()
@@ -0,0 +1,31 @@
+import torch
+
+from backend.metrics import metrics_registry
+from backend.transfer import GramMatrixCacheKey, gram_matrix_cache
+from app.scheduler import ScheduledJob, job_scheduler
+import app.metrics  # noqa: F401
+
+
+def test_started_jobs_are_active_before_their_model_is_built() -> None:
+    job: ScheduledJob = job_scheduler.enqueue("test_user")
+    try:
+        assert job.started
+        assert f"nst_active_jobs {job_scheduler.get_num_running_jobs()}" in metrics_registry.render()
+        assert job_scheduler.get_num_running_jobs() >= 1
+    finally:
+        job_scheduler.release(job)
+
+
+def test_gram_cache_statistics_are_exposed() -> None:
+    key = GramMatrixCacheKey("test_style_image", "vgg11", (8, 8), 0)
+    gram_matrix_cache.get(key)
+    gram_matrix_cache.put(key, torch.zeros(1, 4, 4))
+    gram_matrix_cache.get(key)
+    statistics: dict[str, int] = gram_matrix_cache.get_statistics()
+    rendered: str = metrics_registry.render()
+
+    assert "# TYPE nst_gram_cache_hits_total counter" in rendered
+    assert f"nst_gram_cache_hits_total {statistics['hits']}" in rendered
+    assert f"nst_gram_cache_misses_total {statistics['misses']}" in rendered
+    assert f"nst_gram_cache_evictions_total {statistics['evictions']}" in rendered
+    assert f"nst_gram_cache_size_bytes {statistics['size_bytes']}" in rendered
@@ -0,0 +1,12 @@
+from PIL import Image
+
+from app.previews import PreviewChangeDetector
+
+
+def test_preview_change_detector_skips_similar_previews() -> None:
+    change_detector = PreviewChangeDetector(min_change=0.01, thumbnail_size=8)
+
+    assert change_detector.is_changed(Image.new("RGB", (64, 64), (100, 100, 100)))
+    assert not change_detector.is_changed(Image.new("RGB", (64, 64), (101, 100, 100)))
+    assert change_detector.is_changed(Image.new("RGB", (64, 64), (150, 100, 100)))
+    assert not change_detector.is_changed(Image.new("RGB", (32, 32), (150, 100, 100)))
@@ -0,0 +1,49 @@
+import pytest
+
+from app.scheduler import JobScheduler, ScheduledJob
+from app.exceptions import QueueIsFullException
+
+
+def test_scheduler_starts_jobs_up_to_limit() -> None:
+    scheduler = JobScheduler(max_running_jobs=2, max_queued_jobs=2)
+    jobs: list[ScheduledJob] = [scheduler.enqueue(f"user_{idx}") for idx in range(4)]
+
+    assert [job.started for job in jobs] == [True, True, False, False]
+    assert scheduler.get_queue_position(jobs[2]) == 1
+    assert scheduler.get_queue_position(jobs[3]) == 2
+
+    with pytest.raises(QueueIsFullException):
+        scheduler.enqueue("user_4")
+
+    scheduler.release(jobs[0])
+    assert jobs[2].started
+    assert scheduler.get_queue_position(jobs[3]) == 1
+
+
+def test_scheduler_interleaves_users() -> None:
+    scheduler = JobScheduler(max_running_jobs=1, max_queued_jobs=10)
+    running_job: ScheduledJob = scheduler.enqueue("first_user")
+    first_user_jobs: list[ScheduledJob] = [scheduler.enqueue("first_user") for _ in range(3)]
+    second_user_job: ScheduledJob = scheduler.enqueue("second_user")
+
+    assert scheduler.get_queue_position(first_user_jobs[0]) == 1
+    assert scheduler.get_queue_position(second_user_job) == 2
+
+    scheduler.release(running_job)
+    scheduler.release(first_user_jobs[0])
+    assert second_user_job.started
+
+
+@pytest.mark.asyncio
+async def test_scheduler_streams_queue_position() -> None:
+    scheduler = JobScheduler(max_running_jobs=1, max_queued_jobs=10)
+    running_job: ScheduledJob = scheduler.enqueue("first_user")
+    queued_job: ScheduledJob = scheduler.enqueue("second_user")
+
+    positions: list[int] = []
+    async for position in scheduler.wait_for_start(queued_job):
+        positions.append(position)
+        scheduler.release(running_job)
+
+    assert positions == [1]
+    assert queued_job.started
@@ -0,0 +1,107 @@
+import pytest
+
+from PIL import Image
+
+from backend.config import Config
+from app.websocket_protocols import WebsocketImage, StartStyleTransferRequest, StyleTransferResponse, QueueStatusResponse
+from app.websocket_protocols import HandshakeResponse, negotiate_image_format, negotiate_protocol_version, get_frame_protocol_version
+from app.websocket_protocols import FRAME_HEADER, PROTOCOL_MAGIC, MessageType, encode_frame
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("image_format", ["raw", "jpeg", "png"])
+async def test_websocket_image_round_trip(image_format: str) -> None:
+    image: Image.Image = Image.new("RGB", (64, 48), (200, 100, 50))
+
+    websocket_image: WebsocketImage = await WebsocketImage.encode(image, image_format, quality=90)
+    decoded_image: Image.Image = await websocket_image.decode()
+
+    assert websocket_image.image_format == image_format
+    assert decoded_image.size == image.size
+    assert all(abs(decoded - original) <= 2 for decoded, original in zip(decoded_image.getpixel((10, 10)), (200, 100, 50)))
+
+
+def test_compressed_image_is_smaller_than_raw() -> None:
+    image: Image.Image = Image.new("RGB", (512, 512), (200, 100, 50))
+
+    assert len(WebsocketImage.from_pil_image(image, "jpeg").bytes_array) < len(WebsocketImage.from_pil_image(image).bytes_array) // 10
+
+
+def test_unknown_image_format_falls_back_to_png() -> None:
+    assert negotiate_image_format("jpeg") == "jpeg"
+    assert negotiate_image_format("bmp") == "png"
+
+
+def test_request_is_sent_in_one_frame() -> None:
+    image: WebsocketImage = WebsocketImage.from_pil_image(Image.new("RGB", (8, 6), (1, 2, 3)), "png")
+    request = StartStyleTransferRequest("test_user", image, WebsocketImage(b"style", (1, 1), "jpeg"), 100, [0, 12], [3, 4], 2.5,
+                                        optimizer="lbfgs", image_format="webp", image_quality=75, content_layer_weights=[1.0, 0.5],
+                                        style_layer_weights=[0.0, 2.0])
+
+    received_request: StartStyleTransferRequest = StartStyleTransferRequest.from_frame(request.to_frame())
+
+    assert received_request == request
+
+
+def test_truncated_and_malformed_requests_are_rejected() -> None:
+    request = StartStyleTransferRequest("test_user", WebsocketImage(b"content", (1, 1), "jpeg"), WebsocketImage(b"style", (1, 1), "jpeg"),
+                                        100, [0], [0, 1], 2.5)
+    frame: bytes = request.to_frame()
+    header: dict = {
+        "username": "test_user", "content_image": {"size": [1, 1], "format": "jpeg"}, "style_image": {"size": [1, 1], "format": "jpeg"},
+        "num_iteration": 100, "content_loss_layers_id": [0], "style_loss_layers_id": [0, 1], "alpha": 2.5,
+    }
+    malformed_frames: list[bytes] = [
+        frame[:FRAME_HEADER.size - 1],
+        frame[:FRAME_HEADER.size + 10],
+        frame[:-1],
+        FRAME_HEADER.pack(PROTOCOL_MAGIC, Config.protocol_version, MessageType.START_STYLE_TRANSFER_REQUEST, 5) + b"{bad}",
+        FRAME_HEADER.pack(PROTOCOL_MAGIC, Config.protocol_version, MessageType.START_STYLE_TRANSFER_REQUEST, 2) + b"[]",
+        FRAME_HEADER.pack(PROTOCOL_MAGIC, Config.protocol_version, MessageType.START_STYLE_TRANSFER_REQUEST, 2) + b"{}",
+        encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, header, [b"content"]),
+        encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, {**header, "num_iteration": "many"}, [b"content", b"style"]),
+        encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, {**header, "style_image": {"format": "jpeg"}}, [b"content", b"style"]),
+        encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, {key: value for key, value in header.items() if key != "alpha"},
+                     [b"content", b"style"]),
+    ]
+
+    assert StartStyleTransferRequest.from_frame(encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, header, [b"content", b"style"]))
+    for malformed_frame in malformed_frames:
+        with pytest.raises(AssertionError):
+            StartStyleTransferRequest.from_frame(malformed_frame)
+
+
+def test_responses_are_sent_in_one_frame() -> None:
+    response = StyleTransferResponse(WebsocketImage(b"image", (3, 4), "jpeg"), 100, 250, "converged", [[250, 1.5, 0.25, 4.0]],
+                                     peak_memory_bytes=2 ** 20)
+    queue_status = QueueStatusResponse("started", job_id=7)
+
+    assert StyleTransferResponse.from_frame(response.to_frame()) == response
+    assert QueueStatusResponse.from_frame(queue_status.to_frame()) == queue_status
+    with pytest.raises(AssertionError):
+        StyleTransferResponse.from_frame(queue_status.to_frame())
+
+
+def test_protocol_version_negotiation() -> None:
+    assert negotiate_protocol_version(Config.protocol_version + 1) == Config.protocol_version
+    assert negotiate_protocol_version(Config.min_protocol_version) == Config.min_protocol_version
+    with pytest.raises(AssertionError):
+        negotiate_protocol_version(Config.min_protocol_version - 1)
+
+
+def test_handshake_negotiates_version_or_rejects_client() -> None:
+    handshake = HandshakeResponse.from_client_protocol_version(Config.protocol_version + 1)
+    assert handshake.accepted
+    assert HandshakeResponse.from_frame(handshake.to_frame()) == HandshakeResponse(True, Config.protocol_version)
+
+    client_protocol_version: int = Config.min_protocol_version - 1
+    request_frame: bytes = StartStyleTransferRequest("test_user", WebsocketImage(b"content", (1, 1)), WebsocketImage(b"style", (1, 1)),
+                                                     100, [0], [1], 1.0, protocol_version=client_protocol_version).to_frame()
+    assert get_frame_protocol_version(request_frame) == client_protocol_version
+
+    rejection = HandshakeResponse.from_frame(
+        HandshakeResponse.from_client_protocol_version(client_protocol_version).to_frame(client_protocol_version)
+    )
+    assert not rejection.accepted
+    assert (rejection.min_protocol_version, rejection.max_protocol_version) == (Config.min_protocol_version, Config.protocol_version)
+    assert rejection.reason
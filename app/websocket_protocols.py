@@ -1,36 +1,185 @@
-from PIL import Image
+import json
+import enum
+import struct
+import asyncio
+import typing as tp
+
+from io import BytesIO
+from functools import partial
+from PIL import Image, features
 from fastapi import WebSocket
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from backend.config import Config
+
+
+# Every message is one binary frame: fixed header (magic, protocol version, message type, size of JSON header),
+# JSON header with message fields and sizes of binary payloads, and the payloads themselves
+PROTOCOL_MAGIC: bytes = b"NSTP"
+FRAME_HEADER: struct.Struct = struct.Struct("!4sBBI")
+
+
+class MessageType(enum.IntEnum):
+    START_STYLE_TRANSFER_REQUEST = 1
+    QUEUE_STATUS_RESPONSE = 2
+    STYLE_TRANSFER_RESPONSE = 3
+    HANDSHAKE_RESPONSE = 4
+
+
+# The first protocol version, which clients expect HandshakeResponse in. Rejections are sent to all clients
+HANDSHAKE_PROTOCOL_VERSION: int = 2
+
+
+def encode_frame(message_type: MessageType, header: dict[str, tp.Any], payloads: tp.Sequence[bytes] = (),
+                 protocol_version: int = Config.protocol_version) -> bytes:
+    """
+    :param message_type: type of the message
+    :param header: fields of the message. Has to be JSON serializable
+    :param payloads: binary payloads, e.g. encoded images
+    :param protocol_version: protocol version of the frame
+    :return: frame
+    """
+    header_bytes: bytes = json.dumps({**header, "payload_sizes": [len(payload) for payload in payloads]}).encode()
+    return b"".join([FRAME_HEADER.pack(PROTOCOL_MAGIC, protocol_version, message_type, len(header_bytes)), header_bytes, *payloads])
+
+
+def decode_frame(frame: bytes, expected_message_type: MessageType, num_payloads: int = 0) -> tuple[int, dict[str, tp.Any], list[bytes]]:
+    """
+    Malformed and truncated frames are rejected with AssertionError
+    :param frame: frame
+    :param expected_message_type: type of the message, which has to be in the frame
+    :param num_payloads: number of binary payloads of the message
+    :return: protocol version of the frame, fields of the message and binary payloads
+    """
+    assert len(frame) >= FRAME_HEADER.size, "Frame is too short!"
+    magic, protocol_version, message_type, header_size = FRAME_HEADER.unpack_from(frame)
+    assert magic == PROTOCOL_MAGIC, "Frame doesn't belong to style transfer protocol!"
+    assert message_type == expected_message_type, f"Expected {expected_message_type.name} message, but {message_type} met!"
+
+    offset: int = FRAME_HEADER.size + header_size
+    assert offset <= len(frame), "Frame is truncated in its header!"
+    header: tp.Any = _parse_header(frame[FRAME_HEADER.size:offset])
+    assert isinstance(header, dict), "Header of frame has to be JSON object!"
+    payload_sizes: tp.Any = header.pop("payload_sizes", None)
+    assert isinstance(payload_sizes, list) and all(isinstance(size, int) and size >= 0 for size in payload_sizes), \
+        "Header of frame has to contain non-negative sizes of payloads!"
+    assert len(payload_sizes) == num_payloads, f"Expected {num_payloads} payloads, but {len(payload_sizes)} met!"
+    payloads: list[bytes] = []
+    for payload_size in payload_sizes:
+        payloads.append(frame[offset:offset + payload_size])
+        offset += payload_size
+    assert offset == len(frame), "Size of frame doesn't match sizes of its payloads!"
+    return protocol_version, header, payloads
+
+
+def assert_has_fields(header: dict[str, tp.Any], field_names: tp.Iterable[str]) -> None:
+    """
+    :param header: fields of the message
+    :param field_names: names of required fields
+    """
+    missing_fields: list[str] = [field_name for field_name in field_names if field_name not in header]
+    assert not missing_fields, f"Message misses required fields {missing_fields}!"
+
+
+def _parse_header(header_bytes: bytes) -> tp.Any:
+    try:
+        return json.loads(header_bytes)
+    except ValueError as exc:
+        raise AssertionError(f"Header of frame isn't valid JSON: {exc}!") from exc
+
+
+def get_frame_protocol_version(frame: bytes) -> int:
+    """
+    Reads the version without decoding the message, so clients with unsupported versions can be answered
+    :param frame: frame
+    :return: protocol version of the frame
+    """
+    assert len(frame) >= FRAME_HEADER.size, "Frame is too short!"
+    magic, protocol_version, _, _ = FRAME_HEADER.unpack_from(frame)
+    assert magic == PROTOCOL_MAGIC, "Frame doesn't belong to style transfer protocol!"
+    return protocol_version
+
+
+def negotiate_protocol_version(client_protocol_version: int) -> int:
+    """
+    :param client_protocol_version: the latest protocol version supported by the client
+    :return: the latest version supported by both client and server. Responses are sent with this version
+    """
+    assert client_protocol_version >= Config.min_protocol_version, \
+        f"Protocol version {client_protocol_version} isn't supported anymore, the oldest supported is {Config.min_protocol_version}!"
+    return min(client_protocol_version, Config.protocol_version)
+
+
+def negotiate_image_format(image_format: str) -> str:
+    """
+    :param image_format: image format requested by the client
+    :return: requested format if server can encode it, PNG otherwise
+    """
+    if image_format not in Config.available_image_formats or (image_format == "webp" and not features.check("webp")):
+        return "png"
+    return image_format
 
 
 @dataclass
 class WebsocketImage:
+    """
+    Image is sent as raw RGB bytes or as encoded JPEG, WebP or PNG file. Its size and format are fields of message header,
+    and bytes are a payload of the frame
+    """
     bytes_array: bytes
     size: tuple[int, int]
+    image_format: str = "raw"
 
     @staticmethod
-    async def from_websocket(websocket: WebSocket) -> "WebsocketImage":
-        size_text = (await websocket.receive_text()).split()
-        size = (int(size_text[0]), int(size_text[1]))
-        bytes_array = await websocket.receive_bytes()
-        return WebsocketImage(bytes_array, size)
+    def from_header(header: dict[str, tp.Any], bytes_array: bytes) -> "WebsocketImage":
+        assert isinstance(header, dict), "Image header has to be JSON object!"
+        assert_has_fields(header, ("size", "format"))
+        assert header["format"] in Config.available_image_formats, f"Only {Config.available_image_formats} image formats are supported!"
+        return WebsocketImage(bytes_array, (int(header["size"][0]), int(header["size"][1])), header["format"])
 
-    async def to_websocket(self, websocket: WebSocket) -> None:
-        await websocket.send_text(str(self.size[0]) + " " + str(self.size[1]))
-        await websocket.send_bytes(self.bytes_array)
+    def to_header(self) -> dict[str, tp.Any]:
+        return {"size": list(self.size), "format": self.image_format}
+
+    @staticmethod
+    def from_pil_image(img: Image.Image, image_format: str = "raw", quality: int = Config.image_quality) -> "WebsocketImage":
+        if image_format == "raw":
+            return WebsocketImage(img.tobytes(), img.size)
+        stream: BytesIO = BytesIO()
+        img.convert("RGB").save(stream, format=image_format.upper(), quality=quality)
+        return WebsocketImage(stream.getvalue(), img.size, image_format)
 
     @staticmethod
-    def from_pil_image(img: Image.Image) -> Image:
-        bytes_array = img.tobytes()
-        size = img.size
-        return WebsocketImage(bytes_array, size)
+    async def encode(img: Image.Image, image_format: str = "raw", quality: int = Config.image_quality) -> "WebsocketImage":
+        """
+        Encodes image in the default executor, so the event loop isn't blocked
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, partial(WebsocketImage.from_pil_image, img, image_format, quality))
 
     def to_pil_image(self) -> Image:
-        return Image.frombytes("RGB", self.size, self.bytes_array)
+        if self.image_format == "raw":
+            return Image.frombytes("RGB", self.size, self.bytes_array)
+        with Image.open(BytesIO(self.bytes_array)) as img:
+            return img.convert("RGB")
+
+    async def decode(self) -> Image:
+        """
+        Decodes image in the default executor, so the event loop isn't blocked
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.to_pil_image)
 
 
 @dataclass
 class StartStyleTransferRequest:
+    """
+    image_format and image_quality are requested encoding of images in responses. Server falls back to PNG if it can't
+    encode requested format. preview_max_size and preview_fps are requested resolution and frame rate of progress
+    previews, server limits them by its maximums. profile requests per-stage timings in the final response.
+    precision of optimization is one of Config.available_precisions, empty string selects the default of the server.
+    content_layer_weights and style_layer_weights are weights of loss layers in order of their indexes, empty lists
+    select equal weights. Layers with zero weight are skipped.
+    protocol_version is the latest version supported by the client. After the handshake, server replaces it with the
+    negotiated version
+    """
     username: str
     content_image: WebsocketImage
     style_image: WebsocketImage
@@ -38,46 +187,226 @@ class StartStyleTransferRequest:
     content_loss_layers_id: list[int]
     style_loss_layers_id: list[int]
     alpha: float
+    optimizer: str = "adam"
+    engine: str = "optimization"
+    fast_style: str = ""
+    image_format: str = Config.default_image_format
+    image_quality: int = Config.image_quality
+    preview_max_size: int = Config.preview_max_size
+    preview_fps: float = Config.preview_fps
+    profile: bool = False
+    precision: str = ""
+    content_layer_weights: list[float] = field(default_factory=list)
+    style_layer_weights: list[float] = field(default_factory=list)
+    protocol_version: int = Config.protocol_version
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "StartStyleTransferRequest":
+        """
+        Malformed requests, e.g. with missing fields or fields of wrong types, are rejected with AssertionError
+        """
+        protocol_version, header, payloads = decode_frame(frame, MessageType.START_STYLE_TRANSFER_REQUEST, num_payloads=2)
+        assert_has_fields(header, ("username", "content_image", "style_image", "num_iteration", "content_loss_layers_id",
+                                   "style_loss_layers_id", "alpha"))
+        try:
+            return StartStyleTransferRequest._from_header(protocol_version, header, payloads)
+        except (TypeError, ValueError, IndexError) as exc:
+            raise AssertionError(f"Request has invalid fields: {exc}!") from exc
+
+    @staticmethod
+    def _from_header(protocol_version: int, header: dict[str, tp.Any], payloads: list[bytes]) -> "StartStyleTransferRequest":
+        return StartStyleTransferRequest(
+            username=header["username"],
+            content_image=WebsocketImage.from_header(header["content_image"], payloads[0]),
+            style_image=WebsocketImage.from_header(header["style_image"], payloads[1]),
+            num_iteration=int(header["num_iteration"]),
+            content_loss_layers_id=[int(elem) for elem in header["content_loss_layers_id"]],
+            style_loss_layers_id=[int(elem) for elem in header["style_loss_layers_id"]],
+            alpha=float(header["alpha"]),
+            optimizer=header.get("optimizer", "adam"),
+            engine=header.get("engine", "optimization"),
+            fast_style=header.get("fast_style", ""),
+            image_format=header.get("image_format", Config.default_image_format),
+            image_quality=int(header.get("image_quality", Config.image_quality)),
+            preview_max_size=int(header.get("preview_max_size", Config.preview_max_size)),
+            preview_fps=float(header.get("preview_fps", Config.preview_fps)),
+            profile=bool(header.get("profile", False)),
+            precision=header.get("precision", ""),
+            content_layer_weights=[float(elem) for elem in header.get("content_layer_weights", [])],
+            style_layer_weights=[float(elem) for elem in header.get("style_layer_weights", [])],
+            protocol_version=protocol_version,
+        )
+
+    def to_frame(self) -> bytes:
+        header: dict[str, tp.Any] = {
+            "username": self.username,
+            "content_image": self.content_image.to_header(),
+            "style_image": self.style_image.to_header(),
+            "num_iteration": self.num_iteration,
+            "content_loss_layers_id": self.content_loss_layers_id,
+            "style_loss_layers_id": self.style_loss_layers_id,
+            "alpha": self.alpha,
+            "optimizer": self.optimizer,
+            "engine": self.engine,
+            "fast_style": self.fast_style,
+            "image_format": self.image_format,
+            "image_quality": self.image_quality,
+            "preview_max_size": self.preview_max_size,
+            "preview_fps": self.preview_fps,
+            "profile": self.profile,
+            "precision": self.precision,
+            "content_layer_weights": self.content_layer_weights,
+            "style_layer_weights": self.style_layer_weights,
+        }
+        payloads: list[bytes] = [self.content_image.bytes_array, self.style_image.bytes_array]
+        return encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, header, payloads, self.protocol_version)
 
     @staticmethod
     async def from_websocket(websocket: WebSocket) -> "StartStyleTransferRequest":
-        username = await websocket.receive_text()
-        content_image = await WebsocketImage.from_websocket(websocket)
-        style_image = await WebsocketImage.from_websocket(websocket)
-        num_iteration = int(await websocket.receive_text())
-        content_loss_layers_id = [int(elem) for elem in (await websocket.receive_text()).split()]
-        style_loss_layers_id = [int(elem) for elem in (await websocket.receive_text()).split()]
-        alpha = float(await websocket.receive_text())
-        return StartStyleTransferRequest(username, content_image, style_image, num_iteration, content_loss_layers_id, style_loss_layers_id, alpha)
+        return StartStyleTransferRequest.from_frame(await websocket.receive_bytes())
 
     async def to_websocket(self, websocket: WebSocket) -> None:
-        await websocket.send_text(self.username)
-        await self.content_image.to_websocket(websocket)
-        await self.style_image.to_websocket(websocket)
-        await websocket.send_text(str(self.num_iteration))
-        await websocket.send_text(" ".join(*self.content_loss_layers_id))
-        await websocket.send_text(" ".join(*self.style_loss_layers_id))
-        await websocket.send_text(str(self.alpha))
+        await websocket.send_bytes(self.to_frame())
+
+
+@dataclass
+class HandshakeResponse:
+    """
+    Answer to StartStyleTransferRequest, sent before the first QueueStatusResponse. protocol_version is the negotiated
+    version of all following messages. Rejected clients get the range of supported versions and the reason, and the
+    connection is closed
+    """
+    accepted: bool
+    protocol_version: int
+    min_protocol_version: int = Config.min_protocol_version
+    max_protocol_version: int = Config.protocol_version
+    reason: str = ""
+
+    @staticmethod
+    def from_client_protocol_version(client_protocol_version: int) -> "HandshakeResponse":
+        """
+        :param client_protocol_version: the latest protocol version supported by the client
+        :return: accepted handshake with the negotiated version or rejection
+        """
+        try:
+            return HandshakeResponse(True, negotiate_protocol_version(client_protocol_version))
+        except AssertionError as exc:
+            return HandshakeResponse(False, client_protocol_version, reason=str(exc))
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "HandshakeResponse":
+        _, header, _ = decode_frame(frame, MessageType.HANDSHAKE_RESPONSE)
+        return HandshakeResponse(bool(header["accepted"]), int(header["protocol_version"]), int(header["min_protocol_version"]),
+                                 int(header["max_protocol_version"]), header.get("reason", ""))
+
+    def to_frame(self, protocol_version: int = Config.protocol_version) -> bytes:
+        header: dict[str, tp.Any] = {
+            "accepted": self.accepted,
+            "protocol_version": self.protocol_version,
+            "min_protocol_version": self.min_protocol_version,
+            "max_protocol_version": self.max_protocol_version,
+            "reason": self.reason,
+        }
+        return encode_frame(MessageType.HANDSHAKE_RESPONSE, header, protocol_version=protocol_version)
+
+    @staticmethod
+    async def from_websocket(websocket: WebSocket) -> "HandshakeResponse":
+        return HandshakeResponse.from_frame(await websocket.receive_bytes())
+
+    async def to_websocket(self, websocket: WebSocket, protocol_version: int = Config.protocol_version) -> None:
+        await websocket.send_bytes(self.to_frame(protocol_version))
+
+
+@dataclass
+class QueueStatusResponse:
+    """
+    Sent before the first StyleTransferResponse. Status is "queued" while job waits in the queue, then "started" or "rejected"
+    """
+    status: str
+    position: int = 0
+    job_id: tp.Optional[int] = None
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "QueueStatusResponse":
+        _, header, _ = decode_frame(frame, MessageType.QUEUE_STATUS_RESPONSE)
+        return QueueStatusResponse(header["status"], int(header["position"]), header.get("job_id"))
+
+    def to_frame(self, protocol_version: int = Config.protocol_version) -> bytes:
+        return encode_frame(MessageType.QUEUE_STATUS_RESPONSE, {"status": self.status, "position": self.position, "job_id": self.job_id},
+                            protocol_version=protocol_version)
+
+    @staticmethod
+    async def from_websocket(websocket: WebSocket) -> "QueueStatusResponse":
+        return QueueStatusResponse.from_frame(await websocket.receive_bytes())
+
+    async def to_websocket(self, websocket: WebSocket, protocol_version: int = Config.protocol_version) -> None:
+        await websocket.send_bytes(self.to_frame(protocol_version))
 
 
 @dataclass
 class StyleTransferResponse:
+    """
+    stop_reason is set only in the final response
+    """
     image: WebsocketImage
     completeness: int
+    num_iterations: int = 0
+    stop_reason: tp.Optional[str] = None
+    # [iteration, content loss, style loss, total loss] read back since the previous response
+    losses: list[list[float]] = field(default_factory=list)
+    # Per-stage timings of profiled job: stage name to its total_seconds, count and mean_seconds
+    stage_timings: dict[str, dict[str, float]] = field(default_factory=dict)
+    # Peak memory usage of the job in bytes, set only in the final response. 0 if it isn't measured
+    peak_memory_bytes: int = 0
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "StyleTransferResponse":
+        _, header, payloads = decode_frame(frame, MessageType.STYLE_TRANSFER_RESPONSE, num_payloads=1)
+        return StyleTransferResponse(
+            WebsocketImage.from_header(header["image"], payloads[0]),
+            int(header["completeness"]),
+            int(header["num_iterations"]),
+            header.get("stop_reason"),
+            header.get("losses", []),
+            header.get("stage_timings", {}),
+            int(header.get("peak_memory_bytes", 0)),
+        )
+
+    def to_frame(self, protocol_version: int = Config.protocol_version) -> bytes:
+        header: dict[str, tp.Any] = {
+            "image": self.image.to_header(),
+            "completeness": self.completeness,
+            "num_iterations": self.num_iterations,
+            "stop_reason": self.stop_reason,
+            "losses": self.losses,
+            "stage_timings": self.stage_timings,
+            "peak_memory_bytes": self.peak_memory_bytes,
+        }
+        return encode_frame(MessageType.STYLE_TRANSFER_RESPONSE, header, [self.image.bytes_array], protocol_version)
 
     @staticmethod
     async def from_websocket(websocket: WebSocket) -> "StyleTransferResponse":
-        image: WebsocketImage = await WebsocketImage.from_websocket(websocket)
-        completeness: int = int(await websocket.receive_text())
-        return StyleTransferResponse(image, completeness)
+        return StyleTransferResponse.from_frame(await websocket.receive_bytes())
 
-    async def to_websocket(self, websocket: WebSocket) -> None:
-        await self.image.to_websocket(websocket)
-        await websocket.send_text(str(self.completeness))
+    async def to_websocket(self, websocket: WebSocket, protocol_version: int = Config.protocol_version) -> None:
+        await websocket.send_bytes(self.to_frame(protocol_version))
+
+    @staticmethod
+    def from_pil_image(img: Image.Image, completeness: int = 0, num_iterations: int = 0,
+                       stop_reason: tp.Optional[str] = None) -> "StyleTransferResponse":
+        return StyleTransferResponse(WebsocketImage.from_pil_image(img), completeness, num_iterations, stop_reason)
 
     @staticmethod
-    def from_pil_image(img: Image.Image, completeness: int = 0) -> "StyleTransferResponse":
-        return StyleTransferResponse(WebsocketImage.from_pil_image(img), completeness)
+    async def encode(img: Image.Image, image_format: str, quality: int, completeness: int = 0, num_iterations: int = 0,
+                     stop_reason: tp.Optional[str] = None, losses: tp.Optional[list[list[float]]] = None,
+                     stage_timings: tp.Optional[dict[str, dict[str, float]]] = None) -> "StyleTransferResponse":
+        """
+        Encodes image in the default executor, so the event loop isn't blocked
+        """
+        return StyleTransferResponse(
+            await WebsocketImage.encode(img, image_format, quality), completeness, num_iterations, stop_reason, losses or [],
+            stage_timings or {},
+        )
 
     def to_pil_image(self) -> Image.Image:
         return self.image.to_pil_image()
@@ -0,0 +1,5 @@
+from .benchmark_transfer import BenchmarkCase, BenchmarkResult, get_benchmark_cases, run_benchmark_case, compare_results
+from .benchmark_transfer import get_tradeoffs, format_tradeoffs
+
+__all__ = ["BenchmarkCase", "BenchmarkResult", "get_benchmark_cases", "run_benchmark_case", "compare_results", "get_tradeoffs",
+           "format_tradeoffs"]
@@ -0,0 +1,338 @@
+import json
+import time
+import torch
+import asyncio
+import argparse
+import platform
+import itertools
+import typing as tp
+
+from pathlib import Path
+from PIL import Image
+from dataclasses import dataclass, asdict
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.transfer import StyleTransferProcessor, LossRecord, backbone_registry, gram_matrix_cache, compiled_step_cache
+
+
+logger = get_logger(__name__)
+
+# Metrics of results compared with baseline and whether their higher values are better
+COMPARED_METRICS: dict[str, bool] = {
+    "model_build_seconds": False,
+    "iterations_per_second": True,
+    "peak_memory_bytes": False,
+    "time_to_first_preview_seconds": False,
+}
+
+
+@dataclass(frozen=True)
+class BenchmarkCase:
+    pretrained_model_type: str
+    working_image_size: tuple[int, int]
+    content_loss_layers_id: tuple[int, ...]
+    style_loss_layers_id: tuple[int, ...]
+    num_threads: int
+    precision: str = "fp32"
+    channels_last: bool = False
+    step_compiler: tp.Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        content_layers: str = ",".join(map(str, self.content_loss_layers_id))
+        style_layers: str = ",".join(map(str, self.style_loss_layers_id))
+        memory_format: str = "channels_last" if self.channels_last else "nchw"
+        return f"{self.pretrained_model_type}/{self.working_image_size[0]}x{self.working_image_size[1]}/" \
+               f"{content_layers}:{style_layers}/{self.precision}/{memory_format}/{self.step_compiler or 'eager'}/threads={self.num_threads}"
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    pretrained_model_type: str
+    working_image_size: tuple[int, int]
+    content_loss_layers_id: tuple[int, ...]
+    style_loss_layers_id: tuple[int, ...]
+    num_threads: int
+    precision: str
+    channels_last: bool
+    step_compiler: tp.Optional[str]
+    num_iterations: int
+    model_build_seconds: float
+    iterations_per_second: float
+    peak_memory_bytes: int
+    time_to_first_preview_seconds: tp.Optional[float]
+    # Total loss after the last iteration. Comparing it between precisions shows the cost of reduced precision in quality
+    final_total_loss: tp.Optional[float]
+
+
+def get_benchmark_cases(pretrained_model_types: list[str],
+                        working_image_sizes: list[tuple[int, int]],
+                        layer_selections: list[tuple[tuple[int, ...], tuple[int, ...]]],
+                        num_threads: list[int],
+                        precisions: tp.Sequence[str] = ("fp32",),
+                        memory_formats: tp.Sequence[bool] = (False,),
+                        step_compilers: tp.Sequence[tp.Optional[str]] = (None,)) -> list[BenchmarkCase]:
+    """
+    :param pretrained_model_types: types of base models
+    :param working_image_sizes: (height, width) working sizes
+    :param layer_selections: pairs of content and style loss layers
+    :param num_threads: values of torch.set_num_threads
+    :param precisions: precisions of forward pass
+    :param memory_formats: whether channels_last memory format is used
+    :param step_compilers: compilers of optimization step, None for eager step
+    :return: all combinations of parameters
+    """
+    return [
+        BenchmarkCase(model_type, working_image_size, content_layers, style_layers, threads, precision, channels_last, step_compiler)
+        for model_type, working_image_size, (content_layers, style_layers), precision, channels_last, step_compiler, threads
+        in itertools.product(pretrained_model_types, working_image_sizes, layer_selections, precisions, memory_formats, step_compilers,
+                             num_threads)
+    ]
+
+
+def create_random_image(image_size: tuple[int, int], seed: int) -> Image.Image:
+    """
+    :param image_size: (height, width) of image
+    :param seed: seed of the noise
+    :return: RGB noise image
+    """
+    generator: torch.Generator = torch.Generator().manual_seed(seed)
+    pixels: torch.Tensor = torch.randint(0, 256, (*image_size, 3), dtype=torch.uint8, generator=generator)
+    return Image.frombytes("RGB", image_size[::-1], bytes(pixels.flatten().tolist()))
+
+
+def run_benchmark_case(case: BenchmarkCase, num_iterations: int, content_image: tp.Optional[Image.Image] = None,
+                       style_image: tp.Optional[Image.Image] = None) -> BenchmarkResult:
+    """
+    Transfers style between images resized to working size, noise images if they aren't set. Pyramid, early stopping and batching are disabled, so
+    every case makes exactly num_iterations iterations at its working size. Peak memory is measured per job, and Gram
+    matrix and compiled step caches are cleared, so results don't depend on cases run before. Base model is loaded
+    before the measurements, since it's loaded once per process
+    :param case: parameters of the case
+    :param num_iterations: number of iterations
+    :param content_image: content image
+    :param style_image: style image
+    :return: measurements of the case
+    """
+    content_image = create_random_image(case.working_image_size, seed=0) if content_image is None \
+        else content_image.convert("RGB").resize(case.working_image_size[::-1])
+    style_image = create_random_image(case.working_image_size, seed=1) if style_image is None \
+        else style_image.convert("RGB").resize(case.working_image_size[::-1])
+
+    backbone: torch.nn.Module = backbone_registry.get(case.pretrained_model_type)
+    gram_matrix_cache.clear()
+    compiled_step_cache.clear()
+
+    # Settings of the case are process-wide, so they are restored after the case
+    num_threads, channels_last, step_compiler = torch.get_num_threads(), Config.channels_last, Config.step_compiler
+    torch.set_num_threads(case.num_threads)
+    Config.channels_last, Config.step_compiler = case.channels_last, case.step_compiler
+    # Cached base model is converted in place, since the registry applies memory format only at loading
+    backbone.to(memory_format=torch.channels_last if case.channels_last else torch.contiguous_format)
+    try:
+        start_time: float = time.perf_counter()
+        processor = StyleTransferProcessor().configure(
+            "benchmark",
+            content_image,
+            style_image,
+            num_iterations,
+            list(case.content_loss_layers_id),
+            list(case.style_loss_layers_id),
+            alpha=float(Config.alpha),
+            pretrained_model_type=case.pretrained_model_type,
+            use_pyramid=False,
+            early_stopping=False,
+            working_image_size=case.working_image_size,
+            state_interval=0.0,
+            precision=case.precision,
+        )
+        model_build_seconds: float = time.perf_counter() - start_time
+        transfer_seconds, time_to_first_preview_seconds = asyncio.run(_measure_transfer(processor))
+    finally:
+        torch.set_num_threads(num_threads)
+        Config.channels_last, Config.step_compiler = channels_last, step_compiler
+        backbone.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+    loss_history: list[LossRecord] = processor.get_loss_history()
+
+    return BenchmarkResult(
+        name=case.name,
+        pretrained_model_type=case.pretrained_model_type,
+        working_image_size=case.working_image_size,
+        content_loss_layers_id=case.content_loss_layers_id,
+        style_loss_layers_id=case.style_loss_layers_id,
+        num_threads=case.num_threads,
+        precision=case.precision,
+        channels_last=case.channels_last,
+        step_compiler=case.step_compiler,
+        num_iterations=processor.get_num_completed_iterations(),
+        model_build_seconds=model_build_seconds,
+        iterations_per_second=processor.get_num_completed_iterations() / transfer_seconds,
+        peak_memory_bytes=processor.get_peak_memory_usage(),
+        time_to_first_preview_seconds=time_to_first_preview_seconds,
+        final_total_loss=loss_history[-1].total_loss if loss_history else None,
+    )
+
+
+async def _measure_transfer(processor: StyleTransferProcessor) -> tuple[float, tp.Optional[float]]:
+    """
+    :return: duration of the transfer and time from its start to the first intermediate state. The latter is None if
+    no state was published
+    """
+    start_time: float = time.perf_counter()
+    style_transfer_task: asyncio.Task = asyncio.create_task(processor.transfer_style())
+    time_to_first_preview: tp.Optional[float] = None
+    async for _ in processor.get_transfer_states():
+        if time_to_first_preview is None:
+            time_to_first_preview = time.perf_counter() - start_time
+    await style_transfer_task
+    return time.perf_counter() - start_time, time_to_first_preview
+
+
+def compare_results(results: list[dict[str, tp.Any]], baseline: list[dict[str, tp.Any]], tolerance: float) -> list[str]:
+    """
+    :param results: current results
+    :param baseline: saved results
+    :param tolerance: allowed relative degradation of every metric
+    :return: descriptions of regressions of cases present in both results
+    """
+    baseline_by_name: dict[str, dict[str, tp.Any]] = {result["name"]: result for result in baseline}
+    regressions: list[str] = []
+    for result in results:
+        baseline_result: tp.Optional[dict[str, tp.Any]] = baseline_by_name.get(result["name"])
+        if baseline_result is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value, baseline_value = result[metric], baseline_result[metric]
+            if value is None or baseline_value is None or baseline_value <= 0:
+                continue
+            relative_change: float = (value - baseline_value) / baseline_value
+            if (-relative_change if higher_is_better else relative_change) > tolerance:
+                regressions.append(f"{result['name']}: {metric} {baseline_value:.4g} -> {value:.4g} ({100 * relative_change:+.1f}%)")
+    return regressions
+
+
+def get_tradeoffs(results: list[dict[str, tp.Any]]) -> list[dict[str, tp.Any]]:
+    """
+    Compares every case with its eager fp32 NCHW counterpart that has the same other parameters
+    :param results: results of benchmark cases
+    :return: speedups of iterations per second and relative changes of final loss of reduced precision, channels_last
+    and compiled cases
+    """
+    def get_reference_name(result: dict[str, tp.Any]) -> str:
+        return BenchmarkCase(
+            result["pretrained_model_type"], tuple(result["working_image_size"]), tuple(result["content_loss_layers_id"]),
+            tuple(result["style_loss_layers_id"]), result["num_threads"],
+        ).name
+
+    results_by_name: dict[str, dict[str, tp.Any]] = {result["name"]: result for result in results}
+    tradeoffs: list[dict[str, tp.Any]] = []
+    for result in results:
+        reference: tp.Optional[dict[str, tp.Any]] = results_by_name.get(get_reference_name(result))
+        if reference is None or reference is result:
+            continue
+        final_loss_change: tp.Optional[float] = None
+        if result["final_total_loss"] is not None and reference["final_total_loss"]:
+            final_loss_change = (result["final_total_loss"] - reference["final_total_loss"]) / reference["final_total_loss"]
+        tradeoffs.append({
+            "name": result["name"],
+            "reference": reference["name"],
+            "speedup": result["iterations_per_second"] / reference["iterations_per_second"],
+            "final_loss_relative_change": final_loss_change,
+        })
+    return tradeoffs
+
+
+def format_tradeoffs(tradeoffs: list[dict[str, tp.Any]]) -> str:
+    """
+    :param tradeoffs: output of get_tradeoffs()
+    :return: Markdown table of speedups and final loss changes, which can be committed as evidence of the tradeoffs
+    """
+    lines: list[str] = ["| case | reference | speedup | final loss change |", "| --- | --- | --- | --- |"]
+    for tradeoff in tradeoffs:
+        final_loss_change: tp.Optional[float] = tradeoff["final_loss_relative_change"]
+        lines.append(f"| {tradeoff['name']} | {tradeoff['reference']} | {tradeoff['speedup']:.2f}x | "
+                     f"{'n/a' if final_loss_change is None else f'{100 * final_loss_change:+.2f}%'} |")
+    return "\n".join(lines) + "\n"
+
+
+def _parse_image_size(value: str) -> tuple[int, int]:
+    height, width = value.lower().split("x")
+    return int(height), int(width)
+
+
+def _parse_layer_selection(value: str) -> tuple[tuple[int, ...], tuple[int, ...]]:
+    content_layers, style_layers = value.split(":")
+    return tuple(map(int, content_layers.split(","))), tuple(map(int, style_layers.split(",")))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark throughput of style transfer with randomly initialized base models.")
+    parser.add_argument("--backbones", nargs="+", default=["vgg11", "vgg13", "vgg16", "vgg19"], help="types of base models")
+    parser.add_argument("--sizes", nargs="+", type=_parse_image_size, default=[(128, 128), (256, 256)],
+                        help="working sizes as HEIGHTxWIDTH")
+    parser.add_argument("--layers", nargs="+", type=_parse_layer_selection, default=[((1,), (0, 1, 2)), ((3,), (0, 1, 2, 3, 4))],
+                        help="content and style loss layers as CONTENT:STYLE, e.g. 3:0,1,2,3,4")
+    parser.add_argument("--threads", nargs="+", type=int, default=[torch.get_num_threads()], help="values of torch.set_num_threads")
+    parser.add_argument("--precisions", nargs="+", default=["fp32"], choices=Config.available_precisions, help="precisions of forward pass")
+    parser.add_argument("--memory-formats", nargs="+", default=["nchw"], choices=["nchw", "channels_last"], help="memory formats")
+    parser.add_argument("--step-compilers", nargs="+", default=["eager"], choices=["eager", *Config.available_step_compilers],
+                        help="compilers of optimization step. Compilation happens during the first iteration of every case")
+    parser.add_argument("--iterations", type=int, default=20, help="number of iterations of every case")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"), help="path to JSON results")
+    parser.add_argument("--summary", type=Path, help="path to Markdown table of speedups and final loss changes")
+    parser.add_argument("--compare", type=Path, help="path to JSON results of baseline. Exit code is 1 if there are regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative degradation of every metric")
+    parser.add_argument("--pretrained", action="store_true", help="use pretrained weights instead of random ones")
+    parser.add_argument("--content-image", type=Path, help="content image, resized to working size. Noise image if not set")
+    parser.add_argument("--style-image", type=Path, help="style image, resized to working size. Noise image if not set")
+    args = parser.parse_args()
+
+    Config.use_pretrained_weights = args.pretrained
+    Config.batched_transfer = False
+    results: list[dict[str, tp.Any]] = []
+    memory_formats: list[bool] = [memory_format == "channels_last" for memory_format in args.memory_formats]
+    step_compilers: list[tp.Optional[str]] = [None if step_compiler == "eager" else step_compiler for step_compiler in args.step_compilers]
+    content_image: tp.Optional[Image.Image] = Image.open(args.content_image) if args.content_image is not None else None
+    style_image: tp.Optional[Image.Image] = Image.open(args.style_image) if args.style_image is not None else None
+    for case in get_benchmark_cases(args.backbones, args.sizes, args.layers, args.threads, args.precisions, memory_formats, step_compilers):
+        result: BenchmarkResult = run_benchmark_case(case, args.iterations, content_image, style_image)
+        logger.info(f"{case.name}: {result.iterations_per_second:.2f} it/s, build {result.model_build_seconds:.3f}s, "
+                    f"first preview {result.time_to_first_preview_seconds}s, peak memory {result.peak_memory_bytes / 2 ** 20:.1f} MB.")
+        results.append(asdict(result))
+
+    tradeoffs: list[dict[str, tp.Any]] = get_tradeoffs(results)
+    for tradeoff in tradeoffs:
+        logger.info(f"{tradeoff['name']}: {tradeoff['speedup']:.2f}x speed, final loss change "
+                    f"{tradeoff['final_loss_relative_change']} compared with {tradeoff['reference']}.")
+    report: dict[str, tp.Any] = {
+        "environment": {
+            "torch_version": torch.__version__,
+            "device": str(Config.device),
+            "platform": platform.platform(),
+            "pretrained_weights": args.pretrained,
+            "content_image": str(args.content_image) if args.content_image is not None else "noise",
+            "style_image": str(args.style_image) if args.style_image is not None else "noise",
+            "num_iterations": args.iterations,
+        },
+        "results": results,
+        "tradeoffs": tradeoffs,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    logger.info(f"Saved benchmark results to {args.output}.")
+    if args.summary is not None:
+        args.summary.write_text(format_tradeoffs(tradeoffs))
+
+    if args.compare is not None:
+        baseline: list[dict[str, tp.Any]] = json.loads(args.compare.read_text())["results"]
+        regressions: list[str] = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}.")
+        if regressions:
+            raise SystemExit(1)
+        logger.info(f"No regressions compared with {args.compare}.")
+
+
+if __name__ == "__main__":
+    main()
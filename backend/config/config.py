@@ -1,4 +1,5 @@
 import torch
+import typing as tp
 
 from pathlib import Path
 
@@ -7,6 +8,15 @@ class Config:
     # Path to backend package
     path_to_backend: Path = Path(__file__).absolute().parent.parent.resolve()
 
+    # Path for downloading pretrained base models
+    path_to_pretrained_models: Path = path_to_backend / "transfer/pretrained"
+
+    # Load pretrained weights of base models. Randomly initialized weights are used otherwise, e.g. by offline benchmarks
+    use_pretrained_weights: bool = True
+
+    # Base models that are loaded once at server startup. Other types are loaded on the first request
+    preloaded_base_models: list[str] = ["vgg11"]
+
     # The device on which the calculations take place
     # Default value depends on your system (GPU or CPU)
     device: torch.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -15,12 +25,163 @@ class Config:
     normalization_mean: torch.Tensor = torch.tensor([0.485, 0.456, 0.406]).view(-1, 1, 1).to(device)
     normalization_std: torch.Tensor = torch.tensor([0.229, 0.224, 0.225]).view(-1, 1, 1).to(device)
 
+    # Directory with checkpoints of trained fast style models, one {style_name}.pth per style
+    path_to_fast_style_models: Path = path_to_backend / "transfer/fast_styles"
+
+    # Larger side of content image is reduced to this size before fast style transfer
+    fast_style_max_image_size: int = 1024
+
+    # Checkpoint of trained AdaIN decoder for arbitrary style transfer
+    path_to_adain_model: Path = path_to_backend / "transfer/adain/decoder.pth"
+
+    # Indexes of convolutional layers of base model used by AdaIN encoder. The deepest one is the encoder output,
+    # all of them are used for style loss during training. For vgg11 they are relu1_1, relu2_1, relu3_1 and relu4_1
+    adain_encoder_layers_id: list[int] = [0, 1, 2, 4]
+
+    # Larger side of content and style images is reduced to this size before AdaIN style transfer
+    adain_max_image_size: int = 512
+
+    # Default interpolation between content features (0) and AdaIN features (1)
+    adain_style_strength: float = 1.0
+
     # Before style transfer, input images will be resized to this size.
     working_image_size: tuple[int, int] = (256, 256)
 
+    # Maximum total size of cached style Gram matrices in bytes
+    gram_cache_max_size_bytes: int = 256 * 2 ** 20
+
+    # Target peak memory of activations in bytes. If set, the model is split into checkpointed segments that are
+    # recomputed during backward pass, so high working resolutions fit into memory. None disables checkpointing
+    memory_budget_bytes: tp.Optional[int] = None
+
+    # Optimize on coarse-to-fine pyramid: first at reduced resolution, then upsample the result and refine it
+    use_pyramid: bool = False
+
+    # Scales of working image size of pyramid levels and shares of iterations spent on every level
+    pyramid_scales: tuple[float, ...] = (0.25, 0.5, 1.0)
+    pyramid_iteration_ratios: tuple[float, ...] = (0.5, 0.3, 0.2)
+
+    # Minimum side of working image on pyramid levels
+    min_pyramid_image_size: int = 32
+
+    # Style transfer engines: per-image optimization, trained per-style networks and arbitrary style AdaIN network
+    available_engines: tuple[str, ...] = ("optimization", "fast_style", "adain")
+
+    # Precision of forward pass of optimization engine: fp32 or bfloat16 autocast. Gram matrices and losses are
+    # always accumulated in fp32. precision is the default of the deployment, requests can select another one
+    available_precisions: tuple[str, ...] = ("fp32", "bf16")
+    precision: str = "fp32"
+
+    # Keep base models and optimized images in channels_last memory format, which speeds up convolutions on modern CPUs
+    channels_last: bool = False
+
+    # Compiler of the optimization step: forward pass, losses and their weighted sum are fused into one graph by
+    # torch.compile or TorchScript tracing. None runs the step eagerly layer by layer
+    available_step_compilers: tuple[str, ...] = ("torch_compile", "torchscript")
+    step_compiler: tp.Optional[str] = None
+
+    # Maximum number of compiled steps kept in memory. A step is compiled once per base model, working size and loss layers
+    max_compiled_steps: int = 16
+
+    # Optimizers available for style transfer and their learning rates
+    available_optimizers: tuple[str, ...] = ("adam", "adamw", "rmsprop", "lbfgs")
+    optimizer_learning_rates: dict[str, float] = {"adam": 0.01, "adamw": 0.01, "rmsprop": 0.01, "lbfgs": 1.0}
+
+    # Maximum number of L-BFGS iterations per optimization step. Every L-BFGS function evaluation is counted
+    # as one style transfer iteration
+    lbfgs_max_iter: int = 20
+
+    # Per-iteration losses are accumulated on device and read back to host every loss_telemetry_interval iterations.
+    # Only the latest max_loss_history_size values of a job are kept
+    loss_telemetry_interval: int = 10
+    max_loss_history_size: int = 10000
+
+    # Stop transfer when the loss reaches plateau: its relative decrease over the sliding window of values, taken at
+    # every read back of losses, is less than early_stopping_min_relative_improvement
+    early_stopping: bool = True
+    early_stopping_window_size: int = 5
+    early_stopping_min_relative_improvement: float = 1e-3
+    early_stopping_min_iterations: int = 50
+
     # Style loss coefficient in total loss
     alpha: torch.Tensor = torch.tensor(10000, device=device)
 
+    # Optimize compatible concurrent jobs (same base model, working size and loss layers) in one batch
+    batched_transfer: bool = True
+
+    # Maximum number of jobs optimized in one batch
+    max_batch_size: int = 8
+
+    # Default interval in seconds between intermediate transfer states sent to the client
+    transfer_state_interval: float = 1.0
+
+    # Maximum number of intermediate transfer states waiting to be sent. Older states are dropped, so if the client
+    # consumes previews slower than they are produced, e.g. socket send buffer is backed up, it gets only the latest one
+    max_pending_transfer_states: int = 1
+
+    # Number of worker threads that render snapshots of running transfers into preview images
+    max_preview_workers: int = 1
+
+    # Default and maximum larger side of progress previews. The result is always sent at full resolution
+    preview_max_size: int = 512
+    max_preview_size: int = 1024
+
+    # Default and maximum frame rate of progress previews
+    preview_fps: float = 1.0
+    max_preview_fps: float = 4.0
+
+    # Preview isn't sent if mean absolute difference from the last sent one is less than this value in [0, 1].
+    # Previews are compared by thumbnails of preview_thumbnail_size
+    preview_min_change: float = 0.005
+    preview_thumbnail_size: int = 32
+
+    # Split content images larger than working image size into overlapping tiles that are transferred at native resolution
+    tiled_transfer: bool = False
+
+    # Overlap of neighbouring tiles in pixels. Tiles are blended with linear weights inside overlaps
+    tile_overlap: int = 32
+
+    # Maximum number of tiles of one image transferred at once
+    max_parallel_tiles: int = 4
+
+    # Maximum number of concurrently running style transfer jobs. Every running job, batch of jobs and tile of tiled job
+    # holds one worker thread of transfer executor for the whole transfer, so the executor is sized from this limit
+    max_running_jobs: int = 8
+
+    # Maximum number of jobs waiting for start. New jobs are rejected if the queue is full
+    max_queued_jobs: int = 32
+
+    # The latest version of websocket protocol. Client and server use the latest version supported by both of them.
+    # Since version 2 the server answers every request with HandshakeResponse before the first queue status
+    protocol_version: int = 2
+
+    # The oldest version of websocket protocol still supported by the server
+    min_protocol_version: int = 1
+
+    # Image formats of websocket protocol. Raw is uncompressed RGB bytes
+    available_image_formats: tuple[str, ...] = ("raw", "jpeg", "webp", "png")
+
+    # Image format of responses if client doesn't request another one
+    default_image_format: str = "jpeg"
+
+    # Quality of JPEG and WebP encoding from 1 to 100
+    image_quality: int = 90
+
+    # Fraction of jobs profiled even if client doesn't request it. Stages of profiled jobs are timed with device
+    # synchronization, so profiled jobs are slower and aren't batched with other jobs
+    profiling_sample_rate: float = 0.0
+
+    # torch.profiler records a trace of profiled job for profiler_trace_num_iterations iterations starting from
+    # profiler_trace_start_iteration. 0 iterations disables traces
+    profiler_trace_start_iteration: int = 5
+    profiler_trace_num_iterations: int = 5
+
+    # Directory of Chrome trace files of profiled jobs
+    path_to_profiler_traces: Path = path_to_backend / "traces"
+
+    # Upper bounds in seconds of buckets of latency histograms exposed on /metrics
+    latency_buckets: tuple[float, ...] = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
     # Enable debug mode
     debug: bool = True
 
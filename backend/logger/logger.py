@@ -64,7 +64,12 @@ LOGGING_CONFIG = {
             "level": LOGGING_LEVEL,
             "propagate": False,
         },
-        "backend.transfer.nst_model": {
+        "app.scheduler": {
+            "handlers": ["app_handler"],
+            "level": LOGGING_LEVEL,
+            "propagate": False,
+        },
+        "backend.transfer.telemetry": {
             "handlers": ["backend_nst_model_handler"],
             "level": LOGGING_LEVEL,
             "propagate": False,
@@ -74,6 +79,11 @@ LOGGING_CONFIG = {
             "level": LOGGING_LEVEL,
             "propagate": False,
         },
+        "backend.transfer.tiling": {
+            "handlers": ["backend_transfer_handler"],
+            "level": LOGGING_LEVEL,
+            "propagate": False,
+        },
     },
 }
 
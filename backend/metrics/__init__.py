@@ -0,0 +1,5 @@
+from .metrics import Metric, Counter, Gauge, Histogram, MetricsRegistry, LabelValues, metrics_registry, format_image_size
+
+__all__ = [
+    "Metric", "Counter", "Gauge", "Histogram", "MetricsRegistry", "LabelValues", "metrics_registry", "format_image_size",
+]
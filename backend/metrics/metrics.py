@@ -0,0 +1,225 @@
+import abc
+import math
+import bisect
+import threading
+import typing as tp
+
+
+LabelValues = tuple[str, ...]
+Sample = tuple[str, dict[str, str], float]
+
+
+def format_image_size(image_size: tuple[int, int]) -> str:
+    """
+    :param image_size: (height, width) of image
+    :return: label value of image size, e.g. "256x384"
+    """
+    return f"{image_size[0]}x{image_size[1]}"
+
+
+class Metric(abc.ABC):
+    """
+    Base class of metrics exposed in Prometheus text format. Values of labelled metrics are kept per combination of label values
+    """
+    metric_type: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: tp.Sequence[str] = ()) -> None:
+        """
+        :param name: metric name
+        :param documentation: metric description
+        :param label_names: names of labels, which have to be passed to every update of the metric
+        """
+        self._name: str = name
+        self._documentation: str = documentation
+        self._label_names: LabelValues = tuple(label_names)
+        self._lock: threading.Lock = threading.Lock()
+
+    def get_name(self) -> str:
+        return self._name
+
+    @abc.abstractmethod
+    def collect(self) -> list[Sample]:
+        """
+        :return: samples of the metric as (name suffix, labels, value)
+        """
+
+    def render(self) -> str:
+        lines: list[str] = [f"# HELP {self._name} {self._documentation}", f"# TYPE {self._name} {self.metric_type}"]
+        for suffix, labels, value in self.collect():
+            lines.append(f"{self._name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+    def _get_label_values(self, labels: dict[str, tp.Any]) -> LabelValues:
+        assert set(labels) == set(self._label_names), f"Metric {self._name} requires labels {self._label_names}!"
+        return tuple(str(labels[label_name]) for label_name in self._label_names)
+
+    def _to_labels(self, label_values: LabelValues) -> dict[str, str]:
+        return dict(zip(self._label_names, label_values))
+
+
+class Counter(Metric):
+    """
+    Counter is either incremented explicitly or read at collection time by a function from a source that counts itself
+    """
+    metric_type: str = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tp.Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+        self._function: tp.Optional[tp.Callable[[], dict[LabelValues, float]]] = None
+
+    def inc(self, amount: float = 1.0, **labels: tp.Any) -> None:
+        assert amount >= 0, "Counter can only increase!"
+        label_values: LabelValues = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def get(self, **labels: tp.Any) -> float:
+        with self._lock:
+            return self._values.get(self._get_label_values(labels), 0.0)
+
+    def set_function(self, function: tp.Callable[[], dict[LabelValues, float]]) -> None:
+        """
+        :param function: returns monotonically increasing values of the counter by label values in order of label names.
+        Unlabelled counter uses () as key
+        """
+        self._function = function
+
+    def collect(self) -> list[Sample]:
+        if self._function is not None:
+            values: dict[LabelValues, float] = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [("", self._to_labels(label_values), value) for label_values, value in values.items()]
+
+
+class Gauge(Metric):
+    """
+    Gauge is either set explicitly or computed by a function at collection time
+    """
+    metric_type: str = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: tp.Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+        self._function: tp.Optional[tp.Callable[[], dict[LabelValues, float]]] = None
+
+    def set(self, value: float, **labels: tp.Any) -> None:
+        label_values: LabelValues = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, amount: float = 1.0, **labels: tp.Any) -> None:
+        label_values: LabelValues = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: tp.Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: tp.Callable[[], dict[LabelValues, float]]) -> None:
+        """
+        :param function: returns values of the gauge by label values in order of label names. Unlabelled gauge uses () as key
+        """
+        self._function = function
+
+    def collect(self) -> list[Sample]:
+        if self._function is not None:
+            values: dict[LabelValues, float] = self._function()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [("", self._to_labels(label_values), value) for label_values, value in values.items()]
+
+
+class Histogram(Metric):
+    metric_type: str = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tp.Sequence[str] = (),
+                 buckets: tp.Sequence[float] = (0.1, 0.5, 1.0, 5.0, 10.0, 60.0)) -> None:
+        """
+        :param buckets: upper bounds of buckets. +Inf bucket is always added
+        """
+        super().__init__(name, documentation, label_names)
+        assert "le" not in self._label_names, "Label le is reserved for buckets of histogram!"
+        self._buckets: tuple[float, ...] = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: tp.Any) -> None:
+        label_values: LabelValues = self._get_label_values(labels)
+        with self._lock:
+            counts: list[int] = self._counts.setdefault(label_values, [0] * len(self._buckets))
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._sums[label_values] = self._sums.get(label_values, 0.0) + value
+
+    def get_count(self, **labels: tp.Any) -> int:
+        with self._lock:
+            return sum(self._counts.get(self._get_label_values(labels), []))
+
+    def collect(self) -> list[Sample]:
+        samples: list[Sample] = []
+        with self._lock:
+            for label_values, counts in self._counts.items():
+                labels: dict[str, str] = self._to_labels(label_values)
+                cumulative_count: int = 0
+                for upper_bound, count in zip(self._buckets, counts):
+                    cumulative_count += count
+                    samples.append(("_bucket", {**labels, "le": _format_value(upper_bound)}, cumulative_count))
+                samples.append(("_sum", labels, self._sums[label_values]))
+                samples.append(("_count", labels, cumulative_count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Metrics of the process, rendered in Prometheus text exposition format
+    """
+    content_type: str = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            assert metric.get_name() not in self._metrics, f"Metric {metric.get_name()} is already registered!"
+            self._metrics[metric.get_name()] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: tp.Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: tp.Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: tp.Sequence[str] = (),
+                  buckets: tp.Sequence[float] = (0.1, 0.5, 1.0, 5.0, 10.0, 60.0)) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics: list[Metric] = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+metrics_registry: MetricsRegistry = MetricsRegistry()
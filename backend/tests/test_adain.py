@@ -0,0 +1,56 @@
+import torch
+import pytest
+import typing as tp
+
+from PIL import Image
+from pathlib import Path
+
+from backend.config import Config
+from backend.training import train_adain_model
+from backend.transfer import AdaINModel, AdaINCheckpoint, AdaINModelRegistry
+from backend.transfer.adain import adaptive_instance_normalization, get_mean_std
+
+
+@pytest.fixture(scope="module")
+def content_image() -> tp.Generator[Image.Image, None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/content_img.png") as image:
+        yield image
+
+
+@pytest.fixture(scope="module")
+def style_image() -> tp.Generator[Image.Image, None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/style_img.png") as image:
+        yield image
+
+
+def test_adaptive_instance_normalization_matches_style_statistics() -> None:
+    content_features: torch.Tensor = torch.randn(2, 8, 16, 16)
+    style_features: torch.Tensor = 3 * torch.randn(2, 8, 10, 12) + 5
+
+    result_mean, result_std = get_mean_std(adaptive_instance_normalization(content_features, style_features))
+    style_mean, style_std = get_mean_std(style_features)
+
+    assert torch.allclose(result_mean, style_mean, atol=1e-4)
+    assert torch.allclose(result_std, style_std, atol=1e-3)
+
+
+def test_adain_model_keeps_content_size() -> None:
+    model = AdaINModel("vgg11", [0, 1, 2, 4]).to(Config.device)
+    output: torch.Tensor = model(torch.rand(1, 3, 64, 96, device=Config.device), torch.rand(1, 3, 48, 48, device=Config.device))
+
+    assert model.encoder.get_size_multiple() == 8
+    assert output.shape == (1, 3, 64, 96)
+
+
+def test_adain_checkpoint_can_be_loaded(content_image: Image.Image, style_image: Image.Image, tmp_path: Path) -> None:
+    content_image.save(tmp_path / "content.png")
+    style_image.save(tmp_path / "style.png")
+    checkpoint: AdaINCheckpoint = train_adain_model([tmp_path / "content.png"], [tmp_path / "style.png"], image_size=32,
+                                                    num_steps=2, batch_size=1)
+    checkpoint.save(tmp_path / "adain/decoder.pth")
+
+    registry = AdaINModelRegistry(tmp_path / "adain/decoder.pth")
+    model: AdaINModel = registry.get()
+
+    assert registry.get() is model
+    assert all(torch.equal(param.cpu(), checkpoint.decoder_state_dict[name]) for name, param in model.decoder.state_dict().items())
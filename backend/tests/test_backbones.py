@@ -0,0 +1,37 @@
+import torch
+import pytest
+import typing as tp
+
+from PIL import Image
+
+from backend.config import Config
+from backend.transfer import NSTModel, BackboneRegistry
+
+
+@pytest.fixture(scope="module")
+def content_image() -> tp.Generator[Image.Image, None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/content_img.png") as image:
+        yield image
+
+
+@pytest.fixture(scope="module")
+def style_image() -> tp.Generator[Image.Image, None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/style_img.png") as image:
+        yield image
+
+
+def test_backbone_registry_loads_model_once() -> None:
+    registry = BackboneRegistry()
+    base_model: torch.nn.Module = registry.get("vgg11")
+
+    assert registry.get("vgg11") is base_model
+    assert all(not param.requires_grad for param in base_model.parameters())
+
+
+def test_nst_models_share_backbone_weights(content_image: Image.Image, style_image: Image.Image) -> None:
+    first_model = NSTModel("first_user", content_image, style_image)
+    second_model = NSTModel("second_user", content_image, style_image)
+
+    first_conv: torch.nn.Conv2d = next(layer for layer in first_model._model.children() if isinstance(layer, torch.nn.Conv2d))
+    second_conv: torch.nn.Conv2d = next(layer for layer in second_model._model.children() if isinstance(layer, torch.nn.Conv2d))
+    assert first_conv.weight.data_ptr() == second_conv.weight.data_ptr()
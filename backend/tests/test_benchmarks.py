@@ -0,0 +1,97 @@
+import torch
+import pytest
+
+from PIL import Image
+from dataclasses import asdict
+
+from backend.config import Config
+from backend.transfer import backbone_registry, gram_matrix_cache
+from backend.benchmarks import BenchmarkResult, get_benchmark_cases, run_benchmark_case, compare_results, get_tradeoffs
+from backend.benchmarks import format_tradeoffs
+
+
+def test_benchmark_cases_sweep_all_parameters() -> None:
+    cases = get_benchmark_cases(["vgg11", "vgg19"], [(64, 64), (128, 96)], [((1,), (0, 1))], [1, 2])
+
+    assert len(cases) == 8
+    assert len({case.name for case in cases}) == 8
+    assert cases[0].name == "vgg11/64x64/1:0,1/fp32/nchw/eager/threads=1"
+
+
+def test_tradeoffs_compare_with_fp32_nchw_case() -> None:
+    cases = get_benchmark_cases(["vgg11"], [(64, 64)], [((1,), (0, 1))], [1], ["fp32", "bf16"], [False, True])
+    results = [
+        {**asdict(case), "name": case.name, "iterations_per_second": iterations_per_second, "final_total_loss": final_total_loss}
+        for case, iterations_per_second, final_total_loss in zip(cases, [10.0, 12.0, 15.0, 20.0], [2.0, 2.0, 2.2, 2.2])
+    ]
+
+    tradeoffs = get_tradeoffs(results)
+
+    assert [tradeoff["name"] for tradeoff in tradeoffs] == [case.name for case in cases[1:]]
+    assert all(tradeoff["reference"] == cases[0].name for tradeoff in tradeoffs)
+    assert tradeoffs[-1]["speedup"] == pytest.approx(2.0)
+    assert tradeoffs[-1]["final_loss_relative_change"] == pytest.approx(0.1)
+
+    table_lines: list[str] = format_tradeoffs(tradeoffs).splitlines()
+    assert len(table_lines) == 2 + len(tradeoffs)
+    assert table_lines[-1] == f"| {cases[-1].name} | {cases[0].name} | 2.00x | +10.00% |"
+
+
+def test_benchmark_case_with_random_weights(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, "use_pretrained_weights", False)
+    # Randomly initialized base model mustn't stay in the registry for other tests
+    monkeypatch.setattr(backbone_registry, "_base_models", {})
+    num_threads: int = torch.get_num_threads()
+    case = get_benchmark_cases(["vgg11"], [(32, 32)], [((1,), (0, 1))], [1], memory_formats=[True])[0]
+
+    result: BenchmarkResult = run_benchmark_case(case, num_iterations=3)
+
+    # Settings of the case don't leak into the process
+    assert Config.channels_last is False
+    assert torch.get_num_threads() == num_threads
+
+    assert result.num_iterations == 3
+    assert result.iterations_per_second > 0
+    assert result.time_to_first_preview_seconds is not None
+    assert result.final_total_loss is not None
+    assert result.peak_memory_bytes > 0
+
+
+def test_benchmark_case_with_real_images(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, "use_pretrained_weights", False)
+    monkeypatch.setattr(backbone_registry, "_base_models", {})
+    case = get_benchmark_cases(["vgg11"], [(32, 48)], [((1,), (0, 1))], [1])[0]
+
+    with Image.open(Config.path_to_backend / "tests/test_data/content_img.png") as content_image, \
+            Image.open(Config.path_to_backend / "tests/test_data/style_img.png") as style_image:
+        result: BenchmarkResult = run_benchmark_case(case, num_iterations=2, content_image=content_image, style_image=style_image)
+
+    assert result.num_iterations == 2
+    assert result.final_total_loss is not None
+
+
+def test_compare_results_flags_regressions() -> None:
+    baseline = [{"name": "case", "model_build_seconds": 1.0, "iterations_per_second": 10.0, "peak_memory_bytes": 100,
+                 "time_to_first_preview_seconds": None}]
+    results = [{"name": "case", "model_build_seconds": 1.05, "iterations_per_second": 8.0, "peak_memory_bytes": 200,
+                "time_to_first_preview_seconds": 0.5}]
+
+    regressions: list[str] = compare_results(results, baseline, tolerance=0.1)
+
+    assert len(regressions) == 2
+    assert regressions[0].startswith("case: iterations_per_second")
+    assert regressions[1].startswith("case: peak_memory_bytes")
+    assert compare_results(results, [], tolerance=0.1) == []
+
+
+def test_benchmark_cases_do_not_reuse_cached_gram_matrices(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, "use_pretrained_weights", False)
+    monkeypatch.setattr(backbone_registry, "_base_models", {})
+    case = get_benchmark_cases(["vgg11"], [(32, 32)], [((1,), (0, 1))], [1])[0]
+
+    run_benchmark_case(case, num_iterations=1)
+    num_hits: int = gram_matrix_cache.get_statistics()["hits"]
+    run_benchmark_case(case, num_iterations=1)
+
+    # The second run builds its model from scratch, as the first one did
+    assert gram_matrix_cache.get_statistics()["hits"] == num_hits
@@ -0,0 +1,84 @@
+import torch
+import pytest
+import typing as tp
+
+from PIL import Image
+from torch import Tensor
+
+from backend.config import Config
+from backend.transfer import NSTModel, CompiledStep, CompiledStepCache, CompiledStepKey, NSTLossGraph, backbone_registry
+
+
+@pytest.fixture(scope="module")
+def images() -> tp.Generator[tuple[Image.Image, Image.Image], None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/content_img.png") as content_image, \
+            Image.open(Config.path_to_backend / "tests/test_data/style_img.png") as style_image:
+        yield content_image, style_image
+
+
+def make_key(content_loss_layers_id: tuple[int, ...], compiler: str = "torchscript") -> CompiledStepKey:
+    return CompiledStepKey("vgg11", (64, 64), content_loss_layers_id, (0, 2), compiler)
+
+
+def test_loss_graph_matches_loss_layers(images: tuple[Image.Image, Image.Image]) -> None:
+    model = NSTModel("test_user", *images, content_loss_layers_id=[1], style_loss_layers_id=[0, 2], working_image_size=(64, 64))
+    graph = NSTLossGraph(backbone_registry.get("vgg11"), [1], [0, 2]).to(Config.device)
+    inp: Tensor = torch.randn(1, 3, 64, 64, device=Config.device)
+
+    model(inp)
+    model.collect_loss(Config.alpha)
+    losses: Tensor = graph(inp, *model.get_targets(), model._loss_weights, Config.alpha)
+
+    assert losses.shape == (1, 3)
+    assert losses.cpu() == pytest.approx(model.get_last_losses().cpu(), rel=1e-5)
+
+
+def test_compiled_step_computes_loss_and_gradient(images: tuple[Image.Image, Image.Image]) -> None:
+    model = NSTModel("test_user", *images, content_loss_layers_id=[1], style_loss_layers_id=[0, 2], working_image_size=(64, 64))
+    inp: Tensor = torch.randn(1, 3, 64, 64, device=Config.device, requires_grad=True)
+    model(inp)
+    expected_loss: Tensor = model.collect_loss(Config.alpha)
+    expected_gradient: Tensor = torch.autograd.grad(expected_loss.sum(), inp)[0]
+
+    model.enable_compiled_step("torchscript")
+    loss: Tensor = model.compute_loss(inp, Config.alpha)
+    gradient: Tensor = torch.autograd.grad(loss.sum(), inp)[0]
+
+    assert loss.detach().cpu() == pytest.approx(expected_loss.detach().cpu(), rel=1e-5)
+    assert gradient.cpu() == pytest.approx(expected_gradient.cpu(), rel=1e-4, abs=1e-8)
+    assert model.get_last_losses()[:, 2].cpu() == pytest.approx(expected_loss.detach().cpu(), rel=1e-5)
+
+
+def test_compiled_step_supports_changing_batch_size() -> None:
+    graph = NSTLossGraph(backbone_registry.get("vgg11"), [1], [0, 2]).to(Config.device)
+    step = CompiledStep(graph, "torchscript")
+    loss_weights: Tensor = torch.tensor([[1.0, 0.0], [0.0, 0.5], [0.0, 0.5]], device=Config.device)
+
+    for batch_size in (1, 2):
+        inp: Tensor = torch.randn(batch_size, 3, 64, 64, device=Config.device)
+        content_targets: list[Tensor] = [torch.randn(batch_size, 128, 32, 32, device=Config.device)]
+        style_targets: list[Tensor] = [torch.rand(batch_size, 64, 64, device=Config.device),
+                                       torch.rand(batch_size, 256, 256, device=Config.device)]
+        alpha: Tensor = torch.full((batch_size,), 10.0, device=Config.device)
+
+        losses: Tensor = step(inp, content_targets, style_targets, loss_weights, alpha)
+
+        assert losses.shape == (batch_size, 3)
+        assert losses.cpu() == pytest.approx(graph(inp, content_targets, style_targets, loss_weights, alpha).cpu(), rel=1e-5)
+
+
+def test_compiled_step_cache_reuses_steps() -> None:
+    cache = CompiledStepCache(max_size=2)
+
+    step = cache.get(make_key((1,)))
+    assert cache.get(make_key((1,))) is step
+    cache.get(make_key((2,)))
+    cache.get(make_key((1,)))
+    cache.get(make_key((3,)))
+
+    assert cache.get(make_key((2,))) is not None
+    statistics: dict[str, int] = cache.get_statistics()
+    assert statistics["hits"] == 2
+    assert statistics["misses"] == 4
+    assert statistics["evictions"] == 2
+    assert statistics["num_entries"] == 2
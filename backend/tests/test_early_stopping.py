@@ -0,0 +1,22 @@
+from backend.transfer import EarlyStopping
+
+
+def test_early_stopping_detects_plateau() -> None:
+    early_stopping = EarlyStopping(window_size=3, min_relative_improvement=0.01, min_iterations=0)
+
+    assert not early_stopping.update(10, 100.0)
+    assert not early_stopping.update(20, 50.0)
+    assert not early_stopping.update(30, 25.0)
+    assert not early_stopping.update(40, 24.9)
+    assert early_stopping.update(50, 24.8)
+
+
+def test_early_stopping_respects_min_iterations() -> None:
+    early_stopping = EarlyStopping(window_size=2, min_relative_improvement=0.01, min_iterations=100)
+
+    assert not early_stopping.update(10, 1.0)
+    assert not early_stopping.update(20, 1.0)
+    assert early_stopping.update(100, 1.0)
+
+    early_stopping.reset()
+    assert early_stopping.get_relative_improvement() is None
@@ -0,0 +1,56 @@
+import torch
+import pytest
+import typing as tp
+
+from PIL import Image
+from pathlib import Path
+
+from backend.config import Config
+from backend.training import train_fast_style_model
+from backend.transfer import TransformerNet, FastStyleCheckpoint, FastStyleRegistry, NSTModel
+
+
+@pytest.fixture(scope="module")
+def content_image() -> tp.Generator[Image.Image, None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/content_img.png") as image:
+        yield image
+
+
+@pytest.fixture(scope="module")
+def style_image() -> tp.Generator[Image.Image, None, None]:
+    with Image.open(Config.path_to_backend / "tests/test_data/style_img.png") as image:
+        yield image
+
+
+def test_transformer_net_keeps_image_size() -> None:
+    model = TransformerNet(num_channels=8, num_residual_blocks=1)
+    output: torch.Tensor = model(torch.rand(2, 3, 32, 48))
+
+    assert output.shape == (2, 3, 32, 48)
+
+
+def test_content_features_match_content_targets(content_image: Image.Image, style_image: Image.Image) -> None:
+    nst_model = NSTModel("test_user", content_image, style_image, [1, 3], [0])
+    content_targets, _ = nst_model.get_targets()
+
+    with torch.no_grad():
+        content_features: list[torch.Tensor] = nst_model.get_content_features(nst_model._transforms(content_image).unsqueeze(0))
+
+    assert len(content_features) == 2
+    assert all(torch.allclose(feature, target) for feature, target in zip(content_features, content_targets))
+
+
+def test_fast_style_checkpoint_can_be_loaded(content_image: Image.Image, style_image: Image.Image, tmp_path: Path) -> None:
+    content_image.save(tmp_path / "content.png")
+    checkpoint: FastStyleCheckpoint = train_fast_style_model(
+        "test_style", style_image, [tmp_path / "content.png"], [1], [0, 1],
+        image_size=(32, 32), batch_size=1, max_steps=2, num_channels=8, num_residual_blocks=1,
+    )
+    checkpoint.save(tmp_path / "styles/test_style.pth")
+
+    registry = FastStyleRegistry(tmp_path / "styles")
+    model: TransformerNet = registry.get("test_style")
+
+    assert registry.get_available_styles() == ["test_style"]
+    assert registry.get("test_style") is model
+    assert all(torch.equal(param.cpu(), checkpoint.state_dict[name]) for name, param in model.state_dict().items())
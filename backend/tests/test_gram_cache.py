@@ -0,0 +1,37 @@
+import torch
+
+from backend.transfer import GramMatrixCache, GramMatrixCacheKey
+
+
+def make_key(layer_idx: int) -> GramMatrixCacheKey:
+    return GramMatrixCacheKey("style_hash", "vgg11", (256, 256), layer_idx)
+
+
+def test_gram_cache_hits_and_misses() -> None:
+    cache = GramMatrixCache(max_size_bytes=2 ** 20)
+    gram_matrix: torch.Tensor = torch.randn(8, 8)
+
+    assert cache.get(make_key(0)) is None
+    cache.put(make_key(0), gram_matrix)
+    assert cache.get(make_key(0)) is gram_matrix
+
+    statistics: dict[str, int] = cache.get_statistics()
+    assert statistics["hits"] == 1
+    assert statistics["misses"] == 1
+    assert statistics["size_bytes"] == gram_matrix.element_size() * gram_matrix.nelement()
+
+
+def test_gram_cache_evicts_least_recently_used() -> None:
+    gram_matrix_size: int = 8 * 8 * 4
+    cache = GramMatrixCache(max_size_bytes=2 * gram_matrix_size)
+
+    cache.put(make_key(0), torch.randn(8, 8))
+    cache.put(make_key(1), torch.randn(8, 8))
+    cache.get(make_key(0))
+    cache.put(make_key(2), torch.randn(8, 8))
+
+    assert cache.get(make_key(1)) is None
+    assert cache.get(make_key(0)) is not None
+    assert cache.get(make_key(2)) is not None
+    assert cache.get_statistics()["evictions"] == 1
+    assert cache.get_statistics()["size_bytes"] <= 2 * gram_matrix_size
@@ -4,10 +4,11 @@ import typing as tp
 
 from PIL import Image
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 from torchvision.transforms import Compose, Normalize, ToTensor
 
 from backend.config import Config
-from backend.transfer import ContentLossLayer, StyleLossLayer
+from backend.transfer import ContentLossLayer, StyleLossLayer, JobProfiler
 
 
 @pytest.fixture(scope="module")
@@ -37,3 +38,42 @@ def test_style_and_content_loss_layers(tensor_image: torch.Tensor, layer_class:
     assert layer_output.shape == tensor_image.shape
     assert layer_output.cpu() == pytest.approx(random_input.cpu(), abs=1e-6)
     assert layer.loss.item() != pytest.approx(0.0, abs=1e-6)
+
+
+@pytest.mark.parametrize("layer_class", [ContentLossLayer, StyleLossLayer])
+def test_loss_layers_compute_per_sample_loss(layer_class: tp.Union[ContentLossLayer, StyleLossLayer]) -> None:
+    targets: Tensor = torch.randn(3, 4, 8, 8, device=Config.device)
+    inputs: Tensor = torch.randn(3, 4, 8, 8, device=Config.device)
+
+    batched_layer: torch.nn.Module = layer_class(targets)
+    batched_layer(inputs)
+
+    assert batched_layer.loss.shape == (3,)
+    for sample_idx in range(3):
+        layer: torch.nn.Module = layer_class(targets[sample_idx:sample_idx + 1])
+        layer(inputs[sample_idx:sample_idx + 1])
+        assert batched_layer.loss[sample_idx].item() == pytest.approx(layer.loss.item(), rel=1e-5)
+
+
+def test_style_loss_is_computed_in_fp32_under_autocast() -> None:
+    layer = StyleLossLayer(torch.randn(1, 4, 8, 8, device=Config.device))
+
+    with torch.autocast(Config.device.type, dtype=torch.bfloat16):
+        layer(torch.randn(1, 4, 8, 8, device=Config.device).bfloat16())
+
+    assert layer.loss.dtype == torch.float32
+
+
+def test_gram_stage_is_not_timed_during_checkpoint_recomputation() -> None:
+    profiler = JobProfiler(enabled=True, trace_num_iterations=0)
+    layer = StyleLossLayer(torch.randn(1, 4, 8, 8, device=Config.device))
+    layer.set_profiler(profiler)
+    segment = torch.nn.Sequential(torch.nn.Conv2d(4, 4, 3, padding=1), layer).to(Config.device)
+    inp: Tensor = torch.randn(1, 4, 8, 8, device=Config.device, requires_grad=True)
+
+    checkpoint(segment, inp, use_reentrant=False)
+    with profiler.stage("backward"):
+        layer.loss.sum().backward()
+
+    assert inp.grad is not None
+    assert profiler.get_summary()["gram"]["count"] == 1
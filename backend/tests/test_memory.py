@@ -0,0 +1,28 @@
+import torch
+
+from torch import Tensor
+
+from backend.transfer.memory import SavedTensorsCounter, get_tensors_bytes
+
+
+def test_saved_tensors_counter_counts_only_activations() -> None:
+    weight: Tensor = torch.randn(8, 64)
+    inp: Tensor = torch.randn(8, 64, requires_grad=True)
+
+    with SavedTensorsCounter() as saved_tensors:
+        torch.sin(inp)
+        torch.cos(inp)
+        inp * weight
+
+    # Input is saved by sin and cos, but counted once. Weight isn't a part of autograd graph
+    assert saved_tensors.num_bytes == 8 * 64 * 4
+
+    with SavedTensorsCounter(enabled=False) as saved_tensors:
+        torch.sin(inp)
+    assert saved_tensors.num_bytes == 0
+
+
+def test_tensors_bytes_counts_shared_storages_once() -> None:
+    tensor: Tensor = torch.zeros(16, 16)
+
+    assert get_tensors_bytes([tensor, tensor[:8], None]) == 16 * 16 * 4
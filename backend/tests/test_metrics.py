@@ -0,0 +1,40 @@
+import pytest
+
+from backend.metrics import MetricsRegistry, format_image_size
+
+
+def test_metrics_are_rendered_in_prometheus_format() -> None:
+    registry = MetricsRegistry()
+    counter = registry.counter("test_iterations_total", "Iterations", ["backbone", "working_size"])
+    gauge = registry.gauge("test_queued_jobs", "Queued jobs")
+    gauge.set_function(lambda: {(): 3})
+    function_counter = registry.counter("test_cache_hits_total", "Cache hits")
+    function_counter.set_function(lambda: {(): 7})
+
+    counter.inc(5, backbone="vgg11", working_size=format_image_size((256, 384)))
+    counter.inc(backbone="vgg11", working_size="256x384")
+    rendered: str = registry.render()
+
+    assert "# TYPE test_iterations_total counter" in rendered
+    assert 'test_iterations_total{backbone="vgg11",working_size="256x384"} 6.0' in rendered
+    assert "test_queued_jobs 3" in rendered
+    assert "test_cache_hits_total 7" in rendered
+    with pytest.raises(AssertionError):
+        counter.inc(backbone="vgg11")
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_latency_seconds", "Latency", ["backbone"], buckets=[1.0, 10.0])
+
+    for value in (0.5, 1.0, 5.0, 50.0):
+        histogram.observe(value, backbone="vgg16")
+    rendered: str = registry.render()
+
+    assert 'test_latency_seconds_bucket{backbone="vgg16",le="1.0"} 2' in rendered
+    assert 'test_latency_seconds_bucket{backbone="vgg16",le="10.0"} 3' in rendered
+    assert 'test_latency_seconds_bucket{backbone="vgg16",le="+Inf"} 4' in rendered
+    assert 'test_latency_seconds_sum{backbone="vgg16"} 56.5' in rendered
+    assert histogram.get_count(backbone="vgg16") == 4
+    with pytest.raises(AssertionError):
+        registry.gauge("test_latency_seconds", "Duplicate")
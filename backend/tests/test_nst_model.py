@@ -29,7 +29,7 @@ def model(content_image: Image.Image, style_image: Image.Image) -> tp.Generator[
 
 
 def test_nst_model_structure(model: torch.nn.Module) -> None:
-    assert len(list(model._model.children())) == 37
+    assert len(list(model._model.children())) == 35
 
     num_conv_layers: int = len([elem for elem in model._model.children() if isinstance(elem, Conv2d)])
     num_content_loss_layers: int = len([elem for elem in model._model.children() if isinstance(elem, ContentLossLayer)])
@@ -41,6 +41,36 @@ def test_nst_model_structure(model: torch.nn.Module) -> None:
     assert len(model._style_loss_layers) == num_style_loss_layers
 
 
+def test_nst_model_builds_only_requested_layers(content_image: Image.Image, style_image: Image.Image) -> None:
+    model = NSTModel("test_user", content_image, style_image, content_loss_layers_id=[1], style_loss_layers_id=[0, 2])
+    children: list[torch.nn.Module] = list(model._model.children())
+
+    assert len([elem for elem in children if isinstance(elem, Conv2d)]) == 3
+    assert isinstance(children[-1], StyleLossLayer)
+    assert len(model._content_loss_layers) == 1
+    assert len(model._style_loss_layers) == 2
+
+
+def test_nst_model_targets_match_fresh_forward_pass(content_image: Image.Image, style_image: Image.Image) -> None:
+    model = NSTModel("test_user", content_image, style_image, content_loss_layers_id=[0, 1, 3], style_loss_layers_id=[2],
+                     working_image_size=(64, 64))
+    content_targets, _ = model.get_targets()
+
+    expected_targets: list[Tensor] = []
+    output: Tensor = model._transforms(content_image).unsqueeze(0).to(Config.device)
+    with torch.no_grad():
+        for layer in model._model.children():
+            if isinstance(layer, ContentLossLayer):
+                expected_targets.append(output.clone())
+            elif not isinstance(layer, StyleLossLayer):
+                output = layer(output)
+
+    assert len(content_targets) == len(expected_targets) == 3
+    assert all(torch.allclose(target, expected) for target, expected in zip(content_targets, expected_targets))
+    # Targets are feature maps of convolutional layers, before ReLU
+    assert all((target < 0).any() for target in content_targets)
+
+
 def test_nst_model_collects_gradients(model: torch.nn.Module, content_image: Image.Image) -> None:
     input_img: Tensor = torch.randn(1, 3, *Config.working_image_size, requires_grad=True, device=Config.device)
 
@@ -48,12 +78,12 @@ def test_nst_model_collects_gradients(model: torch.nn.Module, content_image: Ima
 
     cumulative_style_loss: Tensor = torch.tensor(0.0, device=Config.device)
     for style_layer in model._style_loss_layers:
-        cumulative_style_loss += style_layer.loss
+        cumulative_style_loss += style_layer.loss.sum()
         assert style_layer.loss.item() != pytest.approx(0.0, abs=1e-6)
 
     cumulative_content_loss: Tensor = torch.tensor(0.0, device=Config.device)
     for content_layer in model._content_loss_layers:
-        cumulative_content_loss += content_layer.loss
+        cumulative_content_loss += content_layer.loss.sum()
         assert content_layer.loss.item() != pytest.approx(0.0, abs=1e-6)
 
     loss = cumulative_style_loss + cumulative_content_loss
@@ -61,3 +91,64 @@ def test_nst_model_collects_gradients(model: torch.nn.Module, content_image: Ima
 
     assert input_img.grad is not None
     assert input_img.grad.data.cpu() != pytest.approx(torch.zeros_like(input_img.grad.data.cpu()), abs=1e-6)
+
+
+def test_nst_model_splits_into_segments_within_budget() -> None:
+    activation_sizes: list[int] = [4, 4, 2, 2, 1, 1]
+
+    assert NSTModel._split_into_segments(activation_sizes, 14) == []
+
+    segment_bounds: list[tuple[int, int]] = NSTModel._split_into_segments(activation_sizes, 13)
+    stored_size: int = sum(activation_sizes[end - 1] for _, end in segment_bounds[:-1])
+    max_segment_size: int = max(sum(activation_sizes[start:end]) for start, end in segment_bounds)
+    assert len(segment_bounds) > 1
+    assert stored_size + max_segment_size <= 13
+
+
+def test_checkpointed_nst_model_computes_same_gradients(content_image: Image.Image, style_image: Image.Image) -> None:
+    model = NSTModel("test_user", content_image, style_image, content_loss_layers_id=[2], style_loss_layers_id=[0, 1, 2])
+    input_img: Tensor = torch.randn(1, 3, *Config.working_image_size, device=Config.device)
+
+    expected_input: Tensor = input_img.clone().requires_grad_(True)
+    model(expected_input)
+    model.collect_loss().sum().backward()
+
+    assert model.enable_checkpointing(memory_budget_bytes=1) > 1
+    checkpointed_input: Tensor = input_img.clone().requires_grad_(True)
+    model(checkpointed_input)
+    model.collect_loss().sum().backward()
+
+    assert checkpointed_input.grad.cpu() == pytest.approx(expected_input.grad.cpu(), abs=1e-5)
+
+
+def test_nst_model_weights_loss_layers(content_image: Image.Image, style_image: Image.Image) -> None:
+    model = NSTModel("test_user", content_image, style_image, content_loss_layers_id=[3, 1], style_loss_layers_id=[0, 1, 2],
+                     content_layer_weights=[1.0, 3.0], style_layer_weights=[2.0, 0.0, 2.0], working_image_size=(64, 64))
+    content_layer_weights, style_layer_weights = model.get_layer_weights()
+
+    assert content_layer_weights == {1: 0.75, 3: 0.25}
+    assert style_layer_weights == {0: 0.5, 2: 0.5}
+    assert len(model._style_loss_layers) == 2
+
+    model(torch.randn(2, 3, 64, 64, device=Config.device))
+    loss: Tensor = model.collect_loss(Config.alpha)
+    content_loss: Tensor = 0.75 * model._content_loss_layers[0].loss + 0.25 * model._content_loss_layers[1].loss
+    style_loss: Tensor = 0.5 * model._style_loss_layers[0].loss + 0.5 * model._style_loss_layers[1].loss
+
+    assert loss.shape == (2,)
+    assert loss.cpu() == pytest.approx((content_loss + Config.alpha * style_loss).cpu(), rel=1e-5)
+
+
+def test_bf16_targets_match_bf16_forward_pass(content_image: Image.Image) -> None:
+    model = NSTModel("test_user", content_image, content_image, content_loss_layers_id=[1, 3], style_loss_layers_id=[0, 2],
+                     working_image_size=(64, 64), precision="bf16")
+    content_targets, style_targets = model.get_targets()
+
+    with torch.no_grad(), torch.autocast(Config.device.type, dtype=torch.bfloat16):
+        model(model._transforms(content_image).unsqueeze(0).to(Config.device))
+    loss: Tensor = model.collect_loss(alpha=torch.tensor(0.0, device=Config.device))
+
+    assert all(target.dtype == torch.float32 for target in content_targets + style_targets)
+    assert loss.item() == pytest.approx(0.0, abs=1e-12)
+    # Style image is the same, so style loss is 0 as well
+    assert model.get_last_losses()[0, 1].item() == pytest.approx(0.0, abs=1e-12)
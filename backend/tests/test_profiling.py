@@ -0,0 +1,40 @@
+import torch
+
+from pathlib import Path
+
+from backend.transfer import JobProfiler
+
+
+def test_disabled_profiler_measures_nothing() -> None:
+    profiler = JobProfiler()
+
+    with profiler.stage("forward"), profiler.timer("decode"):
+        torch.ones(4, 4).sum()
+    profiler.step(10)
+
+    assert profiler.get_summary() == {}
+
+
+def test_profiler_times_stages() -> None:
+    profiler = JobProfiler(enabled=True, trace_num_iterations=0)
+
+    for _ in range(3):
+        with profiler.stage("forward"):
+            torch.ones(16, 16) @ torch.ones(16, 16)
+    profiler.record("decode", 0.5)
+    summary: dict[str, dict[str, float]] = profiler.get_summary()
+
+    assert list(summary) == ["forward", "decode"]
+    assert summary["forward"]["count"] == 3
+    assert summary["decode"] == {"total_seconds": 0.5, "count": 1, "mean_seconds": 0.5}
+
+
+def test_profiler_exports_trace_of_iteration_window(tmp_path: Path) -> None:
+    profiler = JobProfiler(enabled=True, name="test_job", trace_start_iteration=1, trace_num_iterations=2, path_to_traces=tmp_path)
+
+    for iteration in range(1, 5):
+        with profiler.stage("forward"):
+            torch.ones(8, 8).sum()
+        profiler.step(iteration)
+
+    assert (tmp_path / "test_job.json").exists()
@@ -0,0 +1,31 @@
+import torch
+
+from backend.config import Config
+from backend.transfer import SnapshotBuffer
+from backend.transfer.snapshots import get_preview_size, render_image
+
+
+def test_snapshot_buffer_is_double_buffered() -> None:
+    snapshot_buffer = SnapshotBuffer()
+    tensor: torch.Tensor = torch.zeros(1, 3, 8, 8)
+
+    first_idx = snapshot_buffer.take(tensor)
+    tensor += 1
+    second_idx = snapshot_buffer.take(tensor)
+
+    assert {first_idx, second_idx} == {0, 1}
+    assert snapshot_buffer.take(tensor) is None
+    assert torch.equal(snapshot_buffer.get(first_idx), torch.zeros(1, 3, 8, 8))
+    assert torch.equal(snapshot_buffer.get(second_idx), torch.ones(1, 3, 8, 8))
+
+    snapshot_buffer.release(first_idx)
+    assert snapshot_buffer.take(torch.zeros(1, 3, 16, 16)) == first_idx
+    assert snapshot_buffer.get(first_idx).shape == (1, 3, 16, 16)
+
+
+def test_render_image_at_preview_size() -> None:
+    tensor: torch.Tensor = torch.zeros(1, 3, 64, 64, device=Config.device)
+
+    assert get_preview_size((1000, 500), 100) == (100, 50)
+    assert get_preview_size((80, 60), 100) == (80, 60)
+    assert render_image(tensor, (100, 50)).size == (50, 100)
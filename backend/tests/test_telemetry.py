@@ -0,0 +1,30 @@
+import torch
+
+from backend.transfer import LossRecord, LossRingBuffer
+
+
+def test_loss_ring_buffer_reads_back_in_batches() -> None:
+    loss_history = LossRingBuffer(flush_interval=3, max_history_size=4)
+
+    assert loss_history.append(1, torch.tensor([1.0, 2.0, 3.0])) == []
+    assert loss_history.append(2, torch.tensor([2.0, 3.0, 4.0])) == []
+    assert loss_history.get_history() == []
+
+    records: list[LossRecord] = loss_history.append(3, torch.tensor([3.0, 4.0, 5.0]))
+    assert [record.iteration for record in records] == [1, 2, 3]
+    assert records[-1] == LossRecord(3, 3.0, 4.0, 5.0)
+    assert loss_history.get_history(since_iteration=2) == [records[-1]]
+
+
+def test_loss_ring_buffer_keeps_latest_records() -> None:
+    loss_history = LossRingBuffer(flush_interval=10, max_history_size=2)
+
+    assert len(loss_history.append(20, torch.tensor([1.0, 1.0, 2.0]))) == 1
+    loss_history.append(21, torch.tensor([1.0, 1.0, 2.0]))
+    loss_history.append(22, torch.tensor([1.0, 1.0, 2.0]))
+    assert len(loss_history.flush()) == 2
+    assert [record.iteration for record in loss_history.get_history()] == [21, 22]
+
+    loss_history.clear()
+    assert loss_history.get_history() == []
+    assert loss_history.flush() == []
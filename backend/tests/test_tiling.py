@@ -0,0 +1,53 @@
+import asyncio
+
+from PIL import Image
+
+from backend.config import Config
+from backend.transfer import TiledStyleTransferProcessor, TransferState, split_into_tiles, blend_tiles
+
+
+def test_split_into_tiles_covers_image() -> None:
+    boxes = split_into_tiles((300, 200), (128, 128), 32)
+
+    assert all(right - left == 128 and bottom - top == 128 for left, top, right, bottom in boxes)
+    assert {left for left, _, _, _ in boxes} == {0, 96, 172}
+    assert {top for _, top, _, _ in boxes} == {0, 72}
+    assert split_into_tiles((100, 50), (128, 128), 32) == [(0, 0, 100, 50)]
+
+
+def test_blend_tiles_keeps_uniform_color() -> None:
+    boxes = split_into_tiles((300, 200), (128, 128), 32)
+    tiles = [(box, Image.new("RGB", (128, 128), (200, 100, 50))) for box in boxes]
+
+    result = blend_tiles(tiles, (300, 200), 32)
+
+    assert result.size == (300, 200)
+    assert set(result.getdata()) <= {(200, 100, 50), (199, 99, 49), (200, 100, 49), (199, 100, 50)}
+
+
+def test_tiled_preview_is_rendered_at_preview_size() -> None:
+    processor = TiledStyleTransferProcessor()
+    processor._content_image = Image.new("RGB", (400, 200), (0, 0, 255))
+    processor._preview_max_size = 100
+    processor._tile_boxes = [(0, 0, 200, 200), (200, 0, 400, 200)]
+    processor._tile_results = {1: Image.new("RGB", (200, 200), (255, 0, 0))}
+
+    preview = processor._render_preview()
+
+    assert preview.size == (100, 50)
+    assert preview.getpixel((75, 25)) == (255, 0, 0)
+    assert preview.getpixel((25, 25)) == (0, 0, 255)
+
+
+def test_tiled_transfer_states_drop_oldest_when_backed_up() -> None:
+    processor = TiledStyleTransferProcessor()
+    processor._transfer_states = asyncio.Queue()
+    states = [TransferState(Image.new("RGB", (1, 1)), status, status) for status in range(3)]
+
+    for state in states:
+        processor._put_transfer_state(state)
+    processor._put_transfer_state(None)
+
+    pending_states = [processor._transfer_states.get_nowait() for _ in range(processor._transfer_states.qsize())]
+    assert len(pending_states) == min(len(states) + 1, Config.max_pending_transfer_states)
+    assert pending_states[-1] is None
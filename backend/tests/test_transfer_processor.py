@@ -1,11 +1,13 @@
 import pytest
+import asyncio
+import itertools
 import typing as tp
 
 from PIL import Image
 from torch import Tensor
 
 from backend.config import Config
-from backend.transfer import StyleTransferProcessor
+from backend.transfer import StyleTransferProcessor, TransferState
 
 
 @pytest.fixture(scope="module")
@@ -26,3 +28,105 @@ async def test_style_transfer_processor(content_image: Image.Image, style_image:
     st_processor.configure("test_user", content_image, style_image, 50, [3], [0, 1, 2, 3], pretrained_model_type="vgg16")
     result: Image.Image = await st_processor.transfer_style()
     result.save(Config.path_to_backend / "tests/test_data/result.png", "PNG")
+
+
+@pytest.mark.asyncio
+async def test_style_transfer_processor_streams_states(content_image: Image.Image, style_image: Image.Image,
+                                                       monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, "transfer_state_interval", 0.0)
+    st_processor = StyleTransferProcessor()
+    st_processor.configure("test_user", content_image, style_image, 5, [1], [0, 1], alpha=1.0)
+
+    style_transfer_task: asyncio.Task = asyncio.create_task(st_processor.transfer_style())
+    states: list[TransferState] = [state async for state in st_processor.get_transfer_states()]
+    result: Image.Image = await style_transfer_task
+
+    assert len(states) > 0
+    assert all(0 < state.completeness <= 100 for state in states)
+    assert result.size == content_image.size
+    assert [record.iteration for record in st_processor.get_loss_history()] == [1, 2, 3, 4, 5]
+    assert st_processor.get_peak_memory_usage() > 0
+
+
+@pytest.mark.asyncio
+async def test_compatible_jobs_are_transferred_in_one_batch(content_image: Image.Image, style_image: Image.Image,
+                                                            monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, "batched_transfer", True)
+    first_processor = StyleTransferProcessor().configure("first_user", content_image, style_image, 5, [1], [0, 1], alpha=1.0)
+    second_processor = StyleTransferProcessor().configure("second_user", style_image, content_image, 7, [1], [0, 1], alpha=2.0)
+    assert first_processor.get_batch_key() == second_processor.get_batch_key()
+
+    results: list[Image.Image] = await asyncio.gather(first_processor.transfer_style(), second_processor.transfer_style())
+
+    assert results[0].size == content_image.size
+    assert results[1].size == style_image.size
+    # Models of the jobs keep their own targets, so every job accounts only its own targets in peak memory
+    assert all(target.shape[0] == 1 for target in itertools.chain(*first_processor.get_nst_model().get_targets()))
+    assert first_processor.get_peak_memory_usage() == pytest.approx(second_processor.get_peak_memory_usage(), rel=0.1)
+
+
+@pytest.mark.asyncio
+async def test_every_running_job_gets_transfer_worker(content_image: Image.Image, style_image: Image.Image,
+                                                      monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, "batched_transfer", True)
+    # Jobs of different working sizes can't be batched, so every job holds its own worker
+    processors: list[StyleTransferProcessor] = [
+        StyleTransferProcessor().configure(f"user_{idx}", content_image, style_image, 10 ** 6, [1], [0, 1], alpha=1.0,
+                                           early_stopping=False, working_image_size=(32 + 8 * idx, 32 + 8 * idx))
+        for idx in range(Config.max_running_jobs)
+    ]
+    transfer_tasks: list[asyncio.Task] = [asyncio.create_task(processor.transfer_style()) for processor in processors]
+    try:
+        async with asyncio.timeout(60):
+            while not all(processor.is_transferring() for processor in processors):
+                await asyncio.sleep(0.05)
+    finally:
+        for transfer_task in transfer_tasks:
+            transfer_task.cancel()
+        await asyncio.gather(*transfer_tasks, return_exceptions=True)
+        # Workers finish stopped transfers after cancellation
+        while any(processor.is_transferring() for processor in processors):
+            await asyncio.sleep(0.05)
+
+
+def test_pyramid_levels_split_iteration_budget() -> None:
+    pyramid_levels: list[tuple[tuple[int, int], int]] = StyleTransferProcessor()._get_pyramid_levels(100)
+
+    assert [last_iteration for _, last_iteration in pyramid_levels] == [50, 80, 100]
+    assert pyramid_levels[0][0] == (Config.working_image_size[0] // 4, Config.working_image_size[1] // 4)
+    assert pyramid_levels[-1][0] == Config.working_image_size
+
+
+@pytest.mark.asyncio
+async def test_pyramid_style_transfer(content_image: Image.Image, style_image: Image.Image) -> None:
+    st_processor = StyleTransferProcessor()
+    st_processor.configure("test_user", content_image, style_image, 10, [1], [0, 1], alpha=1.0, use_pyramid=True)
+    result: Image.Image = await st_processor.transfer_style()
+
+    assert st_processor._working_image_size == Config.working_image_size
+    assert result.size == content_image.size
+
+
+def test_lbfgs_iteration_counts_function_evaluations(content_image: Image.Image, style_image: Image.Image) -> None:
+    st_processor = StyleTransferProcessor()
+    st_processor.configure("test_user", content_image, style_image, 7, [1], [0, 1], alpha=1.0, optimizer_type="lbfgs")
+    st_processor.begin_transfer()
+
+    num_evaluations: int = st_processor._process_transfer_iteration()
+
+    assert 1 <= num_evaluations <= 7
+    assert not st_processor._is_batchable()
+
+
+@pytest.mark.asyncio
+async def test_previews_are_downscaled(content_image: Image.Image, style_image: Image.Image) -> None:
+    st_processor = StyleTransferProcessor()
+    st_processor.configure("test_user", content_image, style_image, 5, [1], [0, 1], alpha=1.0, state_interval=0.0, preview_max_size=32)
+
+    style_transfer_task: asyncio.Task = asyncio.create_task(st_processor.transfer_style())
+    states: list[TransferState] = [state async for state in st_processor.get_transfer_states()]
+    result: Image.Image = await style_transfer_task
+
+    assert len(states) > 0
+    assert all(max(state.image.size) <= 32 for state in states)
+    assert result.size == content_image.size
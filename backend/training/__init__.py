@@ -0,0 +1,4 @@
+from .train_fast_style import train_fast_style_model, find_images
+from .train_adain import train_adain_model
+
+__all__ = ["train_fast_style_model", "train_adain_model", "find_images"]
@@ -0,0 +1,128 @@
+import time
+import torch
+import argparse
+import typing as tp
+
+from PIL import Image
+from torch import Tensor
+from pathlib import Path
+from torch.optim import Adam
+from torch.nn.functional import mse_loss
+from torchvision.transforms import Compose, Normalize, ToTensor, Resize, RandomCrop
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.transfer.adain import AdaINModel, AdaINCheckpoint, adaptive_instance_normalization, get_mean_std
+from backend.training.train_fast_style import find_images
+
+
+logger = get_logger(__name__)
+
+
+def train_adain_model(content_images_paths: list[Path],
+                      style_images_paths: list[Path],
+                      pretrained_model_type: str = "vgg11",
+                      encoder_layers_id: tp.Optional[list[int]] = None,
+                      style_weight: float = 10.0,
+                      image_size: int = Config.working_image_size[0],
+                      num_steps: int = 1000,
+                      batch_size: int = 4,
+                      learning_rate: float = 1e-4,
+                      seed: int = 0) -> AdaINCheckpoint:
+    """
+    Trains AdaIN decoder. Decoded image has to have AdaIN features as its encoder output (content loss) and channel-wise
+    statistics of style image at every encoder layer (style loss)
+    :param content_images_paths: paths to training content images
+    :param style_images_paths: paths to training style images
+    :param pretrained_model_type: type of pretrained base model used as encoder
+    :param encoder_layers_id: indexes of convolutional layers used by encoder. Config.adain_encoder_layers_id if not set
+    :param style_weight: style loss coefficient in total loss
+    :param image_size: training images are resized and randomly cropped to this size
+    :param num_steps: number of optimization steps. Content and style images are sampled randomly at every step
+    :param batch_size: number of content-style pairs in one batch
+    :param learning_rate: learning rate of Adam optimizer
+    :param seed: seed of weights initialization and sampling of training images
+    :return: checkpoint of trained decoder
+    """
+    assert len(content_images_paths) > 0 and len(style_images_paths) > 0, "At least one content and one style image are required!"
+
+    generator: torch.Generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    model: AdaINModel = AdaINModel(pretrained_model_type, encoder_layers_id).to(Config.device)
+    assert image_size % model.encoder.get_size_multiple() == 0, \
+        f"Image size has to be divisible by {model.encoder.get_size_multiple()}, but {image_size} met!"
+    model.decoder.train()
+    optimizer = Adam(model.decoder.parameters(), lr=learning_rate)
+    transforms = Compose([
+        Resize(image_size),
+        RandomCrop(image_size),
+        ToTensor(),
+        Normalize(mean=Config.normalization_mean.cpu(), std=Config.normalization_std.cpu()),
+    ])
+
+    start_time: float = time.perf_counter()
+    for step in range(num_steps):
+        content_batch: Tensor = _sample_batch(content_images_paths, batch_size, transforms, generator)
+        style_batch: Tensor = _sample_batch(style_images_paths, batch_size, transforms, generator)
+
+        with torch.no_grad():
+            style_features: list[Tensor] = model.encoder(style_batch)
+            target: Tensor = adaptive_instance_normalization(model.encoder(content_batch)[-1], style_features[-1])
+
+        optimizer.zero_grad()
+        output_features: list[Tensor] = model.encoder(model.decoder(target))
+        content_loss: Tensor = mse_loss(output_features[-1], target)
+        style_loss: Tensor = sum(
+            mse_loss(output_mean, style_mean) + mse_loss(output_std, style_std)
+            for (output_mean, output_std), (style_mean, style_std) in zip(map(get_mean_std, output_features), map(get_mean_std, style_features))
+        )
+        loss: Tensor = content_loss + style_weight * style_loss
+        loss.backward()
+        optimizer.step()
+        logger.info(f"Step {step + 1}: content loss {content_loss.item():.3f}, style loss {style_loss.item():.3f}, "
+                    f"{time.perf_counter() - start_time:.1f}s elapsed.")
+
+    return AdaINCheckpoint(
+        pretrained_model_type,
+        model.encoder.get_layers_id(),
+        {name: tensor.detach().cpu() for name, tensor in model.decoder.state_dict().items()},
+    )
+
+
+def _sample_batch(images_paths: list[Path], batch_size: int, transforms: Compose, generator: torch.Generator) -> Tensor:
+    images: list[Tensor] = []
+    for idx in torch.randint(len(images_paths), (batch_size,), generator=generator).tolist():
+        with Image.open(images_paths[idx]) as image:
+            images.append(transforms(image.convert("RGB")))
+    return torch.stack(images).to(Config.device)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train AdaIN decoder for arbitrary style transfer. Runs on CPU if GPU isn't available.")
+    parser.add_argument("--content-dir", required=True, type=Path, help="directory with training content images")
+    parser.add_argument("--style-dir", required=True, type=Path, help="directory with training style images")
+    parser.add_argument("--output", type=Path, default=Config.path_to_adain_model, help="path to checkpoint")
+    parser.add_argument("--pretrained-model", default="vgg11", help="type of pretrained base model")
+    parser.add_argument("--style-weight", type=float, default=10.0, help="style loss coefficient")
+    parser.add_argument("--image-size", type=int, default=Config.working_image_size[0], help="size of training images")
+    parser.add_argument("--steps", type=int, default=1000, help="number of optimization steps")
+    parser.add_argument("--batch-size", type=int, default=4, help="batch size")
+    parser.add_argument("--lr", type=float, default=1e-4, help="learning rate")
+    args = parser.parse_args()
+
+    checkpoint: AdaINCheckpoint = train_adain_model(
+        find_images(args.content_dir),
+        find_images(args.style_dir),
+        pretrained_model_type=args.pretrained_model,
+        style_weight=args.style_weight,
+        image_size=args.image_size,
+        num_steps=args.steps,
+        batch_size=args.batch_size,
+        learning_rate=args.lr,
+    )
+    checkpoint.save(args.output)
+    logger.info(f"Saved AdaIN model to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
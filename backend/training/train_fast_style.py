@@ -0,0 +1,168 @@
+import time
+import torch
+import argparse
+import typing as tp
+
+from PIL import Image
+from torch import Tensor
+from pathlib import Path
+from torch.optim import Adam
+from torchvision.transforms import Compose, Normalize, ToTensor, Resize, CenterCrop
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.transfer.nst_model import NSTModel
+from backend.transfer.fast_style import TransformerNet, FastStyleCheckpoint
+
+
+logger = get_logger(__name__)
+
+IMAGE_EXTENSIONS: tuple[str, ...] = (".jpg", ".jpeg", ".png")
+
+
+def train_fast_style_model(style_name: str,
+                           style_image: Image.Image,
+                           content_images_paths: list[Path],
+                           content_loss_layers_id: tp.Optional[list[int]] = None,
+                           style_loss_layers_id: tp.Optional[list[int]] = None,
+                           alpha: float = 100000.0,
+                           pretrained_model_type: str = "vgg11",
+                           image_size: tuple[int, int] = Config.working_image_size,
+                           num_epochs: int = 2,
+                           batch_size: int = 4,
+                           learning_rate: float = 1e-3,
+                           max_steps: tp.Optional[int] = None,
+                           num_channels: int = 32,
+                           num_residual_blocks: int = 5,
+                           seed: int = 0) -> FastStyleCheckpoint:
+    """
+    Trains TransformerNet for one style. Training objective is the same content and style loss of NSTModel, which
+    StyleTransferProcessor minimizes for a single image
+    :param style_name: name of the style
+    :param style_image: style image
+    :param content_images_paths: paths to training content images
+    :param content_loss_layers_id: indexes of convolutional layers after which content loss is computed
+    :param style_loss_layers_id: indexes of convolutional layers after which style loss is computed
+    :param alpha: style loss coefficient in total loss
+    :param pretrained_model_type: type of pretrained base model of NSTModel
+    :param image_size: training images are resized and cropped to this size. Has to be divisible by 4
+    :param num_epochs: number of passes over content images
+    :param batch_size: number of content images in one batch
+    :param learning_rate: learning rate of Adam optimizer
+    :param max_steps: if set, training stops after this number of optimization steps
+    :param num_channels: number of channels of the first convolutional layer of TransformerNet
+    :param num_residual_blocks: number of residual blocks of TransformerNet
+    :param seed: seed of weights initialization and shuffling of content images
+    :return: checkpoint of trained model
+    """
+    assert len(content_images_paths) > 0, "At least one content image is required for training!"
+    assert image_size[0] % 4 == 0 and image_size[1] % 4 == 0, f"Image size has to be divisible by 4, but {image_size} met!"
+
+    generator: torch.Generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    transforms = Compose([
+        Resize(min(image_size)),
+        CenterCrop(image_size),
+        ToTensor(),
+        Normalize(mean=Config.normalization_mean.cpu(), std=Config.normalization_std.cpu()),
+    ])
+
+    with Image.open(content_images_paths[0]) as first_content_image:
+        nst_model = NSTModel(
+            style_name,
+            first_content_image.convert("RGB"),
+            style_image.convert("RGB"),
+            content_loss_layers_id=content_loss_layers_id,
+            style_loss_layers_id=style_loss_layers_id,
+            pretrained_model_type=pretrained_model_type,
+            working_image_size=image_size,
+        )
+    _, style_targets = nst_model.get_targets()
+
+    model: TransformerNet = TransformerNet(num_channels, num_residual_blocks).to(Config.device).train()
+    optimizer = Adam(model.parameters(), lr=learning_rate)
+    alpha_tensor: Tensor = torch.tensor(alpha, device=Config.device, dtype=torch.float32)
+
+    step: int = 0
+    start_time: float = time.perf_counter()
+    for epoch in range(num_epochs):
+        permutation: list[int] = torch.randperm(len(content_images_paths), generator=generator).tolist()
+        for batch_start in range(0, len(permutation), batch_size):
+            if max_steps is not None and step >= max_steps:
+                break
+            batch_paths: list[Path] = [content_images_paths[idx] for idx in permutation[batch_start:batch_start + batch_size]]
+            content_batch: Tensor = torch.stack([_load_image(path, transforms) for path in batch_paths]).to(Config.device)
+
+            with torch.no_grad():
+                content_targets: list[Tensor] = nst_model.get_content_features(content_batch)
+            nst_model.set_targets(content_targets, [target.expand(len(batch_paths), -1, -1) for target in style_targets])
+
+            optimizer.zero_grad()
+            nst_model(model(content_batch))
+            loss: Tensor = nst_model.collect_loss(alpha_tensor).mean()
+            loss.backward()
+            optimizer.step()
+            step += 1
+            logger.info(f"Epoch {epoch}, step {step}: loss {loss.item():.3f}, {time.perf_counter() - start_time:.1f}s elapsed.")
+
+    return FastStyleCheckpoint(
+        style_name,
+        pretrained_model_type,
+        num_channels,
+        num_residual_blocks,
+        {name: tensor.detach().cpu() for name, tensor in model.state_dict().items()},
+    )
+
+
+def _load_image(path: Path, transforms: Compose) -> Tensor:
+    with Image.open(path) as image:
+        return transforms(image.convert("RGB"))
+
+
+def find_images(directory: Path) -> list[Path]:
+    """
+    :param directory: directory with images
+    :return: sorted paths to all images in the directory and its subdirectories
+    """
+    return sorted(path for path in directory.rglob("*") if path.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train fast style model for one style. Runs on CPU if GPU isn't available.")
+    parser.add_argument("--style-name", required=True, help="name of the style, used as name of checkpoint")
+    parser.add_argument("--style-image", required=True, type=Path, help="path to style image")
+    parser.add_argument("--content-dir", required=True, type=Path, help="directory with training content images")
+    parser.add_argument("--output-dir", type=Path, default=Config.path_to_fast_style_models, help="directory for checkpoint")
+    parser.add_argument("--content-layers", type=int, nargs="+", default=[3], help="indexes of content loss layers")
+    parser.add_argument("--style-layers", type=int, nargs="+", default=[0, 1, 2, 3, 4], help="indexes of style loss layers")
+    parser.add_argument("--alpha", type=float, default=100000.0, help="style loss coefficient")
+    parser.add_argument("--pretrained-model", default="vgg11", help="type of pretrained base model")
+    parser.add_argument("--image-size", type=int, default=Config.working_image_size[0], help="size of training images")
+    parser.add_argument("--epochs", type=int, default=2, help="number of epochs")
+    parser.add_argument("--batch-size", type=int, default=4, help="batch size")
+    parser.add_argument("--lr", type=float, default=1e-3, help="learning rate")
+    parser.add_argument("--max-steps", type=int, default=None, help="maximum number of optimization steps")
+    args = parser.parse_args()
+
+    content_images_paths: list[Path] = find_images(args.content_dir)
+    with Image.open(args.style_image) as style_image:
+        checkpoint: FastStyleCheckpoint = train_fast_style_model(
+            args.style_name,
+            style_image,
+            content_images_paths,
+            content_loss_layers_id=args.content_layers,
+            style_loss_layers_id=args.style_layers,
+            alpha=args.alpha,
+            pretrained_model_type=args.pretrained_model,
+            image_size=(args.image_size, args.image_size),
+            num_epochs=args.epochs,
+            batch_size=args.batch_size,
+            learning_rate=args.lr,
+            max_steps=args.max_steps,
+        )
+    checkpoint.save(args.output_dir / f"{args.style_name}.pth")
+    logger.info(f"Saved {args.style_name} fast style model to {args.output_dir}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,29 @@
+from .backbones import BackboneRegistry, backbone_registry
+from .gram_cache import GramMatrixCache, GramMatrixCacheKey, gram_matrix_cache
+from .compiled_step import CompiledStep, CompiledStepCache, CompiledStepKey, NSTLossGraph, compiled_step_cache
 from .nst_model import NSTModel
-from .transfer import StyleTransferProcessor
+from .early_stopping import EarlyStopping
+from .batching import BatchKey, BatchedTransferEngine
+from .telemetry import LossRecord, LossRingBuffer
+from .profiling import JobProfiler
+from .snapshots import SnapshotBuffer, preview_executor
+from .transfer import StyleTransferProcessor, TransferState, TransferStepInputs, transfer_executor, batched_transfer_engine
+from .tiling import TiledStyleTransferProcessor, split_into_tiles, blend_tiles
+from .fast_style import TransformerNet, FastStyleCheckpoint, FastStyleRegistry, fast_style_registry
+from .fast_style import SinglePassStyleTransferProcessor, FastStyleTransferProcessor
+from .adain import AdaINModel, AdaINCheckpoint, AdaINModelRegistry, AdaINStyleTransferProcessor, adain_model_registry
 from .layers import ContentLossLayer, StyleLossLayer
 
-__all__ = ["NSTModel", "ContentLossLayer", "StyleLossLayer", "StyleTransferProcessor"]
+__all__ = [
+    "BackboneRegistry", "backbone_registry",
+    "GramMatrixCache", "GramMatrixCacheKey", "gram_matrix_cache",
+    "NSTModel", "ContentLossLayer", "StyleLossLayer",
+    "CompiledStep", "CompiledStepCache", "CompiledStepKey", "NSTLossGraph", "compiled_step_cache",
+    "BatchKey", "BatchedTransferEngine", "EarlyStopping",
+    "StyleTransferProcessor", "TransferState", "TransferStepInputs", "transfer_executor", "batched_transfer_engine",
+    "SnapshotBuffer", "preview_executor", "LossRecord", "LossRingBuffer", "JobProfiler",
+    "TiledStyleTransferProcessor", "split_into_tiles", "blend_tiles",
+    "TransformerNet", "FastStyleCheckpoint", "FastStyleRegistry", "SinglePassStyleTransferProcessor",
+    "FastStyleTransferProcessor", "fast_style_registry",
+    "AdaINModel", "AdaINCheckpoint", "AdaINModelRegistry", "AdaINStyleTransferProcessor", "adain_model_registry",
+]
@@ -0,0 +1,260 @@
+import time
+import torch
+import asyncio
+import threading
+import typing as tp
+import torch.nn as nn
+
+from torch import Tensor
+from pathlib import Path
+from PIL.Image import Image
+from dataclasses import dataclass
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.metrics import format_image_size
+from backend.transfer.profiling import JobProfiler
+from backend.transfer.backbones import backbone_registry
+from backend.transfer.fast_style import SinglePassStyleTransferProcessor
+
+
+logger = get_logger(__name__)
+
+
+def get_mean_std(features: Tensor, eps: float = 1e-5) -> tuple[Tensor, Tensor]:
+    """
+    :param features: [batch_size, C, H, W] feature maps
+    :param eps: added to variance to avoid division by zero
+    :return: [batch_size, C, 1, 1] channel-wise means and standard deviations
+    """
+    bs, c = features.shape[:2]
+    flat_features: Tensor = features.view(bs, c, -1)
+    return flat_features.mean(dim=2).view(bs, c, 1, 1), (flat_features.var(dim=2) + eps).sqrt().view(bs, c, 1, 1)
+
+
+def adaptive_instance_normalization(content_features: Tensor, style_features: Tensor) -> Tensor:
+    """
+    Aligns channel-wise mean and standard deviation of content features with ones of style features
+    :param content_features: [batch_size, C, H, W] feature maps of content images
+    :param style_features: [batch_size, C, H', W'] feature maps of style images
+    :return: [batch_size, C, H, W] normalized content features
+    """
+    content_mean, content_std = get_mean_std(content_features)
+    style_mean, style_std = get_mean_std(style_features)
+    return (content_features - content_mean) / content_std * style_std + style_mean
+
+
+class AdaINEncoder(nn.Module):
+    """
+    Frozen pretrained base model truncated after ReLU of the deepest selected convolutional layer. Weights are shared
+    with NSTModel instances through the backbone registry
+    """
+    def __init__(self, pretrained_model_type: str = "vgg11", layers_id: tp.Optional[list[int]] = None) -> None:
+        """
+        :param pretrained_model_type: type of shared pretrained base model
+        :param layers_id: indexes of convolutional layers, after ReLU of which features are returned
+        """
+        super().__init__()
+        self._pretrained_model_type: str = pretrained_model_type
+        self._layers_id: list[int] = sorted(set(layers_id if layers_id is not None else Config.adain_encoder_layers_id))
+        self._slices = nn.ModuleList()
+
+        current_slice = nn.Sequential()
+        conv_layer_idx: int = -1
+        for layer in backbone_registry.get(pretrained_model_type).children():
+            if isinstance(layer, nn.Conv2d):
+                conv_layer_idx += 1
+            current_slice.append(nn.ReLU() if isinstance(layer, nn.ReLU) else layer)
+            if isinstance(layer, nn.ReLU) and conv_layer_idx in self._layers_id:
+                self._slices.append(current_slice)
+                current_slice = nn.Sequential()
+                if conv_layer_idx == self._layers_id[-1]:
+                    break
+        assert len(self._slices) == len(self._layers_id), f"Base model {pretrained_model_type} has no layers {self._layers_id}!"
+
+    def forward(self, inp: Tensor) -> list[Tensor]:
+        """
+        :param inp: [batch_size, 3, H, W] normalized images
+        :return: feature maps in order of depth of selected layers
+        """
+        features: list[Tensor] = []
+        for encoder_slice in self._slices:
+            inp = encoder_slice(inp)
+            features.append(inp)
+        return features
+
+    def get_pretrained_model_type(self) -> str:
+        return self._pretrained_model_type
+
+    def get_layers_id(self) -> list[int]:
+        return self._layers_id
+
+    def get_layers(self) -> list[nn.Module]:
+        return [layer for encoder_slice in self._slices for layer in encoder_slice]
+
+    def get_size_multiple(self) -> int:
+        """
+        :return: number, by which sides of input image have to be divisible, so decoder restores its size
+        """
+        return 2 ** len([layer for layer in self.get_layers() if isinstance(layer, nn.MaxPool2d)])
+
+
+class AdaINDecoder(nn.Module):
+    """
+    Trainable decoder, which mirrors the encoder. Convolutions map channels back and max pooling layers are replaced
+    with nearest neighbour upsampling
+    """
+    def __init__(self, encoder: AdaINEncoder) -> None:
+        super().__init__()
+        layers: list[nn.Module] = []
+        for layer in reversed(encoder.get_layers()):
+            if isinstance(layer, nn.Conv2d):
+                layers += [nn.ReflectionPad2d(1), nn.Conv2d(layer.out_channels, layer.in_channels, 3), nn.ReLU()]
+            elif isinstance(layer, nn.MaxPool2d):
+                layers.append(nn.Upsample(scale_factor=2, mode="nearest"))
+        # Output is normalized image, so the last convolution has no activation
+        self._model = nn.Sequential(*layers[:-1])
+
+    def forward(self, inp: Tensor) -> Tensor:
+        return self._model(inp)
+
+
+class AdaINModel(nn.Module):
+    """
+    Arbitrary style transfer with a single encoder-decoder pass
+    """
+    def __init__(self, pretrained_model_type: str = "vgg11", encoder_layers_id: tp.Optional[list[int]] = None) -> None:
+        super().__init__()
+        self.encoder = AdaINEncoder(pretrained_model_type, encoder_layers_id)
+        self.decoder = AdaINDecoder(self.encoder)
+
+    def forward(self, content: Tensor, style: Tensor, style_strength: float = 1.0) -> Tensor:
+        """
+        :param content: [batch_size, 3, H, W] normalized content images. H and W have to be divisible by encoder.get_size_multiple()
+        :param style: [batch_size, 3, H', W'] normalized style images
+        :param style_strength: 0 reconstructs content image, 1 fully applies style statistics
+        :return: [batch_size, 3, H, W] normalized stylized images
+        """
+        content_features: Tensor = self.encoder(content)[-1]
+        style_features: Tensor = self.encoder(style)[-1]
+        target: Tensor = adaptive_instance_normalization(content_features, style_features)
+        return self.decoder(style_strength * target + (1 - style_strength) * content_features)
+
+
+@dataclass
+class AdaINCheckpoint:
+    """
+    Trained decoder with encoder parameters it was trained with. Encoder weights aren't stored, since they are
+    pretrained weights of the base model
+    """
+    pretrained_model_type: str
+    encoder_layers_id: list[int]
+    decoder_state_dict: dict[str, Tensor]
+
+    # Version of the stored dict. Increased on incompatible changes of AdaINModel or of the format
+    format_version: tp.ClassVar[int] = 1
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save({
+            "format_version": self.format_version,
+            "pretrained_model_type": self.pretrained_model_type,
+            "encoder_layers_id": self.encoder_layers_id,
+            "decoder_state_dict": self.decoder_state_dict,
+        }, path)
+
+    @staticmethod
+    def load(path: Path) -> "AdaINCheckpoint":
+        checkpoint: dict[str, tp.Any] = torch.load(path, map_location="cpu")
+        assert checkpoint.get("format_version") == AdaINCheckpoint.format_version, \
+            f"Only version {AdaINCheckpoint.format_version} of AdaIN checkpoints is supported, " \
+            f"but {checkpoint.get('format_version')} met in {path}!"
+        return AdaINCheckpoint(checkpoint["pretrained_model_type"], checkpoint["encoder_layers_id"], checkpoint["decoder_state_dict"])
+
+    def create_model(self) -> AdaINModel:
+        model = AdaINModel(self.pretrained_model_type, self.encoder_layers_id)
+        model.decoder.load_state_dict(self.decoder_state_dict)
+        return model
+
+
+class AdaINModelRegistry:
+    """
+    Loads trained AdaIN model only once and shares frozen model between all requests
+    """
+    def __init__(self, path_to_checkpoint: Path = Config.path_to_adain_model) -> None:
+        self._path_to_checkpoint: Path = path_to_checkpoint
+        self._model: tp.Optional[AdaINModel] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        return self._path_to_checkpoint.exists()
+
+    def get(self) -> AdaINModel:
+        assert self.is_available(), f"AdaIN model isn't trained, {self._path_to_checkpoint} doesn't exist!"
+        with self._lock:
+            if self._model is None:
+                start_time: float = time.perf_counter()
+                model: AdaINModel = AdaINCheckpoint.load(self._path_to_checkpoint).create_model()
+                model.eval().requires_grad_(False)
+                self._model = model.to(Config.device)
+                logger.info(f"Loaded AdaIN model in {time.perf_counter() - start_time:.2f}s.")
+            return self._model
+
+
+adain_model_registry: AdaINModelRegistry = AdaINModelRegistry()
+
+
+class AdaINStyleTransferProcessor(SinglePassStyleTransferProcessor):
+    """
+    Transfers style of arbitrary style image with a single encoder-decoder pass
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self._style_image: tp.Optional[Image] = None
+        self._style_strength: float = Config.adain_style_strength
+        self._model: tp.Optional[AdaINModel] = None
+
+    def configure(self, username: str, content_image: Image, style_image: Image,
+                  style_strength: float = Config.adain_style_strength,
+                  profiler: tp.Optional[JobProfiler] = None) -> "AdaINStyleTransferProcessor":
+        """
+        :param username: username
+        :param content_image: content image
+        :param style_image: style image
+        :param style_strength: 0 reconstructs content image, 1 fully applies style statistics
+        :param profiler: profiler of the job. Forward pass is timed if it's enabled
+        """
+        assert 0.0 <= style_strength <= 1.0, f"Style strength has to be in [0, 1], but {style_strength} met!"
+        self._username = username
+        self._content_image = content_image
+        self._style_image = style_image
+        self._style_strength = style_strength
+        self._profiler = profiler if profiler is not None else JobProfiler()
+        self._model = adain_model_registry.get()
+        self._transfer_states = asyncio.Queue()
+        logger.debug("AdaINStyleTransferProcessor was configured.", extra={"username": username})
+        return self
+
+    def get_metric_labels(self) -> dict[str, str]:
+        return {
+            "backbone": self._model.encoder.get_pretrained_model_type(),
+            "working_size": format_image_size(self._get_content_working_image_size()),
+        }
+
+    def _get_content_working_image_size(self) -> tuple[int, int]:
+        return self._get_working_image_size(self._content_image, Config.adain_max_image_size, self._model.encoder.get_size_multiple())
+
+    def _run_transfer(self) -> Image:
+        start_time: float = time.perf_counter()
+        size_multiple: int = self._model.encoder.get_size_multiple()
+        content_size: tuple[int, int] = self._get_content_working_image_size()
+        style_size: tuple[int, int] = self._get_working_image_size(self._style_image, Config.adain_max_image_size, size_multiple)
+        with torch.no_grad(), self._profiler.stage("forward"):
+            output: Tensor = self._model(
+                self._to_tensor(self._content_image, content_size),
+                self._to_tensor(self._style_image, style_size),
+                self._style_strength,
+            )
+        result: Image = self._to_pil_image(output, self._content_image.size)
+        logger.info(f"Transferred style with AdaIN in {time.perf_counter() - start_time:.2f}s.", extra={"username": self._username})
+        return result
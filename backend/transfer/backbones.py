@@ -0,0 +1,99 @@
+import time
+import torch
+import threading
+import typing as tp
+import torch.nn as nn
+
+from pathlib import Path
+from torchvision.models import vgg11, vgg13, vgg16, vgg19
+from torchvision.models import VGG11_Weights, VGG13_Weights, VGG16_Weights, VGG19_Weights
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.metrics import Gauge, metrics_registry
+
+
+logger = get_logger(__name__)
+backbone_load_seconds: Gauge = metrics_registry.gauge(
+    "nst_backbone_load_seconds", "Time of loading pretrained base model into memory", ["backbone"],
+)
+
+
+class BackboneRegistry:
+    """
+    Process-wide registry of frozen pretrained base models. Each model type is loaded only once, and its read-only
+    weights are shared between all NSTModel instances
+    """
+    def __init__(self, path_to_save_dir: Path = Config.path_to_pretrained_models) -> None:
+        """
+        :param path_to_save_dir: path for downloading pretrained models
+        """
+        self._path_to_save_dir: Path = path_to_save_dir
+        self._base_models: dict[str, nn.Module] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+        self._available_base_models: dict[str, tp.Any] = {
+            "vgg11": vgg11,
+            "vgg13": vgg13,
+            "vgg16": vgg16,
+            "vgg19": vgg19,
+        }
+        self._available_base_models_weights: dict[str, tp.Any] = {
+            "vgg11": VGG11_Weights.DEFAULT,
+            "vgg13": VGG13_Weights.DEFAULT,
+            "vgg16": VGG16_Weights.DEFAULT,
+            "vgg19": VGG19_Weights.DEFAULT,
+        }
+
+    def get_available_model_types(self) -> list[str]:
+        return list(self._available_base_models.keys())
+
+    def get(self, model_type: str) -> nn.Module:
+        """
+        Returns frozen base model of selected type. Loads it on the first call
+        :param model_type: type of base model
+        :return: shared base model. It must not be modified by the caller
+        """
+        assert model_type in self._available_base_models.keys(), \
+            f"Only {self._available_base_models.keys()} is available for base model"
+
+        with self._lock:
+            if model_type not in self._base_models:
+                self._base_models[model_type] = self._load_pretrained_base_model(model_type)
+            return self._base_models[model_type]
+
+    def preload(self, model_types: list[str]) -> None:
+        """
+        Loads selected base models in advance, e.g. at server startup
+        :param model_types: types of base models
+        """
+        for model_type in model_types:
+            self.get(model_type)
+
+    def _load_pretrained_base_model(self, model_type: str) -> nn.Module:
+        """
+        Loads selected pretrained model from torch hub and freezes its weights
+        :param model_type: type of base model
+        :return: frozen base model
+        """
+        if not self._path_to_save_dir.exists():
+            self._path_to_save_dir.mkdir(parents=True, exist_ok=True)
+
+        start_time: float = time.perf_counter()
+        torch.hub.set_dir(str(self._path_to_save_dir))
+        if model_type.startswith("vgg"):
+            base_model: nn.Module = self._available_base_models[model_type](
+                weights=self._available_base_models_weights[model_type] if Config.use_pretrained_weights else None
+            ).eval().features.to(Config.device)
+        else:
+            raise NotImplementedError("Only vgg models available as base models!")
+        base_model.requires_grad_(False)
+        if Config.channels_last:
+            base_model = base_model.to(memory_format=torch.channels_last)
+        load_time: float = time.perf_counter() - start_time
+        backbone_load_seconds.set(load_time, backbone=model_type)
+        logger.info(f"Loaded {model_type} base model in {load_time:.2f}s.")
+        return base_model
+
+
+backbone_registry: BackboneRegistry = BackboneRegistry()
@@ -0,0 +1,192 @@
+import torch
+import threading
+import typing as tp
+
+from torch import Tensor
+from PIL.Image import Image
+from dataclasses import dataclass, field
+from concurrent.futures import Executor, Future
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.transfer.nst_model import NSTModel
+
+if tp.TYPE_CHECKING:
+    from backend.transfer.transfer import StyleTransferProcessor, TransferStepInputs
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class BatchKey:
+    """
+    Jobs with equal keys have the same model structure and can be optimized in one batch
+    """
+    pretrained_model_type: str
+    working_image_size: tuple[int, int]
+    content_loss_layers_id: tuple[int, ...]
+    style_loss_layers_id: tuple[int, ...]
+    content_layer_weights: tuple[float, ...]
+    style_layer_weights: tuple[float, ...]
+    precision: str
+
+
+@dataclass
+class _TransferJob:
+    processor: "StyleTransferProcessor"
+    future: Future
+    content_targets: list[Tensor]
+    style_targets: list[Tensor]
+
+
+@dataclass
+class _TransferJobGroup:
+    key: BatchKey
+    jobs: list[_TransferJob] = field(default_factory=list)
+    pending_jobs: list[_TransferJob] = field(default_factory=list)
+    model: tp.Optional[NSTModel] = None
+
+
+class BatchedTransferEngine:
+    """
+    Engine that optimizes input tensors of compatible jobs in one batch: one forward and backward pass per step for the
+    whole group. Jobs join and leave the batch at step boundaries. Every group is processed in its own executor thread.
+    Processors of jobs are driven through their step API: begin_transfer(), begin_step(), finish_step() and end_transfer()
+    """
+    def __init__(self, executor: Executor, max_batch_size: int = Config.max_batch_size) -> None:
+        """
+        :param executor: executor that runs processing loops of job groups
+        :param max_batch_size: maximum number of jobs in one batch
+        """
+        self._executor: Executor = executor
+        self._max_batch_size: int = max_batch_size
+        self._groups: dict[BatchKey, list[_TransferJobGroup]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def submit(self, processor: "StyleTransferProcessor") -> Future:
+        """
+        Adds configured processor to the group of compatible jobs
+        :param processor: configured style transfer processor
+        :return: future with result image
+        """
+        content_targets, style_targets = processor.get_nst_model().get_targets()
+        job = _TransferJob(processor, Future(), content_targets, style_targets)
+        key: BatchKey = processor.get_batch_key()
+
+        with self._lock:
+            groups: list[_TransferJobGroup] = self._groups.setdefault(key, [])
+            for group in groups:
+                if len(group.jobs) + len(group.pending_jobs) < self._max_batch_size:
+                    group.pending_jobs.append(job)
+                    return job.future
+
+            group = _TransferJobGroup(key, pending_jobs=[job])
+            groups.append(group)
+        self._executor.submit(self._run_group, group)
+        return job.future
+
+    def _run_group(self, group: _TransferJobGroup) -> None:
+        """
+        Processes steps of the group until there are no jobs in it
+        :param group: group of compatible jobs
+        """
+        try:
+            while True:
+                with self._lock:
+                    new_jobs: list[_TransferJob] = group.pending_jobs
+                    group.pending_jobs = []
+                    if not group.jobs and not new_jobs:
+                        self._remove_group(group)
+                        return
+
+                membership_changed: bool = self._admit_jobs(group, new_jobs)
+                membership_changed = self._release_finished_jobs(group) or membership_changed
+                if membership_changed:
+                    self._update_group_targets(group)
+                if group.jobs:
+                    self._process_group_step(group)
+        except Exception as exc:
+            logger.warning("Batched style transfer failed with exception.", exc_info=exc)
+            self._fail_group(group, exc)
+
+    def _remove_group(self, group: _TransferJobGroup) -> None:
+        """
+        Removes the group from groups of its key. Must be called under the lock
+        """
+        self._groups[group.key].remove(group)
+        if not self._groups[group.key]:
+            del self._groups[group.key]
+
+    def _fail_group(self, group: _TransferJobGroup, exc: Exception) -> None:
+        """
+        Removes the group and sets the exception to futures of all its jobs
+        :param group: failed group
+        :param exc: exception raised during processing of the group
+        """
+        with self._lock:
+            failed_jobs: list[_TransferJob] = group.jobs + group.pending_jobs
+            group.jobs, group.pending_jobs = [], []
+            self._remove_group(group)
+        for job in failed_jobs:
+            if not job.future.done():
+                job.future.set_exception(exc)
+
+    @staticmethod
+    def _admit_jobs(group: _TransferJobGroup, new_jobs: list[_TransferJob]) -> bool:
+        """
+        :return: True if group membership changed
+        """
+        admitted: bool = False
+        for job in new_jobs:
+            if job.future.set_running_or_notify_cancel():
+                job.processor.begin_transfer()
+                group.jobs.append(job)
+                admitted = True
+        return admitted
+
+    @staticmethod
+    def _release_finished_jobs(group: _TransferJobGroup) -> bool:
+        """
+        Removes stopped and completed jobs from the group and sets their results
+        :return: True if group membership changed
+        """
+        finished_jobs: list[_TransferJob] = [job for job in group.jobs if job.processor.is_transfer_finished()]
+        for job in finished_jobs:
+            group.jobs.remove(job)
+            try:
+                result: Image = job.processor.end_transfer()
+                job.future.set_result(result)
+            except Exception as exc:
+                job.future.set_exception(exc)
+        return len(finished_jobs) > 0
+
+    @staticmethod
+    def _update_group_targets(group: _TransferJobGroup) -> None:
+        """
+        Stacks targets of all jobs of the group into batched targets of group model. Group model is a copy, so models
+        of the jobs keep their own targets
+        """
+        if not group.jobs:
+            return
+        group.model = group.jobs[0].processor.get_nst_model().copy_with_targets(
+            [torch.cat(layer_targets) for layer_targets in zip(*(job.content_targets for job in group.jobs))],
+            [torch.cat(layer_targets) for layer_targets in zip(*(job.style_targets for job in group.jobs))],
+        )
+
+    @staticmethod
+    def _process_group_step(group: _TransferJobGroup) -> None:
+        """
+        Makes one optimization step for every job of the group with one forward and backward pass
+        """
+        step_inputs: list["TransferStepInputs"] = [job.processor.begin_step() for job in group.jobs]
+        # Jobs of the group have the same precision
+        with group.jobs[0].processor.step_context() as saved_tensors:
+            loss: Tensor = group.model.compute_loss(
+                torch.cat([inputs.input_tensor for inputs in step_inputs]), torch.stack([inputs.alpha for inputs in step_inputs]),
+            )
+        loss.sum().backward()
+        losses: Tensor = group.model.get_last_losses()
+        for job_idx, job in enumerate(group.jobs):
+            # Activations of the batch are split evenly between its jobs
+            job.processor.finish_step(losses[job_idx], saved_tensors.num_bytes // len(group.jobs))
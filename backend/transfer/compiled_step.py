@@ -0,0 +1,175 @@
+import torch
+import threading
+import typing as tp
+import torch.nn as nn
+
+from torch import Tensor
+from dataclasses import dataclass
+from collections import OrderedDict
+
+from backend.config import Config
+from backend.transfer.backbones import backbone_registry
+from backend.transfer.layers import ContentLossLayer, StyleLossLayer, combine_layer_losses
+
+
+@dataclass(frozen=True)
+class CompiledStepKey:
+    pretrained_model_type: str
+    working_image_size: tuple[int, int]
+    content_loss_layers_id: tuple[int, ...]
+    style_loss_layers_id: tuple[int, ...]
+    compiler: str
+
+
+class NSTLossGraph(nn.Module):
+    """
+    Side effect free counterpart of NSTModel: forward pass through the base model, content and style losses and their
+    weighted sums in one function. Targets, weights of layers and alpha are inputs, so one graph serves all jobs with the
+    same loss layers
+    """
+    def __init__(self, base_model: nn.Module, content_loss_layers_id: tp.Sequence[int], style_loss_layers_id: tp.Sequence[int]) -> None:
+        """
+        :param base_model: shared pretrained base model
+        :param content_loss_layers_id: sorted indexes of convolutional layers after which content loss is computed
+        :param style_loss_layers_id: sorted indexes of convolutional layers after which style loss is computed
+        """
+        super().__init__()
+        last_layer_idx: int = max(content_loss_layers_id[-1], style_loss_layers_id[-1])
+        segments: list[nn.Sequential] = []
+        # Indexes of content and style targets compared with output of every segment, -1 if there is no loss after it
+        self._content_target_idx: list[int] = []
+        self._style_target_idx: list[int] = []
+
+        segment = nn.Sequential()
+        conv_layer_idx: int = 0
+        for layer in base_model.children():
+            segment.append(nn.ReLU() if isinstance(layer, nn.ReLU) else layer)
+            if not isinstance(layer, nn.Conv2d):
+                continue
+            if conv_layer_idx in content_loss_layers_id or conv_layer_idx in style_loss_layers_id:
+                segments.append(segment)
+                segment = nn.Sequential()
+                self._content_target_idx.append(
+                    content_loss_layers_id.index(conv_layer_idx) if conv_layer_idx in content_loss_layers_id else -1
+                )
+                self._style_target_idx.append(style_loss_layers_id.index(conv_layer_idx) if conv_layer_idx in style_loss_layers_id else -1)
+            if conv_layer_idx == last_layer_idx:
+                break
+            conv_layer_idx += 1
+        self._segments = nn.ModuleList(segments)
+
+    def forward(self, inp: Tensor, content_targets: list[Tensor], style_targets: list[Tensor], loss_weights: Tensor, alpha: Tensor) -> Tensor:
+        """
+        :param inp: [batch_size, 3, H, W] optimized images
+        :param content_targets: [batch_size, C, H, W] content targets in order of depth of content loss layers
+        :param style_targets: [batch_size, C, C] style Gram matrix targets in order of depth of style loss layers
+        :param loss_weights: [num_content_layers + num_style_layers, 2] weights of content loss layers followed by style
+        loss layers in content and style losses
+        :param alpha: style loss coefficient in total loss, scalar or [batch_size] tensor
+        :return: [batch_size, 3] tensor of content, style and total losses
+        """
+        content_losses: list[Tensor] = []
+        style_losses: list[Tensor] = []
+        output: Tensor = inp
+        for segment_idx, segment in enumerate(self._segments):
+            output = segment(output)
+            if self._content_target_idx[segment_idx] >= 0:
+                content_losses.append(ContentLossLayer.compute_loss(output, content_targets[self._content_target_idx[segment_idx]]))
+            if self._style_target_idx[segment_idx] >= 0:
+                style_losses.append(StyleLossLayer.compute_loss(output, style_targets[self._style_target_idx[segment_idx]]))
+        content_loss, style_loss = combine_layer_losses(content_losses + style_losses, loss_weights).unbind(dim=-1)
+        return torch.stack([content_loss, style_loss, content_loss + alpha * style_loss], dim=-1)
+
+
+class CompiledStep:
+    """
+    NSTLossGraph compiled on its first call. TorchScript tracing needs example inputs, so arguments of the first call are used.
+    Batch dimension is dynamic, so jobs joining and leaving a batched group don't recompile the step
+    """
+    def __init__(self, graph: NSTLossGraph, compiler: str) -> None:
+        """
+        :param graph: graph of the step
+        :param compiler: one of Config.available_step_compilers
+        """
+        assert compiler in Config.available_step_compilers, f"Only {Config.available_step_compilers} step compilers are available!"
+        self._graph: NSTLossGraph = graph
+        self._compiler: str = compiler
+        self._compiled_graph: tp.Optional[tp.Callable[..., Tensor]] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def __call__(self, inp: Tensor, content_targets: list[Tensor], style_targets: list[Tensor], loss_weights: Tensor, alpha: Tensor) -> Tensor:
+        """
+        Arguments are documented in NSTLossGraph.forward()
+        :return: [batch_size, 3] tensor of content, style and total losses
+        """
+        with self._lock:
+            if self._compiled_graph is None:
+                compiled_graph: tp.Callable[..., Tensor] = self._compile(inp, content_targets, style_targets, loss_weights, alpha)
+                # torch.compile compiles lazily, so the first call is made under the lock too. Otherwise concurrent jobs
+                # would compile the same graph in parallel
+                losses: Tensor = compiled_graph(inp, content_targets, style_targets, loss_weights, alpha)
+                self._compiled_graph = compiled_graph
+                return losses
+        return self._compiled_graph(inp, content_targets, style_targets, loss_weights, alpha)
+
+    def is_compiled(self) -> bool:
+        return self._compiled_graph is not None
+
+    def _compile(self, inp: Tensor, content_targets: list[Tensor], style_targets: list[Tensor], loss_weights: Tensor,
+                 alpha: Tensor) -> tp.Callable[..., Tensor]:
+        if self._compiler == "torch_compile":
+            return torch.compile(self._graph, dynamic=True)
+        return torch.jit.trace(self._graph, (inp, content_targets, style_targets, loss_weights, alpha), check_trace=False)
+
+
+class CompiledStepCache:
+    """
+    Bounded LRU cache of compiled steps, so compilation cost is paid once per configuration, not per request
+    """
+    def __init__(self, max_size: int = Config.max_compiled_steps) -> None:
+        """
+        :param max_size: maximum number of cached steps
+        """
+        self._max_size: int = max_size
+        self._steps: OrderedDict[CompiledStepKey, CompiledStep] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+        self._num_hits: int = 0
+        self._num_misses: int = 0
+        self._num_evictions: int = 0
+
+    def get(self, key: CompiledStepKey) -> CompiledStep:
+        """
+        :param key: cache key
+        :return: cached step or a new one, which is compiled on its first call
+        """
+        with self._lock:
+            step: tp.Optional[CompiledStep] = self._steps.get(key)
+            if step is not None:
+                self._num_hits += 1
+                self._steps.move_to_end(key)
+                return step
+            self._num_misses += 1
+            graph = NSTLossGraph(backbone_registry.get(key.pretrained_model_type), key.content_loss_layers_id, key.style_loss_layers_id)
+            step = CompiledStep(graph.to(Config.device), key.compiler)
+            while len(self._steps) >= self._max_size:
+                self._steps.popitem(last=False)
+                self._num_evictions += 1
+            self._steps[key] = step
+            return step
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._num_hits,
+                "misses": self._num_misses,
+                "evictions": self._num_evictions,
+                "num_entries": len(self._steps),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._steps.clear()
+
+
+compiled_step_cache: CompiledStepCache = CompiledStepCache()
@@ -0,0 +1,45 @@
+import typing as tp
+
+from collections import deque
+
+from backend.config import Config
+
+
+class EarlyStopping:
+    """
+    Policy that detects plateau of the loss: relative improvement of the loss over sliding window of its recent values
+    is less than threshold
+    """
+    def __init__(self,
+                 window_size: int = Config.early_stopping_window_size,
+                 min_relative_improvement: float = Config.early_stopping_min_relative_improvement,
+                 min_iterations: int = Config.early_stopping_min_iterations) -> None:
+        """
+        :param window_size: number of loss values in sliding window
+        :param min_relative_improvement: minimum relative decrease of the loss over the window that isn't a plateau
+        :param min_iterations: number of iterations before which transfer is never stopped
+        """
+        assert window_size >= 2, "Sliding window has to contain at least two values!"
+        self._min_relative_improvement: float = min_relative_improvement
+        self._min_iterations: int = min_iterations
+        self._losses: deque[float] = deque(maxlen=window_size)
+
+    def reset(self) -> None:
+        self._losses.clear()
+
+    def update(self, iteration: int, loss: float) -> bool:
+        """
+        Adds new loss value to the window
+        :param iteration: number of completed iterations
+        :param loss: current loss
+        :return: True if the loss has reached plateau and transfer should be stopped
+        """
+        self._losses.append(loss)
+        if iteration < self._min_iterations or len(self._losses) < self._losses.maxlen:
+            return False
+        return self.get_relative_improvement() < self._min_relative_improvement
+
+    def get_relative_improvement(self) -> tp.Optional[float]:
+        if len(self._losses) < 2:
+            return None
+        return (self._losses[0] - self._losses[-1]) / max(abs(self._losses[0]), 1e-12)
@@ -0,0 +1,340 @@
+import abc
+import time
+import torch
+import asyncio
+import threading
+import typing as tp
+import torch.nn as nn
+
+from torch import Tensor
+from pathlib import Path
+from PIL.Image import Image
+from dataclasses import dataclass
+from torch.nn.functional import interpolate
+from torchvision.transforms import Compose, Normalize, ToTensor, ToPILImage, Resize
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.metrics import format_image_size
+from backend.transfer.telemetry import LossRecord
+from backend.transfer.profiling import JobProfiler
+from backend.transfer.transfer import TransferState, transfer_executor
+
+
+logger = get_logger(__name__)
+
+
+class _ConvLayer(nn.Sequential):
+    def __init__(self, in_channels: int, out_channels: int, kernel_size: int, stride: int = 1) -> None:
+        super().__init__(
+            nn.ReflectionPad2d(kernel_size // 2),
+            nn.Conv2d(in_channels, out_channels, kernel_size, stride),
+        )
+
+
+class _ResidualBlock(nn.Module):
+    def __init__(self, channels: int) -> None:
+        super().__init__()
+        self._block = nn.Sequential(
+            _ConvLayer(channels, channels, 3),
+            nn.InstanceNorm2d(channels, affine=True),
+            nn.ReLU(),
+            _ConvLayer(channels, channels, 3),
+            nn.InstanceNorm2d(channels, affine=True),
+        )
+
+    def forward(self, inp: Tensor) -> Tensor:
+        return inp + self._block(inp)
+
+
+class _UpsampleConvLayer(_ConvLayer):
+    """
+    Nearest neighbour upsampling followed by convolution. Unlike transposed convolution it doesn't produce checkerboard artifacts
+    """
+    def forward(self, inp: Tensor) -> Tensor:
+        return super().forward(interpolate(inp, scale_factor=2, mode="nearest"))
+
+
+class TransformerNet(nn.Module):
+    """
+    Feed-forward image transformation network trained for one style. It maps normalized content image to normalized
+    stylized image of the same size in a single forward pass
+    """
+    def __init__(self, num_channels: int = 32, num_residual_blocks: int = 5) -> None:
+        """
+        :param num_channels: number of channels of the first convolutional layer. Deeper layers have 2x and 4x channels
+        :param num_residual_blocks: number of residual blocks at the lowest resolution
+        """
+        super().__init__()
+        self._model = nn.Sequential(
+            _ConvLayer(3, num_channels, 9),
+            nn.InstanceNorm2d(num_channels, affine=True),
+            nn.ReLU(),
+            _ConvLayer(num_channels, 2 * num_channels, 3, stride=2),
+            nn.InstanceNorm2d(2 * num_channels, affine=True),
+            nn.ReLU(),
+            _ConvLayer(2 * num_channels, 4 * num_channels, 3, stride=2),
+            nn.InstanceNorm2d(4 * num_channels, affine=True),
+            nn.ReLU(),
+            *[_ResidualBlock(4 * num_channels) for _ in range(num_residual_blocks)],
+            _UpsampleConvLayer(4 * num_channels, 2 * num_channels, 3),
+            nn.InstanceNorm2d(2 * num_channels, affine=True),
+            nn.ReLU(),
+            _UpsampleConvLayer(2 * num_channels, num_channels, 3),
+            nn.InstanceNorm2d(num_channels, affine=True),
+            nn.ReLU(),
+            _ConvLayer(num_channels, 3, 9),
+        )
+
+    def forward(self, inp: Tensor) -> Tensor:
+        """
+        :param inp: [batch_size, 3, H, W] normalized images. H and W have to be divisible by 4
+        :return: [batch_size, 3, H, W] normalized stylized images
+        """
+        return self._model(inp)
+
+
+@dataclass
+class FastStyleCheckpoint:
+    """
+    Trained TransformerNet with parameters it was trained with. Stored as {style_name}.pth
+    """
+    style_name: str
+    pretrained_model_type: str
+    num_channels: int
+    num_residual_blocks: int
+    state_dict: dict[str, Tensor]
+
+    # Version of the stored dict. Increased on incompatible changes of TransformerNet or of the format
+    format_version: tp.ClassVar[int] = 1
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        torch.save({
+            "format_version": self.format_version,
+            "style_name": self.style_name,
+            "pretrained_model_type": self.pretrained_model_type,
+            "num_channels": self.num_channels,
+            "num_residual_blocks": self.num_residual_blocks,
+            "state_dict": self.state_dict,
+        }, path)
+
+    @staticmethod
+    def load(path: Path) -> "FastStyleCheckpoint":
+        checkpoint: dict[str, tp.Any] = torch.load(path, map_location="cpu")
+        assert checkpoint.get("format_version") == FastStyleCheckpoint.format_version, \
+            f"Only version {FastStyleCheckpoint.format_version} of fast style checkpoints is supported, " \
+            f"but {checkpoint.get('format_version')} met in {path}!"
+        return FastStyleCheckpoint(
+            checkpoint["style_name"],
+            checkpoint["pretrained_model_type"],
+            checkpoint["num_channels"],
+            checkpoint["num_residual_blocks"],
+            checkpoint["state_dict"],
+        )
+
+    def create_model(self) -> TransformerNet:
+        model = TransformerNet(self.num_channels, self.num_residual_blocks)
+        model.load_state_dict(self.state_dict)
+        return model
+
+
+class FastStyleRegistry:
+    """
+    Process-wide registry of trained fast style models. Each style is loaded from its checkpoint only once, and frozen
+    model is shared between all requests
+    """
+    def __init__(self, path_to_checkpoints: Path = Config.path_to_fast_style_models) -> None:
+        """
+        :param path_to_checkpoints: directory with {style_name}.pth checkpoints
+        """
+        self._path_to_checkpoints: Path = path_to_checkpoints
+        self._models: dict[str, TransformerNet] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def get_available_styles(self) -> list[str]:
+        if not self._path_to_checkpoints.exists():
+            return []
+        return sorted(path.stem for path in self._path_to_checkpoints.glob("*.pth"))
+
+    def get(self, style_name: str) -> TransformerNet:
+        """
+        Returns frozen model of selected style. Loads it on the first call
+        :param style_name: name of trained style
+        :return: shared model. It must not be modified by the caller
+        """
+        assert style_name in self.get_available_styles(), f"Only {self.get_available_styles()} fast styles are available"
+
+        with self._lock:
+            if style_name not in self._models:
+                start_time: float = time.perf_counter()
+                model: TransformerNet = FastStyleCheckpoint.load(self._path_to_checkpoints / f"{style_name}.pth").create_model()
+                model.eval().requires_grad_(False)
+                self._models[style_name] = model.to(Config.device)
+                logger.info(f"Loaded {style_name} fast style model in {time.perf_counter() - start_time:.2f}s.")
+            return self._models[style_name]
+
+
+fast_style_registry: FastStyleRegistry = FastStyleRegistry()
+
+
+class SinglePassStyleTransferProcessor(abc.ABC):
+    """
+    Base class of processors that transfer style with a single forward pass of a trained network. They have the same
+    interface as StyleTransferProcessor, so they are served by the same controllers
+    """
+    def __init__(self) -> None:
+        self._username: tp.Optional[str] = None
+        self._content_image: tp.Optional[Image] = None
+        self._transfer_states: tp.Optional[asyncio.Queue] = None
+        self._is_transferring: bool = False
+        self._stop_reason: tp.Optional[str] = None
+        self._profiler: JobProfiler = JobProfiler()
+
+    def is_transferring(self) -> bool:
+        return self._is_transferring
+
+    def get_current_transfer_status(self) -> int:
+        return 0
+
+    def get_num_completed_iterations(self) -> int:
+        """
+        :return: 1, the only forward pass, if transfer was completed
+        """
+        return int(self._stop_reason == "completed")
+
+    def get_stop_reason(self) -> tp.Optional[str]:
+        return self._stop_reason
+
+    def get_loss_history(self, since_iteration: int = 0) -> list[LossRecord]:
+        """
+        :return: empty list, since single pass transfer doesn't optimize any loss
+        """
+        return []
+
+    def get_peak_memory_usage(self) -> int:
+        return 0
+
+    @abc.abstractmethod
+    def get_metric_labels(self) -> dict[str, str]:
+        """
+        :return: labels of metrics of the job: type of the network and working size
+        """
+
+    def get_iterations_per_second(self) -> float:
+        """
+        :return: 0, since single pass transfer makes no iterations
+        """
+        return 0.0
+
+    async def transfer_style(self) -> Image:
+        assert self._transfer_states is not None, f"{type(self).__name__} is not configured! Call configure() method!"
+        self._stop_reason = None
+        self._is_transferring = True
+        try:
+            result: Image = await asyncio.get_running_loop().run_in_executor(transfer_executor, self._run_transfer)
+            self._stop_reason = "completed"
+            return result
+        except asyncio.CancelledError:
+            self._stop_reason = "stopped"
+            raise
+        finally:
+            self._is_transferring = False
+            self._transfer_states.put_nowait(None)
+
+    async def get_transfer_states(self) -> tp.AsyncGenerator[TransferState, None]:
+        """
+        Single pass transfer has no intermediate states, so it only waits for the end of the transfer
+        """
+        assert self._transfer_states is not None, f"{type(self).__name__} is not configured! Call configure() method!"
+        while True:
+            state: tp.Optional[TransferState] = await self._transfer_states.get()
+            if state is None:
+                return
+            yield state
+
+    @abc.abstractmethod
+    def _run_transfer(self) -> Image:
+        """
+        Runs the forward pass in transfer_executor
+        :return: stylized image
+        """
+
+    @staticmethod
+    def _get_working_image_size(image: Image, max_image_size: int, size_multiple: int) -> tuple[int, int]:
+        """
+        :param image: input image
+        :param max_image_size: maximum size of the larger side
+        :param size_multiple: both sides are made divisible by it, e.g. for downsampling and upsampling layers
+        :return: (height, width) to which image is resized before forward pass
+        """
+        width, height = image.size
+        scale: float = min(1.0, max_image_size / max(width, height))
+        return (
+            max(size_multiple, round(height * scale / size_multiple) * size_multiple),
+            max(size_multiple, round(width * scale / size_multiple) * size_multiple),
+        )
+
+    @staticmethod
+    def _to_tensor(image: Image, working_image_size: tuple[int, int]) -> Tensor:
+        return Compose([
+            ToTensor(),
+            Normalize(mean=Config.normalization_mean, std=Config.normalization_std),
+            Resize(working_image_size),
+        ])(image).unsqueeze(0).to(Config.device)
+
+    @staticmethod
+    def _to_pil_image(output: Tensor, image_size: tuple[int, int]) -> Image:
+        """
+        :param output: [1, 3, H, W] normalized output of the network
+        :param image_size: (width, height) of the result
+        :return: result image
+        """
+        output = output * Config.normalization_std + Config.normalization_mean
+        return Compose([
+            Resize(image_size[::-1]),
+            ToPILImage(),
+        ])(output.clamp(0, 1).squeeze(0).cpu())
+
+
+class FastStyleTransferProcessor(SinglePassStyleTransferProcessor):
+    """
+    Transfers one of trained styles with a single forward pass of its TransformerNet
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self._style_name: tp.Optional[str] = None
+        self._model: tp.Optional[TransformerNet] = None
+
+    def configure(self, username: str, content_image: Image, style_name: str,
+                  profiler: tp.Optional[JobProfiler] = None) -> "FastStyleTransferProcessor":
+        """
+        :param username: username
+        :param content_image: content image
+        :param style_name: name of trained style
+        :param profiler: profiler of the job. Forward pass is timed if it's enabled
+        """
+        self._username = username
+        self._content_image = content_image
+        self._style_name = style_name
+        self._profiler = profiler if profiler is not None else JobProfiler()
+        self._model = fast_style_registry.get(style_name)
+        self._transfer_states = asyncio.Queue()
+        logger.debug(f"FastStyleTransferProcessor was configured with style {style_name}.", extra={"username": username})
+        return self
+
+    def get_metric_labels(self) -> dict[str, str]:
+        return {"backbone": "transformer_net", "working_size": format_image_size(self._get_content_working_image_size())}
+
+    def _get_content_working_image_size(self) -> tuple[int, int]:
+        # TransformerNet downsamples input twice, so both sides have to be divisible by 4
+        return self._get_working_image_size(self._content_image, Config.fast_style_max_image_size, 4)
+
+    def _run_transfer(self) -> Image:
+        start_time: float = time.perf_counter()
+        working_image_size: tuple[int, int] = self._get_content_working_image_size()
+        with torch.no_grad(), self._profiler.stage("forward"):
+            output: Tensor = self._model(self._to_tensor(self._content_image, working_image_size))
+        result: Image = self._to_pil_image(output, self._content_image.size)
+        logger.info(f"Transferred {self._style_name} fast style in {time.perf_counter() - start_time:.2f}s.", extra={"username": self._username})
+        return result
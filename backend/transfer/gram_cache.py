@@ -0,0 +1,105 @@
+import hashlib
+import threading
+import typing as tp
+
+from torch import Tensor
+from PIL.Image import Image
+from dataclasses import dataclass
+from collections import OrderedDict
+
+from backend.config import Config
+
+
+@dataclass(frozen=True)
+class GramMatrixCacheKey:
+    style_image_hash: str
+    pretrained_model_type: str
+    working_image_size: tuple[int, int]
+    layer_idx: int
+    precision: str = "fp32"
+
+
+class GramMatrixCache:
+    """
+    Bounded LRU cache of style Gram matrices. Size of the cache is accounted in bytes of stored tensors
+    """
+    def __init__(self, max_size_bytes: int = Config.gram_cache_max_size_bytes) -> None:
+        """
+        :param max_size_bytes: maximum total size of cached Gram matrices
+        """
+        self._max_size_bytes: int = max_size_bytes
+        self._size_bytes: int = 0
+        self._gram_matrices: OrderedDict[GramMatrixCacheKey, Tensor] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+        self._num_hits: int = 0
+        self._num_misses: int = 0
+        self._num_evictions: int = 0
+
+    @staticmethod
+    def hash_image(image: Image) -> str:
+        """
+        Computes content hash of the image
+        :param image: PIL image
+        :return: hex digest of image mode, size and pixels
+        """
+        image_hash = hashlib.sha256()
+        image_hash.update(f"{image.mode} {image.size[0]} {image.size[1]}".encode())
+        image_hash.update(image.tobytes())
+        return image_hash.hexdigest()
+
+    def get(self, key: GramMatrixCacheKey) -> tp.Optional[Tensor]:
+        """
+        :param key: cache key
+        :return: cached Gram matrix or None. Returned tensor is shared and must not be modified
+        """
+        with self._lock:
+            gram_matrix: tp.Optional[Tensor] = self._gram_matrices.get(key)
+            if gram_matrix is None:
+                self._num_misses += 1
+                return None
+            self._num_hits += 1
+            self._gram_matrices.move_to_end(key)
+            return gram_matrix
+
+    def put(self, key: GramMatrixCacheKey, gram_matrix: Tensor) -> None:
+        """
+        Adds Gram matrix to the cache, evicting least recently used ones if the cache is full
+        :param key: cache key
+        :param gram_matrix: detached Gram matrix
+        """
+        gram_matrix_size: int = self._get_tensor_size(gram_matrix)
+        if gram_matrix_size > self._max_size_bytes:
+            return
+
+        with self._lock:
+            if key in self._gram_matrices:
+                self._size_bytes -= self._get_tensor_size(self._gram_matrices.pop(key))
+            while self._size_bytes + gram_matrix_size > self._max_size_bytes:
+                _, evicted_gram_matrix = self._gram_matrices.popitem(last=False)
+                self._size_bytes -= self._get_tensor_size(evicted_gram_matrix)
+                self._num_evictions += 1
+            self._gram_matrices[key] = gram_matrix
+            self._size_bytes += gram_matrix_size
+
+    def get_statistics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._num_hits,
+                "misses": self._num_misses,
+                "evictions": self._num_evictions,
+                "size_bytes": self._size_bytes,
+                "num_entries": len(self._gram_matrices),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._gram_matrices.clear()
+            self._size_bytes = 0
+
+    @staticmethod
+    def _get_tensor_size(tensor: Tensor) -> int:
+        return tensor.element_size() * tensor.nelement()
+
+
+gram_matrix_cache: GramMatrixCache = GramMatrixCache()
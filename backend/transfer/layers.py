@@ -1,20 +1,21 @@
 import torch
+import typing as tp
 import torch.nn.functional
 
-
 from backend.config import Config
+from backend.transfer.profiling import JobProfiler
 
 
 class ContentLossLayer(torch.nn.Module):
     """
-    Layer for computing content loss. It doesn't change input
+    Layer for computing per-sample content loss. It doesn't change input
     """
     def __init__(self, target: torch.Tensor) -> None:
         """
         :param target: feature map of original content image, [batch_size, C, H, W] tensor
         """
         assert len(target.shape) == 4, \
-            f"Input tensor has to be [1, C, H, W], but {target.shape} met!"
+            f"Input tensor has to be [batch_size, C, H, W], but {target.shape} met!"
 
         super().__init__()
         self.target: torch.Tensor = target.to(Config.device)
@@ -22,45 +23,98 @@ class ContentLossLayer(torch.nn.Module):
 
     def forward(self, inp: torch.Tensor) -> torch.Tensor:
         """
+        Computes [batch_size] tensor of content losses. i-th sample of the input is compared with i-th target
         :param inp: [batch_size, C, H, W] tensor
         :return: inp without any changes
         """
-        self.loss = torch.nn.functional.mse_loss(inp, self.target, reduction="mean")
+        self.loss = self.compute_loss(inp, self.target)
         return inp
 
+    @staticmethod
+    def compute_loss(inp: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        """
+        Loss is accumulated in fp32, even if input is computed under reduced precision autocast
+        :param inp: [batch_size, C, H, W] tensor
+        :param target: [batch_size, C, H, W] feature map of original content image
+        :return: [batch_size] tensor of content losses
+        """
+        with torch.autocast(inp.device.type, enabled=False):
+            return torch.nn.functional.mse_loss(inp.float(), target.float(), reduction="none").mean(dim=(1, 2, 3))
+
 
 class StyleLossLayer(torch.nn.Module):
     """
-    Layer for computing style loss. It doesn't change input
+    Layer for computing per-sample style loss. It doesn't change input
     """
-    def __init__(self, target: torch.Tensor) -> None:
+    def __init__(self, target: tp.Optional[torch.Tensor] = None, target_gram_matrix: tp.Optional[torch.Tensor] = None) -> None:
         """
-        :param target: feature map of original style image, [1, C, H, W] tensor
+        :param target: feature map of original style image, [batch_size, C, H, W] tensor
+        :param target_gram_matrix: precomputed Gram matrix of original style image, [batch_size, C, C] tensor. Used instead of target
         """
-        assert len(target.shape) == 4, \
-            f"Input tensor has to be [1, C, H, W], but {target.shape} met!"
+        assert (target is None) != (target_gram_matrix is None), "Exactly one of target and target_gram_matrix has to be set!"
 
         super().__init__()
-        self.target_gram_matrix = self._gram_matrix(target.to(Config.device)).detach()
+        if target_gram_matrix is None:
+            assert len(target.shape) == 4, \
+                f"Input tensor has to be [batch_size, C, H, W], but {target.shape} met!"
+            target_gram_matrix = self._gram_matrix(target.to(Config.device))
+        self.target_gram_matrix: torch.Tensor = target_gram_matrix.to(Config.device).detach()
         self.loss: torch.Tensor = torch.tensor(0.0, device=Config.device)
+        self._profiler: tp.Optional[JobProfiler] = None
 
     def forward(self, inp: torch.Tensor) -> torch.Tensor:
         """
-        :param inp: [1, C, H, W] tensor
+        Computes [batch_size] tensor of style losses. i-th sample of the input is compared with i-th target
+        :param inp: [batch_size, C, H, W] tensor
         :return: inp without any changes
         """
-        gram_matrix: torch.Tensor = self._gram_matrix(inp)
-        self.loss = torch.nn.functional.mse_loss(gram_matrix, self.target_gram_matrix, reduction="mean")
+        # Checkpointed segments are recomputed during backward pass. That time already belongs to "backward" stage
+        if self._profiler is None or self._profiler.is_stage_active("backward"):
+            self.loss = self.compute_loss(inp, self.target_gram_matrix)
+            return inp
+        with self._profiler.stage("gram"):
+            self.loss = self.compute_loss(inp, self.target_gram_matrix)
         return inp
 
+    def set_profiler(self, profiler: tp.Optional[JobProfiler]) -> None:
+        """
+        :param profiler: profiler, which times Gram matrix computation and style loss as "gram" stage. None disables timing
+        """
+        self._profiler = profiler if profiler is not None and profiler.is_enabled() else None
+
+    @staticmethod
+    def compute_loss(inp: torch.Tensor, target_gram_matrix: torch.Tensor) -> torch.Tensor:
+        """
+        :param inp: [batch_size, C, H, W] tensor
+        :param target_gram_matrix: [batch_size, C, C] Gram matrix of original style image
+        :return: [batch_size] tensor of style losses
+        """
+        gram_matrix: torch.Tensor = StyleLossLayer._gram_matrix(inp)
+        with torch.autocast(inp.device.type, enabled=False):
+            return torch.nn.functional.mse_loss(gram_matrix, target_gram_matrix.float(), reduction="none").mean(dim=(1, 2))
+
     @staticmethod
     def _gram_matrix(tensor: torch.Tensor) -> torch.Tensor:
         """
-        Reshapes input tensor to 2d-matrix and computes the Gram matrix
-        :param tensor: [1, C, H, W] tensor
-        :return: [C, H * W] tensor - the Gram matrix
+        Reshapes every sample of input tensor to 2d-matrix and computes its Gram matrix. Products are accumulated in fp32,
+        even if input is computed under reduced precision autocast, since sums over H * W positions lose precision in bf16
+        :param tensor: [batch_size, C, H, W] tensor in any memory format
+        :return: [batch_size, C, C] fp32 tensor - the Gram matrices
         """
-        bs, c, h, w = tensor.size()
-        matrix: torch.Tensor = tensor.view(bs * c, h * w)
-        result: torch.Tensor = torch.mm(matrix, matrix.t()).div(bs * c * h * w)
+        _, c, h, w = tensor.size()
+        with torch.autocast(tensor.device.type, enabled=False):
+            # Batch size isn't used explicitly, so traced graphs aren't specialized to it
+            matrix: torch.Tensor = tensor.float().flatten(start_dim=2)
+            result: torch.Tensor = torch.bmm(matrix, matrix.transpose(1, 2)).div(c * h * w)
         return result
+
+
+def combine_layer_losses(layer_losses: list[torch.Tensor], loss_weights: torch.Tensor) -> torch.Tensor:
+    """
+    Combines per-layer losses into content and style losses with one matrix product
+    :param layer_losses: [batch_size] losses of content loss layers followed by losses of style loss layers
+    :param loss_weights: [num_layers, 2] weights of layers in content (first column) and style (second column) losses
+    :return: [batch_size, 2] tensor of content and style losses
+    """
+    with torch.autocast(loss_weights.device.type, enabled=False):
+        return torch.stack(layer_losses, dim=-1) @ loss_weights
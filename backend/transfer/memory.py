@@ -0,0 +1,91 @@
+import os
+import torch
+import resource
+import typing as tp
+
+from torch import Tensor
+
+
+def get_rss_bytes() -> int:
+    """
+    :return: resident set size of the process
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is measured in kilobytes on Linux. It's the peak value, but it's the best available approximation
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_tensors_bytes(tensors: tp.Iterable[tp.Optional[Tensor]]) -> int:
+    """
+    :param tensors: tensors or None
+    :return: total size of distinct storages of the tensors
+    """
+    storages: dict[int, int] = {}
+    for tensor in tensors:
+        if tensor is not None:
+            storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+    return sum(storages.values())
+
+
+class SavedTensorsCounter:
+    """
+    Counts size of tensors that job saves for backward pass inside the context. Tensors that don't belong to autograd
+    graph, e.g. shared base model weights and targets, aren't counted. Tensors saved inside checkpointed segments are
+    recomputed during backward pass, so they aren't counted either
+    """
+    def __init__(self, enabled: bool = True) -> None:
+        """
+        :param enabled: whether tensors are counted. Disabled counter doesn't install hooks
+        """
+        self.num_bytes: int = 0
+        self._enabled: bool = enabled
+        self._storages: set[int] = set()
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
+
+    def __enter__(self) -> "SavedTensorsCounter":
+        if self._enabled:
+            self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc_info: tp.Any) -> None:
+        if self._enabled:
+            self._hooks.__exit__(*exc_info)
+
+    def _pack(self, tensor: Tensor) -> Tensor:
+        if not tensor.requires_grad and tensor.grad_fn is None:
+            return tensor
+        storage_ptr: int = tensor.untyped_storage().data_ptr()
+        if storage_ptr not in self._storages:
+            self._storages.add(storage_ptr)
+            self.num_bytes += tensor.untyped_storage().nbytes()
+        return tensor
+
+    @staticmethod
+    def _unpack(tensor: Tensor) -> Tensor:
+        return tensor
+
+
+class JobMemoryTracker:
+    """
+    Tracks peak memory of one job: the largest size of tensors owned by the job plus tensors saved for backward pass
+    during one step. Process-wide statistics, e.g. RSS or peak memory allocated on CUDA, include concurrent jobs and
+    shared base models, so the same accounting is used on all devices
+    """
+    def __init__(self) -> None:
+        self._peak_bytes: int = 0
+
+    def reset(self) -> None:
+        self._peak_bytes = 0
+
+    def update(self, step_bytes: int) -> None:
+        """
+        Called after every step
+        :param step_bytes: size of tensors owned by the job and saved for backward pass during the last step
+        """
+        self._peak_bytes = max(self._peak_bytes, step_bytes)
+
+    def get_peak_bytes(self) -> int:
+        return self._peak_bytes
@@ -1,20 +1,19 @@
+import copy
 import torch
 import typing as tp
 import torch.nn as nn
 
 from torch import Tensor
-from pathlib import Path
 from PIL.Image import Image
+from torch.utils.checkpoint import checkpoint
 from torchvision.transforms import Compose, Normalize, ToTensor, Resize
-from torchvision.models import vgg11, vgg13, vgg16, vgg19
-from torchvision.models import VGG11_Weights, VGG13_Weights, VGG16_Weights, VGG19_Weights
 
 from backend.config import Config
-from backend.logger import get_logger
-from backend.transfer.layers import ContentLossLayer, StyleLossLayer
-
-
-logger = get_logger(__name__)
+from backend.transfer.backbones import backbone_registry
+from backend.transfer.compiled_step import CompiledStep, CompiledStepKey, compiled_step_cache
+from backend.transfer.gram_cache import GramMatrixCacheKey, gram_matrix_cache
+from backend.transfer.layers import ContentLossLayer, StyleLossLayer, combine_layer_losses
+from backend.transfer.profiling import JobProfiler
 
 
 class NSTModel(nn.Module):
@@ -25,145 +24,395 @@ class NSTModel(nn.Module):
                  username: str,
                  content_image: Image,
                  style_image: Image,
+                 content_loss_layers_id: tp.Optional[list[int]] = None,
+                 style_loss_layers_id: tp.Optional[list[int]] = None,
                  pretrained_model_type: str = "vgg11",
-                 path_to_save_dir: Path = Config.path_to_backend / "./transfer/pretrained") -> None:
+                 working_image_size: tuple[int, int] = Config.working_image_size,
+                 style_targets: tp.Optional[list[Tensor]] = None,
+                 content_layer_weights: tp.Optional[list[float]] = None,
+                 style_layer_weights: tp.Optional[list[float]] = None,
+                 precision: str = "fp32") -> None:
         """
         Initialize NSTModel
         :param username: username
         :param content_image: content image
         :param style_image: style image
-        :param path_to_save_dir: path for downloading pretrained model
+        :param content_loss_layers_id: indexes of convolutional layers after which content loss is computed.
+        All convolutional layers are used if not set
+        :param style_loss_layers_id: indexes of convolutional layers after which style loss is computed.
+        All convolutional layers are used if not set
+        :param pretrained_model_type: type of shared pretrained base model
+        :param working_image_size: size to which input images are resized before style transfer
+        :param style_targets: precomputed style Gram matrices in order of style loss layers. If set, style image isn't
+        forwarded through the model
+        :param content_layer_weights: weights of content loss layers in order of content_loss_layers_id. Weights are
+        normalized to sum to 1 and layers with zero weight aren't built. Equal weights if not set
+        :param style_layer_weights: weights of style loss layers in order of style_loss_layers_id, same as content ones
+        :param precision: precision of forward pass, one of Config.available_precisions. Targets are computed in the same
+        precision as optimized image, so they can be matched exactly, and are stored in fp32
         """
         self._username = username
-        self._initialize_available_models()
-        assert pretrained_model_type in self._available_base_models.keys(), \
-            f"Only {self._available_base_models.keys()} is available for base model"
+        assert pretrained_model_type in backbone_registry.get_available_model_types(), \
+            f"Only {backbone_registry.get_available_model_types()} is available for base model"
 
         super().__init__()
         self._pretrained_model_type: str = pretrained_model_type
-        self._path_to_save_dir: Path = path_to_save_dir
+        self._working_image_size: tuple[int, int] = working_image_size
+        self._precision: str = precision
+        self._last_losses: tp.Optional[Tensor] = None
 
         self._transforms = Compose([
             ToTensor(),
             Normalize(mean=Config.normalization_mean, std=Config.normalization_std),
-            Resize(Config.working_image_size),
+            Resize(working_image_size),
         ])
 
+        base_model: nn.Module = self._load_pretrained_base_model(pretrained_model_type)
+        num_conv_layers: int = len([layer for layer in base_model.children() if isinstance(layer, nn.Conv2d)])
+        self._content_layer_weights: dict[int, float] = self._get_layer_weights(content_loss_layers_id, content_layer_weights, num_conv_layers)
+        self._style_layer_weights: dict[int, float] = self._get_layer_weights(style_loss_layers_id, style_layer_weights, num_conv_layers)
+        self._content_loss_layers_id: list[int] = list(self._content_layer_weights)
+        self._style_loss_layers_id: list[int] = list(self._style_layer_weights)
+        # Weights of content and style loss layers in content (first column) and style (second column) losses
+        self._loss_weights: Tensor = torch.zeros(len(self._content_loss_layers_id) + len(self._style_loss_layers_id), 2, device=Config.device)
+        self._loss_weights[:len(self._content_loss_layers_id), 0] = torch.tensor(list(self._content_layer_weights.values()))
+        self._loss_weights[len(self._content_loss_layers_id):, 1] = torch.tensor(list(self._style_layer_weights.values()))
+
         self._content_loss_layers: list[ContentLossLayer] = []
         self._style_loss_layers: list[StyleLossLayer] = []
-        self._model = self._build_model(content_image, style_image, pretrained_model_type).to(Config.device)
+        self._model = self._build_model(content_image, style_image, base_model, style_targets).to(Config.device)
+        self._checkpoint_segments: list[nn.Sequential] = []
+        self._compiled_step: tp.Optional[CompiledStep] = None
 
     def forward(self, inp: Tensor) -> Tensor:
         """
-        Forwards input tensor through the model
+        Forwards input tensor through the model. If checkpointing is enabled, activations inside segments aren't stored
+        and are recomputed during backward pass
         :param inp: input tensor
         :return: output of the model
         """
-        output = self._model(inp)
+        if not self._checkpoint_segments:
+            return self._model(inp)
+        output: Tensor = inp
+        for segment in self._checkpoint_segments:
+            output = checkpoint(segment, output, use_reentrant=False)
         return output
 
-    def collect_loss(self,
-                     collect_content_loss_layers: list[int],
-                     collect_style_loss_layers: list[int],
-                     alpha: torch.Tensor = Config.alpha) -> Tensor:
-        """
-        Computes content and style loss for previously forwarded tensor
-        :param collect_content_loss_layers: list of indexes of content loss layers whose loss will be taken into account
-        :param collect_style_loss_layers: list of indexes of style loss layers whose loss will be taken into account
-        :param alpha: style loss coefficient in total loss
-        :return: total loss of previously forwarded tensor
-        """
-        content_loss: Tensor = torch.tensor(0.0, device=Config.device)
-        for layer_idx in collect_content_loss_layers:
-            content_loss += self._content_loss_layers[layer_idx].loss
-        content_loss /= len(collect_content_loss_layers)
-
-        style_loss: Tensor = torch.tensor(0.0, device=Config.device)
-        for layer_idx in collect_style_loss_layers:
-            style_loss += self._style_loss_layers[layer_idx].loss
-        style_loss /= len(collect_style_loss_layers)
+    def enable_compiled_step(self, compiler: str) -> None:
+        """
+        Makes compute_loss() run forward pass and losses as one compiled graph instead of walking loss layers. The graph
+        is taken from the process-wide cache, so it's compiled once per base model, working size and loss layers
+        :param compiler: one of Config.available_step_compilers
+        """
+        assert not self._checkpoint_segments, "Compiled step can't be used with checkpointing!"
+        self._compiled_step = compiled_step_cache.get(CompiledStepKey(
+            self._pretrained_model_type,
+            self._working_image_size,
+            tuple(self._content_loss_layers_id),
+            tuple(self._style_loss_layers_id),
+            compiler,
+        ))
+
+    def compute_loss(self, inp: Tensor, alpha: torch.Tensor = Config.alpha) -> Tensor:
+        """
+        Forwards input tensor and computes its losses with compiled step if it's enabled, otherwise layer by layer
+        :param inp: [batch_size, 3, H, W] input tensor
+        :param alpha: style loss coefficient in total loss, scalar or [batch_size] tensor
+        :return: [batch_size] tensor of total losses
+        """
+        if self._compiled_step is None:
+            self(inp)
+            return self.collect_loss(alpha)
+        content_targets, style_targets = self.get_targets()
+        # alpha is always [batch_size], so scalar alpha of single jobs and alphas of batched groups share one compiled graph
+        alpha = torch.as_tensor(alpha, device=inp.device).expand(inp.shape[0])
+        losses: Tensor = self._compiled_step(inp, content_targets, style_targets, self._loss_weights, alpha)
+        self._last_losses = losses.detach()
+        return losses[:, 2]
+
+    def set_profiler(self, profiler: JobProfiler) -> None:
+        """
+        Times Gram matrix computation and style loss of style loss layers as "gram" stage of enabled profiler
+        :param profiler: profiler of the job
+        """
+        for layer in self._style_loss_layers:
+            layer.set_profiler(profiler)
+
+    def enable_checkpointing(self, memory_budget_bytes: int, batch_size: int = 1) -> int:
+        """
+        Splits the model into checkpointed segments, so estimated peak activation memory fits into the budget
+        :param memory_budget_bytes: target peak memory of activations stored for backward pass
+        :param batch_size: batch size of input tensor
+        :return: number of checkpointed segments. 0 if the whole model fits into the budget
+        """
+        activation_sizes: list[int] = [batch_size * size for size in self._estimate_activation_sizes()]
+        segment_bounds: list[tuple[int, int]] = self._split_into_segments(activation_sizes, memory_budget_bytes)
+        self._checkpoint_segments = [self._model[start:end] for start, end in segment_bounds]
+        return len(self._checkpoint_segments)
+
+    def collect_loss(self, alpha: torch.Tensor = Config.alpha) -> Tensor:
+        """
+        Computes content and style loss for every sample of previously forwarded tensor as weighted sums of losses of loss layers
+        :param alpha: style loss coefficient in total loss, scalar or [batch_size] tensor
+        :return: [batch_size] tensor of total losses of previously forwarded tensor
+        """
+        layer_losses: list[Tensor] = [layer.loss for layer in self._content_loss_layers] + [layer.loss for layer in self._style_loss_layers]
+        content_loss, style_loss = combine_layer_losses(layer_losses, self._loss_weights).unbind(dim=-1)
         loss: Tensor = content_loss + alpha * style_loss
-        logger.debug("", extra={"username": self._username, "content_loss": content_loss.item(),
-                                "style_loss": style_loss.item(), "total_loss": loss.item()})
+        self._last_losses = torch.stack([content_loss, style_loss, loss], dim=-1).detach()
         return loss
 
-    def cut_model(self, conv_layer_idx: int) -> None:
+    def get_last_losses(self) -> Tensor:
+        """
+        Losses stay on device, so reading them doesn't synchronize with it
+        :return: [batch_size, 3] tensor of content, style and total losses computed by the last collect_loss() or
+        compute_loss() call
+        """
+        assert self._last_losses is not None, "Loss wasn't collected yet! Call collect_loss() method!"
+        return self._last_losses
+
+    def get_layer_weights(self) -> tuple[dict[int, float], dict[int, float]]:
+        """
+        :return: normalized weights of content and style loss layers by indexes of their convolutional layers
+        """
+        return self._content_layer_weights, self._style_layer_weights
+
+    def get_targets(self) -> tuple[list[Tensor], list[Tensor]]:
+        """
+        :return: content targets and style Gram matrix targets of loss layers in order of their depth
+        """
+        return [layer.target for layer in self._content_loss_layers], [layer.target_gram_matrix for layer in self._style_loss_layers]
+
+    def set_targets(self, content_targets: list[Tensor], style_targets: list[Tensor]) -> None:
+        """
+        Replaces targets of loss layers, e.g. with targets of several jobs stacked into one batch
+        :param content_targets: [batch_size, C, H, W] content targets in order of depth of content loss layers
+        :param style_targets: [batch_size, C, C] style Gram matrix targets in order of depth of style loss layers
+        """
+        assert len(content_targets) == len(self._content_loss_layers) and len(style_targets) == len(self._style_loss_layers), \
+            "Number of targets has to match number of loss layers!"
+        for layer, target in zip(self._content_loss_layers, content_targets):
+            layer.target = target
+        for layer, target_gram_matrix in zip(self._style_loss_layers, style_targets):
+            layer.target_gram_matrix = target_gram_matrix
+
+    def copy_with_targets(self, content_targets: list[Tensor], style_targets: list[Tensor]) -> "NSTModel":
+        """
+        Creates model of the same structure with its own loss layers, e.g. to optimize several jobs in one batch without
+        changing models of the jobs. Layers of base model are shared
+        :param content_targets: [batch_size, C, H, W] content targets in order of depth of content loss layers
+        :param style_targets: [batch_size, C, C] style Gram matrix targets in order of depth of style loss layers
+        :return: copy of the model with given targets
+        """
+        assert not self._checkpoint_segments, "Checkpointed model can't be copied!"
+        assert len(content_targets) == len(self._content_loss_layers) and len(style_targets) == len(self._style_loss_layers), \
+            "Number of targets has to match number of loss layers!"
+        model: NSTModel = copy.copy(self)
+        model._modules = self._modules.copy()
+        model._content_loss_layers, model._style_loss_layers = [], []
+        layers: list[nn.Module] = []
+        for layer in self._model.children():
+            if isinstance(layer, ContentLossLayer):
+                layer = ContentLossLayer(content_targets[len(model._content_loss_layers)])
+                model._content_loss_layers.append(layer)
+            elif isinstance(layer, StyleLossLayer):
+                layer = StyleLossLayer(target_gram_matrix=style_targets[len(model._style_loss_layers)])
+                model._style_loss_layers.append(layer)
+            layers.append(layer)
+        model._model = nn.Sequential(*layers)
+        model._last_losses = None
+        return model
+
+    def get_content_features(self, inp: Tensor) -> list[Tensor]:
+        """
+        Computes feature maps of input tensor at content loss layers, e.g. to use them as content targets of the next batch
+        :param inp: [batch_size, 3, H, W] normalized images of working size
+        :return: [batch_size, C, H, W] feature maps in order of depth of content loss layers
+        """
+        content_features: list[Tensor] = []
+        output: Tensor = inp
+        for layer in self._model.children():
+            if isinstance(layer, ContentLossLayer):
+                content_features.append(output)
+                if len(content_features) == len(self._content_loss_layers):
+                    break
+            elif not isinstance(layer, StyleLossLayer):
+                output = layer(output)
+        return content_features
+
+    def _estimate_activation_sizes(self) -> list[int]:
         """
-        Cuts all layers of the model after conv_layer_idx convolutional layers
-        :param conv_layer_idx: number of convolutional layers that has to be preserved
+        :return: size in bytes of output of every model layer for one input image of working size
         """
-        for model_layer_idx, layer in enumerate(self._model.children()):
+        channels, height, width = 3, *self._working_image_size
+        activation_sizes: list[int] = []
+        for layer in self._model.children():
             if isinstance(layer, nn.Conv2d):
-                conv_layer_idx -= 1
-            if conv_layer_idx + 1 == 0:
-                self._model = self._model[:model_layer_idx + 3]
-                return
-
-    def _initialize_available_models(self) -> None:
-        """
-        Initializes available base models for neural style transfer. Adds two dictionaries. first contains mapping from
-        model_type (str) to torch function that loads pretrained base model. Second contains mapping from model_type to
-        pretrained weights.
-        """
-        self._available_base_models: dict[str, tp.Any] = {
-            "vgg11": vgg11,
-            "vgg13": vgg13,
-            "vgg16": vgg16,
-            "vgg19": vgg19,
-        }
-        self._available_base_models_weights: dict[str, tp.Any] = {
-            "vgg11": VGG11_Weights.DEFAULT,
-            "vgg13": VGG13_Weights.DEFAULT,
-            "vgg16": VGG16_Weights.DEFAULT,
-            "vgg19": VGG19_Weights.DEFAULT,
-        }
+                channels = layer.out_channels
+                height = (height + 2 * layer.padding[0] - layer.dilation[0] * (layer.kernel_size[0] - 1) - 1) // layer.stride[0] + 1
+                width = (width + 2 * layer.padding[1] - layer.dilation[1] * (layer.kernel_size[1] - 1) - 1) // layer.stride[1] + 1
+            elif isinstance(layer, nn.MaxPool2d):
+                height = (height - layer.kernel_size) // layer.stride + 1
+                width = (width - layer.kernel_size) // layer.stride + 1
+            # Activations are float32 tensors
+            activation_sizes.append(channels * height * width * 4)
+        return activation_sizes
+
+    @staticmethod
+    def _split_into_segments(activation_sizes: list[int], memory_budget_bytes: int) -> list[tuple[int, int]]:
+        """
+        Finds the smallest number of segments, such that outputs of segments stored between forward and backward passes
+        plus activations of the largest recomputed segment fit into the budget
+        :param activation_sizes: size in bytes of output of every layer
+        :param memory_budget_bytes: target peak memory of activations
+        :return: list of [start, end) bounds of segments. Empty list if checkpointing isn't needed
+        """
+        total_size: int = sum(activation_sizes)
+        if total_size <= memory_budget_bytes:
+            return []
+
+        for num_segments in range(2, len(activation_sizes) + 1):
+            segment_bounds: list[tuple[int, int]] = []
+            segment_start, segment_size = 0, 0
+            for layer_idx, size in enumerate(activation_sizes):
+                segment_size += size
+                if segment_size >= total_size / num_segments and layer_idx + 1 < len(activation_sizes):
+                    segment_bounds.append((segment_start, layer_idx + 1))
+                    segment_start, segment_size = layer_idx + 1, 0
+            segment_bounds.append((segment_start, len(activation_sizes)))
+
+            stored_size: int = sum(activation_sizes[end - 1] for _, end in segment_bounds[:-1])
+            max_segment_size: int = max(sum(activation_sizes[start:end]) for start, end in segment_bounds)
+            if stored_size + max_segment_size <= memory_budget_bytes:
+                return segment_bounds
+        return [(layer_idx, layer_idx + 1) for layer_idx in range(len(activation_sizes))]
+
+    @staticmethod
+    def _get_layer_weights(layers_id: tp.Optional[list[int]], layer_weights: tp.Optional[list[float]], num_conv_layers: int) -> dict[int, float]:
+        """
+        :param layers_id: indexes of convolutional layers or None
+        :param layer_weights: weights of layers in order of layers_id or None for equal weights
+        :param num_conv_layers: number of convolutional layers in base model
+        :return: weights normalized to sum to 1 by sorted indexes of layers with positive weight
+        """
+        if layer_weights is None:
+            layers_id = NSTModel._validate_layers_id(layers_id, num_conv_layers)
+            layer_weights = [1.0] * len(layers_id)
+        assert layers_id is not None and len(layer_weights) == len(layers_id), "Every loss layer has to have one weight!"
+        assert len(set(layers_id)) == len(layers_id), f"Weighted loss layers have to be unique, but {layers_id} met!"
+        assert all(weight >= 0 for weight in layer_weights), f"Loss layers weights have to be non-negative, but {layer_weights} met!"
+        weights: dict[int, float] = {layer_idx: weight for layer_idx, weight in zip(layers_id, layer_weights) if weight > 0}
+        selected_layers_id: list[int] = NSTModel._validate_layers_id(list(weights), num_conv_layers)
+        total_weight: float = sum(weights.values())
+        return {layer_idx: weights[layer_idx] / total_weight for layer_idx in selected_layers_id}
+
+    @staticmethod
+    def _validate_layers_id(layers_id: tp.Optional[list[int]], num_conv_layers: int) -> list[int]:
+        """
+        :param layers_id: indexes of convolutional layers or None
+        :param num_conv_layers: number of convolutional layers in base model
+        :return: sorted unique indexes. All convolutional layers if layers_id is None
+        """
+        if layers_id is None:
+            return list(range(num_conv_layers))
+        assert len(layers_id) > 0, "At least one loss layer has to be selected!"
+        assert all(0 <= layer_idx < num_conv_layers for layer_idx in layers_id), \
+            f"Loss layers indexes have to be in [0, {num_conv_layers}), but {layers_id} met!"
+        return sorted(set(layers_id))
 
-    def _build_model(self, content_image: Image, style_image: Image, pretrained_model_type: str) -> nn.Module:
+    def _build_model(self, content_image: Image, style_image: Image, base_model: nn.Module,
+                     style_targets: tp.Optional[list[Tensor]] = None) -> nn.Module:
         """
-        Builds model that will be used for neural style_transfer
+        Builds model that will be used for neural style_transfer. Base model is truncated after the deepest requested
+        convolutional layer, and loss layers are inserted only at requested positions
         :param content_image: content image
         :param style_image: style image
-        :param pretrained_model_type: pretrained model type
+        :param base_model: pretrained base model
+        :param style_targets: precomputed style Gram matrices in order of style loss layers
         :return: neural style transfer model
         """
-        base_model: nn.Module = self._load_pretrained_base_model(pretrained_model_type)
         result = nn.Sequential()
+        cached_gram_matrices, gram_cache_keys = self._get_cached_style_targets(style_image, style_targets)
+        compute_style_targets: bool = any(gram_matrix is None for gram_matrix in cached_gram_matrices.values())
+
+        last_content_layer_idx: int = self._content_loss_layers_id[-1]
+        last_style_layer_idx: int = self._style_loss_layers_id[-1] if compute_style_targets else -1
+        last_layer_idx: int = max(self._content_loss_layers_id[-1], self._style_loss_layers_id[-1])
 
         current_content_tensor: Tensor = self._transforms(content_image).unsqueeze(0).to(Config.device)
-        current_style_tensor: Tensor = self._transforms(style_image).unsqueeze(0).to(Config.device)
+        current_style_tensor: tp.Optional[Tensor] = None
+        if compute_style_targets:
+            current_style_tensor = self._transforms(style_image).unsqueeze(0).to(Config.device)
 
-        idx: int = 0
-        for layer in base_model.children():
-            current_content_tensor = layer(current_content_tensor)
-            current_style_tensor = layer(current_style_tensor)
-            if isinstance(layer, nn.Conv2d):
-                result.append(layer)
-                result.append(ContentLossLayer(current_content_tensor).to(Config.device))
-                self._content_loss_layers.append(result[-1])
-                result.append(StyleLossLayer(current_style_tensor).to(Config.device))
-                self._style_loss_layers.append(result[-1])
-                idx += 1
-            elif isinstance(layer, nn.ReLU):
-                result.append(nn.ReLU())
-            else:
-                result.append(layer)
+        conv_layer_idx: int = 0
+        with torch.no_grad(), torch.autocast(Config.device.type, dtype=torch.bfloat16, enabled=self._precision == "bf16"):
+            for layer in base_model.children():
+                if conv_layer_idx <= last_content_layer_idx:
+                    current_content_tensor = layer(current_content_tensor)
+                if conv_layer_idx <= last_style_layer_idx:
+                    current_style_tensor = layer(current_style_tensor)
+
+                if isinstance(layer, nn.Conv2d):
+                    result.append(layer)
+                    self._append_loss_layers(result, conv_layer_idx, current_content_tensor, current_style_tensor, cached_gram_matrices,
+                                             gram_cache_keys)
+                    if conv_layer_idx == last_layer_idx:
+                        break
+                    conv_layer_idx += 1
+                elif isinstance(layer, nn.ReLU):
+                    result.append(nn.ReLU())
+                else:
+                    result.append(layer)
         return result
 
+    def _get_cached_style_targets(self, style_image: Image, style_targets: tp.Optional[list[Tensor]]
+                                  ) -> tuple[dict[int, tp.Optional[Tensor]], dict[int, GramMatrixCacheKey]]:
+        """
+        :param style_image: style image
+        :param style_targets: precomputed style Gram matrices in order of style loss layers
+        :return: Gram matrices by indexes of style loss layers, None if a Gram matrix isn't cached, and keys under which
+        computed Gram matrices are put into the cache. Keys are empty if targets are precomputed
+        """
+        if style_targets is not None:
+            assert len(style_targets) == len(self._style_loss_layers_id), "Number of style targets has to match number of style loss layers!"
+            return dict(zip(self._style_loss_layers_id, style_targets)), {}
+        style_image_hash: str = gram_matrix_cache.hash_image(style_image)
+        gram_cache_keys: dict[int, GramMatrixCacheKey] = {
+            conv_layer_idx: GramMatrixCacheKey(style_image_hash, self._pretrained_model_type, self._working_image_size, conv_layer_idx,
+                                               self._precision)
+            for conv_layer_idx in self._style_loss_layers_id
+        }
+        return {conv_layer_idx: gram_matrix_cache.get(key) for conv_layer_idx, key in gram_cache_keys.items()}, gram_cache_keys
+
+    def _append_loss_layers(self, model: nn.Sequential, conv_layer_idx: int, content_tensor: Tensor, style_tensor: tp.Optional[Tensor],
+                            cached_gram_matrices: dict[int, tp.Optional[Tensor]], gram_cache_keys: dict[int, GramMatrixCacheKey]) -> None:
+        """
+        Appends loss layers requested after the convolutional layer to the model
+        :param model: model being built
+        :param conv_layer_idx: index of the last appended convolutional layer
+        :param content_tensor: output of the layer for content image. It's copied to fp32, since in-place ReLU of shared
+        base model overwrites it on the next layer
+        :param style_tensor: output of the layer for style image. None if all Gram matrices are cached
+        :param cached_gram_matrices: Gram matrices by indexes of style loss layers
+        :param gram_cache_keys: cache keys by indexes of style loss layers
+        """
+        if conv_layer_idx in self._content_loss_layers_id:
+            model.append(ContentLossLayer(content_tensor.to(torch.float32, copy=True)).to(Config.device))
+            self._content_loss_layers.append(model[-1])
+        if conv_layer_idx not in cached_gram_matrices:
+            return
+        if style_tensor is not None:
+            model.append(StyleLossLayer(style_tensor).to(Config.device))
+            gram_matrix_cache.put(gram_cache_keys[conv_layer_idx], model[-1].target_gram_matrix)
+        else:
+            model.append(StyleLossLayer(target_gram_matrix=cached_gram_matrices[conv_layer_idx]).to(Config.device))
+        self._style_loss_layers.append(model[-1])
+
     def _load_pretrained_base_model(self, model_type: str) -> nn.Module:
         """
-        Loads selected pretrained model from torch hub. Now only vgg16 and vgg19 is implemented
+        Gets selected pretrained model from the process-wide registry. Its weights are frozen and shared between
+        all NSTModel instances, so they must not be modified
         :param model_type: type of base model.
         :return: base model.
         """
-        path_to_pretrained: Path = Config.path_to_backend / self._path_to_save_dir
-        if not path_to_pretrained.exists():
-            path_to_pretrained.mkdir(parents=True, exist_ok=True)
-
-        torch.hub.set_dir(str(path_to_pretrained))
-        if model_type.startswith("vgg"):
-            base_model: nn.Module = self._available_base_models[model_type](
-                weights=self._available_base_models_weights[model_type]
-            ).eval().features.to(Config.device)
-        else:
-            raise NotImplementedError("Only vgg models available as base models!")
-        return base_model
+        return backbone_registry.get(model_type)
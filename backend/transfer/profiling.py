@@ -0,0 +1,158 @@
+import time
+import torch
+import threading
+import contextlib
+import typing as tp
+
+from pathlib import Path
+from torch.profiler import ProfilerActivity, profile, record_function
+
+from backend.config import Config
+from backend.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+class JobProfiler:
+    """
+    Named timers of stages of one job and optional torch.profiler trace of a window of its iterations. Disabled
+    profiler doesn't measure anything, so it can be used unconditionally
+    """
+    def __init__(self,
+                 enabled: bool = False,
+                 name: str = "job",
+                 trace_start_iteration: int = Config.profiler_trace_start_iteration,
+                 trace_num_iterations: int = Config.profiler_trace_num_iterations,
+                 path_to_traces: Path = Config.path_to_profiler_traces) -> None:
+        """
+        :param enabled: whether stages are timed
+        :param name: name of the job, used as name of trace file
+        :param trace_start_iteration: iteration at which trace recording starts
+        :param trace_num_iterations: number of recorded iterations. 0 disables trace
+        :param path_to_traces: directory of Chrome trace files
+        """
+        self._enabled: bool = enabled
+        self._name: str = name
+        self._trace_start_iteration: int = trace_start_iteration
+        self._trace_num_iterations: int = trace_num_iterations
+        self._path_to_traces: Path = path_to_traces
+        self._totals: dict[str, float] = {}
+        self._counts: dict[str, int] = {}
+        # Number of active executions of every stage. Stages are entered by the thread of the job, but backward pass may
+        # run on autograd device threads, so it's not thread-local
+        self._active_stages: dict[str, int] = {}
+        self._lock: threading.Lock = threading.Lock()
+        self._trace: tp.Optional[profile] = None
+        self._trace_thread_id: tp.Optional[int] = None
+        self._is_trace_recorded: bool = False
+
+    def is_enabled(self) -> bool:
+        return self._enabled
+
+    def is_stage_active(self, stage_name: str) -> bool:
+        """
+        :param stage_name: name of the stage
+        :return: whether the stage is being measured now, e.g. to skip stages nested into it
+        """
+        with self._lock:
+            return self._active_stages.get(stage_name, 0) > 0
+
+    def record(self, stage_name: str, seconds: float) -> None:
+        """
+        :param stage_name: name of the stage
+        :param seconds: duration of one execution of the stage
+        """
+        if not self._enabled:
+            return
+        with self._lock:
+            self._totals[stage_name] = self._totals.get(stage_name, 0.0) + seconds
+            self._counts[stage_name] = self._counts.get(stage_name, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, stage_name: str) -> tp.Iterator[None]:
+        """
+        Measures wall time of the stage. Can wrap awaits, e.g. encoding and decoding in the executor
+        """
+        if not self._enabled:
+            yield
+            return
+        start_time: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage_name, time.perf_counter() - start_time)
+
+    @contextlib.contextmanager
+    def stage(self, stage_name: str) -> tp.Iterator[None]:
+        """
+        Measures device work of the stage. Device is synchronized before and after the stage, so asynchronous kernels are
+        attributed to the stage that launched them. The stage is also named in torch.profiler trace. Stages may be nested
+        """
+        if not self._enabled:
+            yield
+            return
+        self._synchronize()
+        start_time: float = time.perf_counter()
+        with self._lock:
+            self._active_stages[stage_name] = self._active_stages.get(stage_name, 0) + 1
+        try:
+            with record_function(stage_name):
+                yield
+                self._synchronize()
+        finally:
+            with self._lock:
+                self._active_stages[stage_name] -= 1
+            self.record(stage_name, time.perf_counter() - start_time)
+
+    def step(self, iteration: int) -> None:
+        """
+        Starts or stops trace recording. Called after every iteration by the thread that runs the transfer
+        :param iteration: number of iterations made
+        """
+        if not self._enabled or self._trace_num_iterations <= 0 or self._is_trace_recorded:
+            return
+        if self._trace is None and iteration >= self._trace_start_iteration:
+            with self._lock:
+                if self._trace is not None:
+                    return
+                activities: list[ProfilerActivity] = [ProfilerActivity.CPU]
+                if Config.device.type == "cuda":
+                    activities.append(ProfilerActivity.CUDA)
+                self._trace = profile(activities=activities, record_shapes=True)
+                self._trace_thread_id = threading.get_ident()
+            self._trace.start()
+        elif iteration >= self._trace_start_iteration + self._trace_num_iterations:
+            self.finish()
+
+    def finish(self) -> None:
+        """
+        Stops trace recording, if it was started by the current thread, and writes the trace to the trace directory
+        """
+        if self._trace is None or self._trace_thread_id != threading.get_ident() or self._is_trace_recorded:
+            return
+        self._is_trace_recorded = True
+        self._trace.stop()
+        self._path_to_traces.mkdir(parents=True, exist_ok=True)
+        path_to_trace: Path = self._path_to_traces / f"{self._name}.json"
+        self._trace.export_chrome_trace(str(path_to_trace))
+        logger.info(f"Saved profiler trace to {path_to_trace}.")
+
+    def get_summary(self) -> dict[str, dict[str, float]]:
+        """
+        :return: total time, number of executions and mean time of every stage in order of first execution
+        """
+        with self._lock:
+            return {
+                stage_name: {
+                    "total_seconds": round(total, 6),
+                    "count": self._counts[stage_name],
+                    "mean_seconds": round(total / self._counts[stage_name], 6),
+                }
+                for stage_name, total in self._totals.items()
+            }
+
+    @staticmethod
+    def _synchronize() -> None:
+        if Config.device.type == "cuda":
+            torch.cuda.synchronize(Config.device)
@@ -0,0 +1,79 @@
+import torch
+import threading
+import typing as tp
+
+from torch import Tensor
+from PIL.Image import Image
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.functional import interpolate
+from torchvision.transforms import ToPILImage
+
+from backend.config import Config
+
+
+preview_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=Config.max_preview_workers, thread_name_prefix="preview_renderer")
+
+
+def get_preview_size(image_size: tuple[int, int], max_size: tp.Optional[int] = None) -> tuple[int, int]:
+    """
+    :param image_size: (height, width) of the image
+    :param max_size: if set, image is downscaled so its larger side is not more than max_size
+    :return: (height, width) of the preview
+    """
+    if max_size is None or max(image_size) <= max_size:
+        return image_size
+    scale: float = max_size / max(image_size)
+    return max(1, round(image_size[0] * scale)), max(1, round(image_size[1] * scale))
+
+
+def render_image(tensor: Tensor, image_size: tuple[int, int]) -> Image:
+    """
+    Resizes normalized image tensor, then denormalizes it, so denormalization is done at the output size
+    :param tensor: [1, 3, H, W] normalized image
+    :param image_size: (height, width) of the result
+    :return: image
+    """
+    with torch.no_grad():
+        if tuple(tensor.shape[-2:]) != image_size:
+            tensor = interpolate(tensor, size=image_size, mode="bilinear", align_corners=False, antialias=True)
+        tensor = (tensor * Config.normalization_std + Config.normalization_mean).clamp(0, 1)
+    return ToPILImage()(tensor.squeeze(0).cpu())
+
+
+class SnapshotBuffer:
+    """
+    Preallocated double buffer for snapshots of the tensor being optimized. Snapshot is copied on device at step
+    boundary, so the optimizer can continue, while preview worker renders another buffer. If both buffers are being
+    rendered, new snapshot is skipped
+    """
+    def __init__(self) -> None:
+        self._buffers: list[tp.Optional[Tensor]] = [None, None]
+        self._is_busy: list[bool] = [False, False]
+        self._lock: threading.Lock = threading.Lock()
+
+    def take(self, tensor: Tensor) -> tp.Optional[int]:
+        """
+        Copies tensor into a free buffer. Buffer is reallocated only if shape of the tensor has changed
+        :param tensor: tensor to copy
+        :return: index of the buffer or None if both buffers are busy
+        """
+        with self._lock:
+            free_buffers_idx: list[int] = [idx for idx, is_busy in enumerate(self._is_busy) if not is_busy]
+            if not free_buffers_idx:
+                return None
+            buffer_idx: int = free_buffers_idx[0]
+            self._is_busy[buffer_idx] = True
+
+        buffer: tp.Optional[Tensor] = self._buffers[buffer_idx]
+        if buffer is None or buffer.shape != tensor.shape or buffer.device != tensor.device:
+            buffer = self._buffers[buffer_idx] = torch.empty(tensor.shape, dtype=tensor.dtype, device=tensor.device)
+        # On GPU the copy is enqueued on the same stream as optimization, so it sees the tensor exactly at the step boundary
+        buffer.copy_(tensor.detach(), non_blocking=True)
+        return buffer_idx
+
+    def get(self, buffer_idx: int) -> Tensor:
+        return self._buffers[buffer_idx]
+
+    def release(self, buffer_idx: int) -> None:
+        with self._lock:
+            self._is_busy[buffer_idx] = False
@@ -0,0 +1,88 @@
+import torch
+import threading
+import typing as tp
+
+from torch import Tensor
+from collections import deque
+from dataclasses import dataclass
+
+from backend.config import Config
+from backend.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class LossRecord:
+    iteration: int
+    content_loss: float
+    style_loss: float
+    total_loss: float
+
+
+class LossRingBuffer:
+    """
+    Per-iteration losses of one job. Losses are accumulated on device without synchronization and are read back
+    to host in batches, when at least flush_interval iterations passed since the previous read back
+    """
+    def __init__(self, flush_interval: int = Config.loss_telemetry_interval, max_history_size: int = Config.max_loss_history_size,
+                 username: tp.Optional[str] = None) -> None:
+        """
+        :param flush_interval: number of iterations between read backs. It's also the size of the device buffer
+        :param max_history_size: maximum number of records kept on host. The oldest records are dropped
+        :param username: username for log records
+        """
+        self._flush_interval: int = flush_interval
+        self._username: tp.Optional[str] = username
+        self._buffer: tp.Optional[Tensor] = None
+        self._pending_iterations: list[int] = []
+        self._last_flush_iteration: int = 0
+        self._history: deque[LossRecord] = deque(maxlen=max_history_size)
+        self._lock: threading.Lock = threading.Lock()
+
+    def append(self, iteration: int, losses: Tensor) -> list[LossRecord]:
+        """
+        :param iteration: number of iterations made
+        :param losses: [3] tensor of content, style and total loss on any device
+        :return: records read back to host by this call. Empty list if there was no read back
+        """
+        if self._buffer is None or self._buffer.device != losses.device:
+            self._buffer = torch.empty(self._flush_interval, 3, device=losses.device)
+        self._buffer[len(self._pending_iterations)].copy_(losses.detach())
+        self._pending_iterations.append(iteration)
+        if len(self._pending_iterations) == self._flush_interval or iteration - self._last_flush_iteration >= self._flush_interval:
+            return self.flush()
+        return []
+
+    def flush(self) -> list[LossRecord]:
+        """
+        Reads pending losses back to host with one synchronization
+        :return: read back records
+        """
+        if not self._pending_iterations:
+            return []
+        values: list[list[float]] = self._buffer[:len(self._pending_iterations)].tolist()
+        records: list[LossRecord] = [LossRecord(iteration, *losses) for iteration, losses in zip(self._pending_iterations, values)]
+        with self._lock:
+            self._history.extend(records)
+        self._last_flush_iteration = records[-1].iteration
+        self._pending_iterations = []
+        logger.debug("", extra={"username": self._username, "content_loss": records[-1].content_loss,
+                                "style_loss": records[-1].style_loss, "total_loss": records[-1].total_loss})
+        return records
+
+    def get_history(self, since_iteration: int = 0) -> list[LossRecord]:
+        """
+        Can be called from any thread
+        :param since_iteration: only records of later iterations are returned
+        :return: records read back to host
+        """
+        with self._lock:
+            return [record for record in self._history if record.iteration > since_iteration]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._history.clear()
+        self._pending_iterations = []
+        self._last_flush_iteration = 0
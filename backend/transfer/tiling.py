@@ -0,0 +1,295 @@
+import math
+import time
+import torch
+import asyncio
+import typing as tp
+
+from torch import Tensor
+from PIL.Image import Image
+from functools import partial
+from torchvision.transforms import ToTensor, ToPILImage
+
+from backend.config import Config
+from backend.logger import get_logger
+from backend.metrics import format_image_size
+from backend.transfer.nst_model import NSTModel
+from backend.transfer.snapshots import get_preview_size, preview_executor
+from backend.transfer.telemetry import LossRecord
+from backend.transfer.transfer import StyleTransferProcessor, TransferState
+
+
+logger = get_logger(__name__)
+
+
+def split_into_tiles(image_size: tuple[int, int], tile_size: tuple[int, int], overlap: int) -> list[tuple[int, int, int, int]]:
+    """
+    Splits image into overlapping tiles. Tiles at the right and bottom borders are shifted, so all tiles have the same size
+    :param image_size: (width, height) of the image
+    :param tile_size: (height, width) of the tile. Same order as in Config.working_image_size
+    :param overlap: minimum overlap of neighbouring tiles in pixels
+    :return: list of (left, top, right, bottom) boxes of tiles
+    """
+    width, height = image_size
+    tile_height, tile_width = min(tile_size[0], height), min(tile_size[1], width)
+    return [
+        (left, top, left + tile_width, top + tile_height)
+        for top in _get_tile_starts(height, tile_height, overlap)
+        for left in _get_tile_starts(width, tile_width, overlap)
+    ]
+
+
+def _get_tile_starts(length: int, tile_length: int, overlap: int) -> list[int]:
+    assert overlap < tile_length, f"Overlap of tiles has to be less than tile size {tile_length}, but {overlap} met!"
+    if length <= tile_length:
+        return [0]
+    return list(range(0, length - tile_length, tile_length - overlap)) + [length - tile_length]
+
+
+def blend_tiles(tiles: list[tuple[tuple[int, int, int, int], Image]], image_size: tuple[int, int], overlap: int) -> Image:
+    """
+    Blends tiles into one image. Inside overlaps weights of tiles linearly decrease towards tile borders, so there are no seams
+    :param tiles: list of tile boxes and tile images
+    :param image_size: (width, height) of the result image
+    :param overlap: overlap of neighbouring tiles in pixels
+    :return: blended image
+    """
+    width, height = image_size
+    result: Tensor = torch.zeros(3, height, width)
+    weights_sum: Tensor = torch.zeros(1, height, width)
+    for (left, top, right, bottom), tile in tiles:
+        weights: Tensor = torch.outer(
+            _get_blending_ramp(bottom - top, overlap if top > 0 else 0, overlap if bottom < height else 0),
+            _get_blending_ramp(right - left, overlap if left > 0 else 0, overlap if right < width else 0),
+        ).unsqueeze(0)
+        result[:, top:bottom, left:right] += ToTensor()(tile) * weights
+        weights_sum[:, top:bottom, left:right] += weights
+    return ToPILImage()(result / weights_sum.clamp_min(1e-8))
+
+
+def _get_blending_ramp(length: int, start_overlap: int, end_overlap: int) -> Tensor:
+    positions: Tensor = torch.arange(1, length + 1, dtype=torch.float32)
+    ramp: Tensor = torch.ones(length)
+    if start_overlap > 0:
+        ramp = torch.minimum(ramp, positions / (start_overlap + 1))
+    if end_overlap > 0:
+        ramp = torch.minimum(ramp, positions.flip(0) / (end_overlap + 1))
+    return ramp
+
+
+class TiledStyleTransferProcessor:
+    """
+    Style transfer for images that are larger than working size. Content image is split into overlapping tiles of working
+    size. Every tile is optimized at native resolution against global style Gram matrices, which are computed once and
+    shared by all tiles, and then tiles are blended. At most Config.max_parallel_tiles tiles are in memory at once
+    """
+    def __init__(self) -> None:
+        self._username: tp.Optional[str] = None
+        self._content_image: tp.Optional[Image] = None
+        self._style_image: tp.Optional[Image] = None
+        self._num_iteration: tp.Optional[int] = None
+        self._collect_content_loss_layers: tp.Optional[list[int]] = None
+        self._collect_style_loss_layers: tp.Optional[list[int]] = None
+        self._alpha: tp.Optional[float] = None
+        self._processor_kwargs: dict[str, tp.Any] = {}
+        self._state_interval: float = Config.transfer_state_interval
+        self._preview_max_size: tp.Optional[int] = None
+        self._tile_boxes: list[tuple[int, int, int, int]] = []
+        self._style_targets: tp.Optional[list[Tensor]] = None
+        self._tile_processors: dict[int, StyleTransferProcessor] = {}
+        self._tile_results: dict[int, Image] = {}
+        self._tile_num_iterations: list[int] = []
+        self._tile_stop_reasons: list[str] = []
+        # Preview-sized content image with downscaled transferred tiles pasted into it and indexes of these tiles
+        self._preview_image: tp.Optional[Image] = None
+        self._preview_tiles: set[int] = set()
+        self._peak_memory_bytes: int = 0
+        self._transfer_states: tp.Optional[asyncio.Queue] = None
+
+    def configure(self,
+                  username: str,
+                  content_image: Image,
+                  style_image: Image,
+                  num_iteration: int,
+                  collect_content_loss_layers: list[int],
+                  collect_style_loss_layers: list[int],
+                  alpha: float,
+                  pretrained_model_type: str = "vgg11",
+                  state_interval: tp.Optional[float] = None,
+                  preview_max_size: tp.Optional[int] = None,
+                  **processor_kwargs: tp.Any) -> "TiledStyleTransferProcessor":
+        """
+        Configures tiled transfer. Parameters are the same as in StyleTransferProcessor.configure(). Intermediate states
+        of tiles aren't published, previews of the whole image are published instead
+        """
+        self._username = username
+        self._content_image = content_image
+        self._style_image = style_image
+        self._num_iteration = num_iteration
+        self._collect_content_loss_layers = collect_content_loss_layers
+        self._collect_style_loss_layers = collect_style_loss_layers
+        self._alpha = alpha
+        self._processor_kwargs = {"pretrained_model_type": pretrained_model_type, **processor_kwargs}
+        self._state_interval = state_interval if state_interval is not None else Config.transfer_state_interval
+        self._preview_max_size = preview_max_size
+        self._tile_boxes = split_into_tiles(content_image.size, Config.working_image_size, Config.tile_overlap)
+        self._transfer_states = asyncio.Queue()
+
+        _, self._style_targets = NSTModel(
+            username,
+            content_image.crop(self._tile_boxes[0]),
+            style_image,
+            content_loss_layers_id=collect_content_loss_layers,
+            style_loss_layers_id=collect_style_loss_layers,
+            pretrained_model_type=pretrained_model_type,
+            content_layer_weights=processor_kwargs.get("content_layer_weights"),
+            style_layer_weights=processor_kwargs.get("style_layer_weights"),
+            precision=processor_kwargs["precision"] if processor_kwargs.get("precision") is not None else Config.precision,
+        ).get_targets()
+        logger.debug(f"TiledStyleTransferProcessor was configured with {len(self._tile_boxes)} tiles.", extra={"username": username})
+        return self
+
+    async def transfer_style(self) -> Image:
+        """
+        Transfers style of all tiles, at most Config.max_parallel_tiles at once, and blends them
+        :return: result image
+        """
+        assert self._transfer_states is not None, "TiledStyleTransferProcessor is not configured! Call configure() method!"
+        self._tile_results, self._tile_num_iterations, self._tile_stop_reasons = {}, [], []
+        self._preview_image, self._preview_tiles = None, set()
+        tile_slots = asyncio.Semaphore(Config.max_parallel_tiles)
+        states_publishing_task: asyncio.Task = asyncio.create_task(self._publish_transfer_states())
+        try:
+            await asyncio.gather(*(self._transfer_tile(tile_idx, tile_slots) for tile_idx in range(len(self._tile_boxes))))
+        finally:
+            states_publishing_task.cancel()
+            self._put_transfer_state(None)
+
+        tiles: list[tuple[tuple[int, int, int, int], Image]] = [(box, self._tile_results[idx]) for idx, box in enumerate(self._tile_boxes)]
+        return await asyncio.get_running_loop().run_in_executor(
+            None, blend_tiles, tiles, self._content_image.size, Config.tile_overlap,
+        )
+
+    async def get_transfer_states(self) -> tp.AsyncGenerator[TransferState, None]:
+        assert self._transfer_states is not None, "TiledStyleTransferProcessor is not configured! Call configure() method!"
+        while True:
+            state: tp.Optional[TransferState] = await self._transfer_states.get()
+            if state is None:
+                return
+            yield state
+
+    def get_current_transfer_status(self) -> int:
+        completed_tiles_status: int = 100 * len(self._tile_results)
+        running_tiles_status: int = sum(processor.get_current_transfer_status() for processor in list(self._tile_processors.values()))
+        return (completed_tiles_status + running_tiles_status) // len(self._tile_boxes)
+
+    def get_num_completed_iterations(self) -> int:
+        """
+        :return: average number of iterations made per tile
+        """
+        if not self._tile_num_iterations:
+            return 0
+        return round(sum(self._tile_num_iterations) / len(self._tile_num_iterations))
+
+    def get_stop_reason(self) -> tp.Optional[str]:
+        if not self._tile_stop_reasons:
+            return None
+        if "stopped" in self._tile_stop_reasons:
+            return "stopped"
+        if all(stop_reason == "converged" for stop_reason in self._tile_stop_reasons):
+            return "converged"
+        return "completed"
+
+    def get_loss_history(self, since_iteration: int = 0) -> list[LossRecord]:
+        """
+        :return: empty list, since tiles are optimized independently and their losses aren't comparable with each other
+        """
+        return []
+
+    def get_metric_labels(self) -> dict[str, str]:
+        """
+        :return: labels of metrics of the job. Working size is the size of tiles
+        """
+        return {
+            "backbone": self._processor_kwargs.get("pretrained_model_type", "vgg11"),
+            "working_size": format_image_size(Config.working_image_size),
+        }
+
+    def get_iterations_per_second(self) -> float:
+        """
+        :return: total number of iterations per second of running tiles
+        """
+        return sum(processor.get_iterations_per_second() for processor in list(self._tile_processors.values()))
+
+    def get_peak_memory_usage(self) -> int:
+        return self._peak_memory_bytes
+
+    async def _transfer_tile(self, tile_idx: int, tile_slots: asyncio.Semaphore) -> None:
+        async with tile_slots:
+            box: tuple[int, int, int, int] = self._tile_boxes[tile_idx]
+            processor = StyleTransferProcessor()
+            await asyncio.get_running_loop().run_in_executor(None, partial(
+                processor.configure,
+                self._username,
+                self._content_image.crop(box),
+                self._style_image,
+                self._num_iteration,
+                self._collect_content_loss_layers,
+                self._collect_style_loss_layers,
+                self._alpha,
+                working_image_size=(box[3] - box[1], box[2] - box[0]),
+                style_targets=self._style_targets,
+                # Previews of tiles aren't consumed, so they aren't rendered
+                state_interval=math.inf,
+                **self._processor_kwargs,
+            ))
+            self._tile_processors[tile_idx] = processor
+            try:
+                self._tile_results[tile_idx] = await processor.transfer_style()
+            finally:
+                del self._tile_processors[tile_idx]
+            self._tile_num_iterations.append(processor.get_num_completed_iterations())
+            self._tile_stop_reasons.append(processor.get_stop_reason())
+            self._peak_memory_bytes = max(self._peak_memory_bytes, processor.get_peak_memory_usage())
+
+    async def _publish_transfer_states(self) -> None:
+        """
+        Periodically publishes content image with already transferred tiles pasted into it
+        """
+        while True:
+            await asyncio.sleep(self._state_interval)
+            start_time: float = time.monotonic()
+            preview: Image = await asyncio.get_running_loop().run_in_executor(preview_executor, self._render_preview)
+            self._put_transfer_state(TransferState(preview, self.get_current_transfer_status(), self.get_num_completed_iterations()))
+            logger.debug(f"Built tiled transfer preview in {time.monotonic() - start_time:.2f}s.", extra={"username": self._username})
+
+    def _put_transfer_state(self, state: tp.Optional[TransferState]) -> None:
+        """
+        Puts state to the queue. Only the latest states are kept, if nobody consumes them
+        :param state: preview of the transfer or None, which marks its end
+        """
+        while self._transfer_states.qsize() >= Config.max_pending_transfer_states:
+            self._transfer_states.get_nowait()
+        self._transfer_states.put_nowait(state)
+
+    def _render_preview(self) -> Image:
+        """
+        Pastes newly transferred tiles into preview-sized content image. Every tile is downscaled only once, so rendering
+        doesn't depend on resolution of content image. Runs in preview executor, so the event loop isn't blocked
+        :return: copy of the preview
+        """
+        width, height = self._content_image.size
+        preview_height, preview_width = get_preview_size((height, width), self._preview_max_size)
+        if self._preview_image is None:
+            self._preview_image = self._content_image.resize((preview_width, preview_height))
+        for tile_idx, tile in list(self._tile_results.items()):
+            if tile_idx in self._preview_tiles:
+                continue
+            left, top, right, bottom = self._tile_boxes[tile_idx]
+            preview_box: tuple[int, int, int, int] = (
+                round(left * preview_width / width), round(top * preview_height / height),
+                round(right * preview_width / width), round(bottom * preview_height / height),
+            )
+            tile_size: tuple[int, int] = (max(1, preview_box[2] - preview_box[0]), max(1, preview_box[3] - preview_box[1]))
+            self._preview_image.paste(tile.resize(tile_size), preview_box[:2])
+            self._preview_tiles.add(tile_idx)
+        return self._preview_image.copy()
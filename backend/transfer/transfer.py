@@ -1,32 +1,111 @@
-import asyncio
+import time
 import torch
+import asyncio
+import contextlib
+import threading
 import typing as tp
 
 from torch import Tensor
 from PIL.Image import Image
-from torch.optim import Optimizer, Adam
-from torchvision.transforms import Compose, Normalize, ToTensor, ToPILImage, Resize
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from torch.optim import Optimizer, Adam, AdamW, RMSprop, LBFGS
+from torch.nn.functional import interpolate
+from torchvision.transforms import Compose, Normalize, ToTensor, Resize
 
 from backend.config import Config
 from backend.logger import get_logger
-from backend.transfer import NSTModel
+from backend.metrics import Counter, metrics_registry, format_image_size
+from backend.transfer.nst_model import NSTModel
+from backend.transfer.memory import JobMemoryTracker, SavedTensorsCounter, get_tensors_bytes
+from backend.transfer.early_stopping import EarlyStopping
+from backend.transfer.profiling import JobProfiler
+from backend.transfer.telemetry import LossRecord, LossRingBuffer
+from backend.transfer.snapshots import SnapshotBuffer, get_preview_size, render_image, preview_executor
+from backend.transfer.batching import BatchKey, BatchedTransferEngine
 
 
 logger = get_logger(__name__)
 
 
+def get_max_transfer_workers() -> int:
+    """
+    Optimization loop of a job or a batch of jobs occupies its worker until the transfer ends. Tiled jobs run several tiles
+    at once. So the executor has a worker for every job that can be started by the scheduler, otherwise started jobs
+    would wait for a worker without progress and queue position
+    :return: number of worker threads of transfer executor
+    """
+    return Config.max_running_jobs * (Config.max_parallel_tiles if Config.tiled_transfer else 1)
+
+
+transfer_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=get_max_transfer_workers(), thread_name_prefix="style_transfer")
+batched_transfer_engine: BatchedTransferEngine = BatchedTransferEngine(transfer_executor)
+iterations_total: Counter = metrics_registry.counter(
+    "nst_iterations_total", "Forward and backward passes made by all style transfer jobs", ["backbone", "working_size"],
+)
+
+
+@dataclass
+class TransferState:
+    image: Image
+    completeness: int
+    num_iterations: int
+
+
+@dataclass
+class TransferStepInputs:
+    """
+    Inputs of forward pass of one optimization step of a job
+    """
+    input_tensor: Tensor
+    alpha: Tensor
+
+
 class StyleTransferProcessor:
     def __init__(self) -> None:
         self._username: tp.Optional[str] = None
+        self._pretrained_model_type: tp.Optional[str] = None
         self._nst_model: tp.Optional[NSTModel] = None
         self._input_tensor: tp.Optional[Tensor] = None
         self._optimizer: tp.Optional[Optimizer] = None
+        self._optimizer_type: str = "adam"
         self._num_iteration: tp.Optional[int] = None
         self._collect_content_loss_layers: tp.Optional[list[int]] = None
         self._collect_style_loss_layers: tp.Optional[list[int]] = None
+        self._content_layer_weights: tp.Optional[list[float]] = None
+        self._style_layer_weights: tp.Optional[list[float]] = None
         self._alpha: tp.Optional[Tensor] = None
         self._init_content_image_size: tp.Optional[tuple[int, int]] = None
         self._transfer_status: int = 0
+        self._event_loop: tp.Optional[asyncio.AbstractEventLoop] = None
+        self._transfer_states: tp.Optional[asyncio.Queue] = None
+        self._stop_event: threading.Event = threading.Event()
+        self._last_state_time: float = 0.0
+        self._transfer_start_time: float = 0.0
+        self._memory_budget_bytes: tp.Optional[int] = None
+        self._memory_tracker: JobMemoryTracker = JobMemoryTracker()
+        # Size of tensors saved for backward pass during the current step
+        self._saved_tensors_bytes: int = 0
+        self._content_image: tp.Optional[Image] = None
+        self._style_image: tp.Optional[Image] = None
+        self._working_image_size: tuple[int, int] = Config.working_image_size
+        self._final_working_image_size: tuple[int, int] = Config.working_image_size
+        self._style_targets: tp.Optional[list[Tensor]] = None
+        self._state_interval: float = Config.transfer_state_interval
+        self._preview_max_size: tp.Optional[int] = None
+        self._snapshot_buffer: SnapshotBuffer = SnapshotBuffer()
+        self._is_transfer_states_closed: bool = False
+        self._pyramid_levels: list[tuple[tuple[int, int], int]] = []
+        self._pyramid_level_idx: int = 0
+        self._early_stopping: tp.Optional[EarlyStopping] = None
+        self._last_losses: tp.Optional[Tensor] = None
+        self._loss_history: LossRingBuffer = LossRingBuffer()
+        self._stop_reason: tp.Optional[str] = None
+        self._num_completed_iterations: int = 0
+        self._profiler: JobProfiler = JobProfiler()
+        self._precision: str = Config.precision
+        self._step_compiler: tp.Optional[str] = None
+        self._is_step_compiled: bool = False
 
     def configure(self,
                   username: str,
@@ -36,70 +115,497 @@ class StyleTransferProcessor:
                   collect_content_loss_layers: list[int],
                   collect_style_loss_layers: list[int],
                   alpha: float,
-                  pretrained_model_type: str = "vgg11") -> "StyleTransferProcessor":
+                  pretrained_model_type: str = "vgg11",
+                  memory_budget_bytes: tp.Optional[int] = Config.memory_budget_bytes,
+                  use_pyramid: bool = Config.use_pyramid,
+                  optimizer_type: str = "adam",
+                  early_stopping: bool = Config.early_stopping,
+                  working_image_size: tuple[int, int] = Config.working_image_size,
+                  style_targets: tp.Optional[list[Tensor]] = None,
+                  state_interval: tp.Optional[float] = None,
+                  preview_max_size: tp.Optional[int] = None,
+                  profiler: tp.Optional[JobProfiler] = None,
+                  precision: tp.Optional[str] = None,
+                  content_layer_weights: tp.Optional[list[float]] = None,
+                  style_layer_weights: tp.Optional[list[float]] = None) -> "StyleTransferProcessor":
+        """
+        Configures style transfer. Parameters of optimization are documented in NSTModel. Intermediate states are
+        published not more often than every state_interval seconds (Config.transfer_state_interval if not set) and
+        are downscaled so their larger side is not more than preview_max_size. The result always has the size of content image.
+        If enabled profiler is set, stages of the transfer are timed and the job isn't batched with other jobs. precision of
+        forward pass is one of Config.available_precisions (Config.precision if not set). Optimization step is compiled
+        by Config.step_compiler, unless the model is checkpointed
+        """
+        precision = precision if precision is not None else Config.precision
+        assert optimizer_type in Config.available_optimizers, f"Only {Config.available_optimizers} optimizers are available!"
+        assert precision in Config.available_precisions, f"Only {Config.available_precisions} precisions are available!"
+        assert Config.step_compiler is None or Config.step_compiler in Config.available_step_compilers, \
+            f"Only {Config.available_step_compilers} step compilers are available!"
+        assert Config.step_compiler != "torchscript" or precision == "fp32", "TorchScript step supports only fp32 precision!"
+        self._step_compiler = Config.step_compiler
+        self._precision = precision
         self._username = username
-        self._nst_model = NSTModel(username, content_image, style_image, pretrained_model_type=pretrained_model_type)
-
-        self._input_tensor = Compose([
-            ToTensor(),
-            Normalize(mean=Config.normalization_mean, std=Config.normalization_std),
-            Resize(Config.working_image_size),
-        ])(content_image).view(1, 3, *Config.working_image_size).to(Config.device)
-        self._input_tensor.requires_grad = True
-
-        self._optimizer = Adam([self._input_tensor], lr=0.01)
+        self._optimizer_type = optimizer_type
+        self._pretrained_model_type = pretrained_model_type
+        self._content_image = content_image
+        self._style_image = style_image
         self._num_iteration = num_iteration
         self._collect_content_loss_layers = collect_content_loss_layers
         self._collect_style_loss_layers = collect_style_loss_layers
+        self._content_layer_weights = content_layer_weights
+        self._style_layer_weights = style_layer_weights
         self._alpha = torch.tensor(alpha, device=Config.device, dtype=torch.float32)
-        self._nst_model.cut_model(max(self._collect_style_loss_layers + self._collect_content_loss_layers))
         self._init_content_image_size = content_image.size[::-1]
+        self._transfer_states = asyncio.Queue()
+        self._memory_budget_bytes = memory_budget_bytes
+        self._early_stopping = EarlyStopping() if early_stopping else None
+        self._loss_history = LossRingBuffer(Config.loss_telemetry_interval, Config.max_loss_history_size, username)
+        self._final_working_image_size = working_image_size
+        self._style_targets = style_targets
+        self._state_interval = state_interval if state_interval is not None else Config.transfer_state_interval
+        self._preview_max_size = preview_max_size
+        self._profiler = profiler if profiler is not None else JobProfiler()
+
+        self._pyramid_levels = self._get_pyramid_levels(num_iteration) if use_pyramid else [(working_image_size, num_iteration)]
+        self._configure_pyramid_level(0)
         logger.debug("StyleTransferProcessor was successfully configured with parameters:", extra={"username": self._username})
         logger.debug(f"NUM_ITERATIONS: {self._num_iteration}", extra={"username": self._username})
         logger.debug(f"CONTENT_LOSS_LAYERS: {self._collect_content_loss_layers}", extra={"username": self._username})
         logger.debug(f"STYLE_LOSS_LAYERS: {self._collect_style_loss_layers}", extra={"username": self._username})
+        logger.debug(f"LOSS_LAYERS_WEIGHTS: {self._content_layer_weights}, {self._style_layer_weights}", extra={"username": self._username})
         logger.debug(f"ALPHA: {self._alpha}", extra={"username": self._username})
+        logger.debug(f"OPTIMIZER: {self._optimizer_type}", extra={"username": self._username})
+        logger.debug(f"PRECISION: {self._precision}", extra={"username": self._username})
+        logger.debug(f"STEP_COMPILER: {self._step_compiler}", extra={"username": self._username})
+        logger.debug(f"PYRAMID_LEVELS: {self._pyramid_levels}", extra={"username": self._username})
         return self
 
-    def get_current_image(self) -> Image:
+    def get_current_image(self, max_size: tp.Optional[int] = None) -> Image:
+        """
+        :param max_size: if set, image is downscaled so its larger side is not more than max_size
+        :return: current image of the size of content image
+        """
         assert self._input_tensor is not None, "StyleTransferProcessor is not configured! Call configure() method!"
         assert self._transfer_status != 0, "StyleTransferProcessor isn't transferring now!"
 
         logger.debug("Get current style transfer result.", extra={"username": self._username})
+        return render_image(self._input_tensor.detach(), get_preview_size(self._init_content_image_size, max_size))
 
-        current_img_tensor: Tensor = self._input_tensor.detach() * Config.normalization_std + Config.normalization_mean
-        current_img_tensor = current_img_tensor.clamp(0, 1).squeeze(0)
-        return Compose([
-            Resize(self._init_content_image_size),
-            ToPILImage(),
-        ])(current_img_tensor.cpu())
+    def get_peak_memory_usage(self) -> int:
+        """
+        :return: peak memory usage in bytes of the last transfer. It's measured as documented in JobMemoryTracker
+        """
+        return self._memory_tracker.get_peak_bytes()
+
+    def get_num_completed_iterations(self) -> int:
+        """
+        :return: number of iterations actually made during the last transfer
+        """
+        return self._num_completed_iterations
+
+    def get_stop_reason(self) -> tp.Optional[str]:
+        """
+        :return: reason why the last transfer was finished: "completed", "converged" or "stopped"
+        """
+        return self._stop_reason
+
+    def get_loss_history(self, since_iteration: int = 0) -> list[LossRecord]:
+        """
+        Can be called while transfer is running. Losses are read back to host every loss_telemetry_interval iterations,
+        so the latest ones may be missing
+        :param since_iteration: only losses of later iterations are returned
+        :return: content, style and total losses of the current or the last transfer
+        """
+        return self._loss_history.get_history(since_iteration)
+
+    def get_metric_labels(self) -> dict[str, str]:
+        """
+        :return: labels of metrics of the job: type of base model and final working size
+        """
+        return {"backbone": self._pretrained_model_type, "working_size": format_image_size(self._final_working_image_size)}
+
+    def get_iterations_per_second(self) -> float:
+        """
+        :return: average number of iterations per second of the running transfer. 0 if transfer isn't running
+        """
+        if not self.is_transferring():
+            return 0.0
+        return self._transfer_status / max(time.monotonic() - self._transfer_start_time, 1e-6)
 
     def is_transferring(self) -> bool:
         return self._transfer_status > 0
 
     def get_current_transfer_status(self) -> int:
-        return 100 * self._transfer_status // self._num_iteration
+        return min(100, 100 * self._transfer_status // self._num_iteration)
 
     async def transfer_style(self) -> Image:
+        """
+        Runs style transfer in the worker executor, so the event loop isn't blocked by optimization. If batching is
+        enabled, the job is optimized in one batch with other compatible jobs
+        :return: result image
+        """
+        assert self._nst_model is not None, "StyleTransferProcessor is not configured! Call configure() method!"
+        self._event_loop = asyncio.get_running_loop()
+        self._stop_event.clear()
+        self._is_transfer_states_closed = False
+        try:
+            if self._is_batchable():
+                return await asyncio.wrap_future(batched_transfer_engine.submit(self))
+            return await self._event_loop.run_in_executor(transfer_executor, self._run_transfer)
+        except asyncio.CancelledError:
+            self._stop_event.set()
+            raise
+        finally:
+            self._put_transfer_state(None)
+
+    async def get_transfer_states(self) -> tp.AsyncGenerator[TransferState, None]:
+        """
+        Yields intermediate states of the running transfer until it is finished
+        """
+        assert self._transfer_states is not None, "StyleTransferProcessor is not configured! Call configure() method!"
+        while True:
+            state: tp.Optional[TransferState] = await self._transfer_states.get()
+            if state is None:
+                return
+            yield state
+
+    def get_nst_model(self) -> NSTModel:
+        assert self._nst_model is not None, "StyleTransferProcessor is not configured! Call configure() method!"
+        return self._nst_model
+
+    def get_batch_key(self) -> BatchKey:
+        """
+        :return: key of the job. Jobs with equal keys can be optimized in one batch
+        """
+        content_layer_weights, style_layer_weights = self.get_nst_model().get_layer_weights()
+        return BatchKey(
+            self._pretrained_model_type,
+            self._working_image_size,
+            tuple(content_layer_weights),
+            tuple(style_layer_weights),
+            tuple(content_layer_weights.values()),
+            tuple(style_layer_weights.values()),
+            self._precision,
+        )
+
+    def begin_transfer(self) -> None:
+        """
+        Resets state of the previous transfer. Steps of the transfer are made by begin_step() and finish_step() until
+        is_transfer_finished(), then end_transfer() returns the result. So the job can be optimized alone or in a batch
+        """
         logger.debug("Started style transfer process.", extra={"username": self._username})
-        for iteration_idx in range(self._num_iteration):
-            self._transfer_status = iteration_idx + 1
+        self._transfer_status = 0
+        self._stop_reason = None
+        self._last_state_time = time.monotonic()
+        self._transfer_start_time = self._last_state_time
+        self._memory_tracker.reset()
+        self._saved_tensors_bytes = 0
+        self._last_losses = None
+        self._loss_history.clear()
+        if self._early_stopping is not None:
+            self._early_stopping.reset()
 
-            await asyncio.sleep(0)
-            await self._process_transfer_iteration()
+    def is_transfer_finished(self) -> bool:
+        return self._stop_event.is_set() or self._stop_reason is not None or self._transfer_status >= self._num_iteration
 
-            if (iteration_idx + 1) % (self._num_iteration // 10) == 0:
-                logger.info(f"Completed {100 * (iteration_idx + 1) / self._num_iteration:.2f}%.", extra={"username": self._username})
+    def begin_step(self) -> TransferStepInputs:
+        """
+        Zeroes gradients of the job before forward pass of the next optimization step
+        :return: inputs of forward pass of the step
+        """
+        self._optimizer.zero_grad()
+        return TransferStepInputs(self._input_tensor, self._alpha)
 
+    @contextlib.contextmanager
+    def step_context(self) -> tp.Iterator[SavedTensorsCounter]:
+        """
+        Forward pass of the step runs in this context in precision of the job. Backward pass runs outside of it
+        :return: counter of activations saved for backward pass. Compiled steps manage their buffers themselves, so they
+        aren't counted
+        """
+        with self._autocast(), SavedTensorsCounter(enabled=not self._is_step_compiled) as saved_tensors:
+            yield saved_tensors
+
+    def finish_step(self, losses: Tensor, saved_tensors_bytes: int) -> None:
+        """
+        Makes optimizer step after backward pass, records losses of the step and publishes intermediate state if it's time to
+        :param losses: [3] tensor of content, style and total losses of the job
+        :param saved_tensors_bytes: size of activations of the job saved for backward pass
+        """
+        with self._profiler.stage("optimizer_step"):
+            self._optimizer.step()
+        self._last_losses = losses
+        self._saved_tensors_bytes = saved_tensors_bytes
+        self._complete_iteration()
+
+    def end_transfer(self) -> Image:
+        """
+        :return: result image of the finished transfer
+        """
+        if self._stop_event.is_set():
+            self._stop_reason = "stopped"
+            logger.info("Style transfer process was stopped.", extra={"username": self._username})
+        elif self._stop_reason is None:
+            self._stop_reason = "completed"
+        self._loss_history.flush()
+        self._profiler.finish()
         result: Image = self.get_current_image()
+        self._num_completed_iterations = min(self._transfer_status, self._num_iteration)
         self._transfer_status = 0
-        logger.info("Ended style transfer process.", extra={"username": self._username})
+        logger.info(f"Ended style transfer process after {self._num_completed_iterations} iterations ({self._stop_reason}). "
+                    f"Peak memory usage: {self.get_peak_memory_usage() / 2 ** 20:.1f} MB.", extra={"username": self._username})
         return result
 
-    async def _process_transfer_iteration(self) -> None:
+    def _run_transfer(self) -> Image:
+        self.begin_transfer()
+        while not self.is_transfer_finished():
+            self._process_transfer_iteration()
+        return self.end_transfer()
+
+    def _is_batchable(self) -> bool:
+        # Checkpointing is configured for a single image, pyramid jobs change working size between levels and L-BFGS
+        # re-evaluates loss of a single job several times per step, and stages of profiled jobs are timed on their own,
+        # so such jobs are optimized alone
+        return Config.batched_transfer and self._memory_budget_bytes is None and len(self._pyramid_levels) == 1 \
+            and self._optimizer_type != "lbfgs" and not self._profiler.is_enabled()
+
+    def _get_pyramid_levels(self, num_iteration: int) -> list[tuple[tuple[int, int], int]]:
+        """
+        Splits iteration budget between levels of coarse-to-fine pyramid
+        :param num_iteration: total number of iterations
+        :return: list of working image size and number of the last iteration of every level
+        """
+        total_ratio: float = sum(Config.pyramid_iteration_ratios)
+        pyramid_levels: list[tuple[tuple[int, int], int]] = []
+        last_iteration: int = 0
+        for level_idx, (scale, ratio) in enumerate(zip(Config.pyramid_scales, Config.pyramid_iteration_ratios)):
+            if level_idx + 1 == len(Config.pyramid_scales):
+                last_iteration = num_iteration
+            else:
+                last_iteration += int(num_iteration * ratio / total_ratio)
+            working_image_size: tuple[int, int] = (
+                max(Config.min_pyramid_image_size, round(self._final_working_image_size[0] * scale)),
+                max(Config.min_pyramid_image_size, round(self._final_working_image_size[1] * scale)),
+            )
+            if not pyramid_levels or last_iteration > pyramid_levels[-1][1]:
+                pyramid_levels.append((working_image_size, last_iteration))
+        return pyramid_levels
+
+    def _configure_pyramid_level(self, level_idx: int) -> None:
+        """
+        Rebuilds NSTModel with targets of working size of the level. Result of the previous level is upsampled and used
+        as initial input tensor
+        :param level_idx: index of pyramid level
+        """
+        self._pyramid_level_idx = level_idx
+        self._working_image_size = self._pyramid_levels[level_idx][0]
+        with self._profiler.stage("build_model"):
+            self._nst_model = NSTModel(
+                self._username,
+                self._content_image,
+                self._style_image,
+                content_loss_layers_id=self._collect_content_loss_layers,
+                style_loss_layers_id=self._collect_style_loss_layers,
+                pretrained_model_type=self._pretrained_model_type,
+                working_image_size=self._working_image_size,
+                style_targets=self._style_targets if self._working_image_size == self._final_working_image_size else None,
+                content_layer_weights=self._content_layer_weights,
+                style_layer_weights=self._style_layer_weights,
+                precision=self._precision,
+            )
+        self._nst_model.set_profiler(self._profiler)
+
+        if level_idx == 0:
+            self._input_tensor = Compose([
+                ToTensor(),
+                Normalize(mean=Config.normalization_mean, std=Config.normalization_std),
+                Resize(self._working_image_size),
+            ])(self._content_image).view(1, 3, *self._working_image_size).to(Config.device)
+        else:
+            self._input_tensor = interpolate(self._input_tensor.detach(), size=self._working_image_size, mode="bilinear", align_corners=False)
+        if Config.channels_last:
+            self._input_tensor = self._input_tensor.contiguous(memory_format=torch.channels_last)
+        self._input_tensor.requires_grad = True
+        self._optimizer = self._create_optimizer()
+
+        num_segments: int = 0
+        if self._memory_budget_bytes is not None:
+            num_segments = self._nst_model.enable_checkpointing(self._memory_budget_bytes)
+            logger.debug(f"MEMORY_BUDGET: {self._memory_budget_bytes} bytes, {num_segments} checkpointed segments",
+                         extra={"username": self._username})
+        self._is_step_compiled = self._step_compiler is not None and num_segments == 0
+        if self._is_step_compiled:
+            self._nst_model.enable_compiled_step(self._step_compiler)
+
+    def _create_optimizer(self) -> Optimizer:
+        learning_rate: float = Config.optimizer_learning_rates[self._optimizer_type]
+        if self._optimizer_type == "adamw":
+            return AdamW([self._input_tensor], lr=learning_rate)
+        elif self._optimizer_type == "rmsprop":
+            return RMSprop([self._input_tensor], lr=learning_rate)
+        elif self._optimizer_type == "lbfgs":
+            return LBFGS([self._input_tensor], lr=learning_rate, max_iter=Config.lbfgs_max_iter)
+        return Adam([self._input_tensor], lr=learning_rate)
+
+    def _complete_iteration(self, num_evaluations: int = 1) -> None:
+        """
+        Updates transfer status after optimization step and publishes intermediate state if it's time to
+        :param num_evaluations: number of forward and backward passes made during the step
+        """
+        previous_transfer_status: int = self._transfer_status
+        self._transfer_status += num_evaluations
+        iterations_total.inc(num_evaluations, **self.get_metric_labels())
+        self._profiler.step(self._transfer_status)
+        self._memory_tracker.update(self._saved_tensors_bytes + self._get_owned_tensors_bytes())
+        self._saved_tensors_bytes = 0
+        records: list[LossRecord] = []
+        if self._last_losses is not None:
+            records = self._loss_history.append(self._transfer_status, self._last_losses)
+        if self._transfer_status >= self._pyramid_levels[self._pyramid_level_idx][1] and \
+                self._pyramid_level_idx + 1 < len(self._pyramid_levels):
+            self._configure_pyramid_level(self._pyramid_level_idx + 1)
+            logger.debug(f"Switched to pyramid level with working size {self._working_image_size}.", extra={"username": self._username})
+        elif self._pyramid_level_idx + 1 == len(self._pyramid_levels):
+            self._check_convergence(records)
+
+        if 10 * self._transfer_status // self._num_iteration > 10 * previous_transfer_status // self._num_iteration:
+            logger.info(f"Completed {100 * self._transfer_status / self._num_iteration:.2f}%.", extra={"username": self._username})
+
+        if time.monotonic() - self._last_state_time >= self._state_interval:
+            self._take_snapshot()
+            self._last_state_time = time.monotonic()
+
+    def _check_convergence(self, records: list[LossRecord]) -> None:
+        """
+        Feeds the latest loss read back to host to early stopping policy. Losses are read back only every
+        loss_telemetry_interval iterations, so checking doesn't synchronize with the device on every iteration
+        :param records: loss records read back after the last optimization step
+        """
+        if self._early_stopping is None or not records:
+            return
+        if self._early_stopping.update(records[-1].iteration, records[-1].total_loss):
+            self._stop_reason = "converged"
+            logger.info(f"Loss reached plateau after {self._transfer_status} iterations.", extra={"username": self._username})
+
+    def _take_snapshot(self) -> None:
+        """
+        Copies input tensor into snapshot buffer and passes rendering of the preview to preview worker, so the
+        optimization isn't stalled. Snapshot is skipped if previous ones are still being rendered
+        """
+        with self._profiler.stage("snapshot"):
+            buffer_idx: tp.Optional[int] = self._snapshot_buffer.take(self._input_tensor)
+        if buffer_idx is None:
+            logger.debug("Skipped snapshot, since preview worker is busy.", extra={"username": self._username})
+            return
+        preview_executor.submit(self._render_snapshot, buffer_idx, self.get_current_transfer_status(), self._transfer_status)
+
+    def _render_snapshot(self, buffer_idx: int, completeness: int, num_iterations: int) -> None:
+        """
+        Runs in preview worker. Renders snapshot at preview size and publishes it as intermediate state
+        """
+        try:
+            with self._profiler.stage("render_preview"):
+                image: Image = render_image(
+                    self._snapshot_buffer.get(buffer_idx), get_preview_size(self._init_content_image_size, self._preview_max_size),
+                )
+        finally:
+            self._snapshot_buffer.release(buffer_idx)
+        self._publish_transfer_state(TransferState(image, completeness, num_iterations))
+
+    def _publish_transfer_state(self, state: TransferState) -> None:
+        """
+        Passes state from the worker thread to the event loop
+        :param state: intermediate state of the transfer
+        """
+        self._event_loop.call_soon_threadsafe(self._put_transfer_state, state)
+
+    def _put_transfer_state(self, state: tp.Optional[TransferState]) -> None:
+        """
+        Puts state to the queue. Only the latest states are kept, if nobody consumes them. None marks end of the transfer,
+        states rendered after it are ignored
+        :param state: intermediate state of the transfer or None
+        """
+        if self._is_transfer_states_closed or (state is not None and self._stop_event.is_set()):
+            return
+        self._is_transfer_states_closed = state is None
+        while self._transfer_states.qsize() >= Config.max_pending_transfer_states:
+            self._transfer_states.get_nowait()
+        self._transfer_states.put_nowait(state)
+
+    def _process_transfer_iteration(self) -> int:
+        """
+        Makes one optimization step and completes its iterations
+        :return: number of forward and backward passes made during the step
+        """
         assert self._nst_model is not None, "StyleTransferProcessor is not configured! Call configure() method!"
-        self._optimizer.zero_grad()
-        self._nst_model(self._input_tensor)
-        loss: Tensor = self._nst_model.collect_loss(self._collect_content_loss_layers, self._collect_style_loss_layers, self._alpha)
-        loss.backward(retain_graph=True)
-        self._optimizer.step()
+        if self._optimizer_type == "lbfgs":
+            return self._process_lbfgs_iteration()
+
+        loss, saved_tensors_bytes = self._compute_loss(self.begin_step())
+        with self._profiler.stage("backward"):
+            loss.sum().backward()
+        self.finish_step(self._nst_model.get_last_losses()[0], saved_tensors_bytes)
+        return 1
+
+    def _compute_loss(self, step_inputs: TransferStepInputs) -> tuple[Tensor, int]:
+        """
+        Forwards input tensor in precision of the job. Compiled step fuses forward pass and losses, so it's timed as one stage
+        :param step_inputs: inputs of forward pass of the step
+        :return: [1] tensor of total loss and size of activations saved for backward pass
+        """
+        with self.step_context() as saved_tensors:
+            if self._is_step_compiled:
+                with self._profiler.stage("compiled_step"):
+                    loss: Tensor = self._nst_model.compute_loss(step_inputs.input_tensor, step_inputs.alpha)
+            else:
+                with self._profiler.stage("forward"):
+                    self._nst_model(step_inputs.input_tensor)
+                with self._profiler.stage("loss"):
+                    loss = self._nst_model.collect_loss(step_inputs.alpha)
+        return loss, saved_tensors.num_bytes
+
+    def _get_owned_tensors_bytes(self) -> int:
+        """
+        :return: size of optimized image, its gradient, optimizer state and targets of the job
+        """
+        content_targets, style_targets = self._nst_model.get_targets()
+        optimizer_tensors: list[Tensor] = [
+            value for state in self._optimizer.state.values() for value in state.values() if isinstance(value, Tensor)
+        ]
+        return get_tensors_bytes([self._input_tensor, self._input_tensor.grad, *optimizer_tensors, *content_targets, *style_targets])
+
+    def _autocast(self) -> torch.autocast:
+        """
+        :return: context of forward pass in precision of the job. Backward pass runs outside of it
+        """
+        return torch.autocast(Config.device.type, dtype=torch.bfloat16, enabled=self._precision == "bf16")
+
+    def _process_lbfgs_iteration(self) -> int:
+        """
+        Makes one L-BFGS step. The step evaluates loss several times, but not more than remaining iterations of current level
+        :return: number of forward and backward passes made during the step
+        """
+        num_evaluations: int = 0
+        saved_tensors_bytes: int = 0
+        remaining_iterations: int = self._pyramid_levels[self._pyramid_level_idx][1] - self._transfer_status
+        self._optimizer.param_groups[0]["max_iter"] = min(Config.lbfgs_max_iter, remaining_iterations)
+        self._optimizer.param_groups[0]["max_eval"] = remaining_iterations
+
+        def closure() -> Tensor:
+            nonlocal num_evaluations, saved_tensors_bytes
+            num_evaluations += 1
+            loss, evaluation_saved_tensors_bytes = self._compute_loss(self.begin_step())
+            # L-BFGS evaluates loss several times per step, but graphs of evaluations don't coexist
+            saved_tensors_bytes = max(saved_tensors_bytes, evaluation_saved_tensors_bytes)
+            loss = loss.sum()
+            with self._profiler.stage("backward"):
+                loss.backward()
+            self._last_losses = self._nst_model.get_last_losses()[0]
+            return loss
+
+        # L-BFGS step includes evaluations of the closure, so its stages are nested into optimizer_step
+        with self._profiler.stage("optimizer_step"):
+            self._optimizer.step(closure)
+        self._saved_tensors_bytes = saved_tensors_bytes
+        self._complete_iteration(num_evaluations)
+        return num_evaluations
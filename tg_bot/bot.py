@@ -98,5 +98,26 @@ async def process_set_num_iteration(message: Message):
     await message.answer(result)
 
 
+@dispatcher.message_handler(commands=["set_optimizer"])
+async def process_set_optimizer(message: Message):
+    result: str = await set_style_transfer_parameter(message.chat.id, message.from_user.username,
+                                                     dispatcher.storage, "optimizer", message.get_args())
+    await message.answer(result)
+
+
+@dispatcher.message_handler(commands=["set_engine"])
+async def process_set_engine(message: Message):
+    result: str = await set_style_transfer_parameter(message.chat.id, message.from_user.username,
+                                                     dispatcher.storage, "engine", message.get_args())
+    await message.answer(result)
+
+
+@dispatcher.message_handler(commands=["set_fast_style"])
+async def process_set_fast_style(message: Message):
+    result: str = await set_style_transfer_parameter(message.chat.id, message.from_user.username,
+                                                     dispatcher.storage, "fast_style", message.get_args())
+    await message.answer(result)
+
+
 if __name__ == "__main__":
     executor.start_polling(dispatcher, skip_updates=True)
@@ -7,8 +7,8 @@ from aiogram.types import PhotoSize, Message, InputFile, InputMediaPhoto
 from websockets.legacy.client import WebSocketClientProtocol as WebSocket
 
 from backend.config import Config
-from tg_bot.exceptions import TransferStoppedException, ContentOrStyleImageNotSetException
-from tg_bot.websocket_protocols import WebsocketImage, StartStyleTransferRequest, StyleTransferResponse
+from tg_bot.exceptions import TransferStoppedException, ContentOrStyleImageNotSetException, TransferRejectedException
+from tg_bot.websocket_protocols import WebsocketImage, StartStyleTransferRequest, StyleTransferResponse, QueueStatusResponse, HandshakeResponse
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -57,12 +57,32 @@ async def get_images_for_style_transfer(chat_id: int, username: str, storage: Ba
     return content_image, style_image
 
 
+async def receive_handshake(username: str, websocket: WebSocket) -> int:
+    handshake: HandshakeResponse = await HandshakeResponse.from_websocket(websocket)
+    if not handshake.accepted:
+        logger.warning(f"Server rejected protocol version {Config.protocol_version} of user {username}, it supports versions "
+                       f"{handshake.min_protocol_version}-{handshake.max_protocol_version}: {handshake.reason}")
+        raise TransferRejectedException("Sorry, this version of the bot isn't supported by the server anymore.")
+    logger.debug(f"Transfer of user {username} uses protocol version {handshake.protocol_version}.")
+    return handshake.protocol_version
+
+
+async def wait_for_transfer_start(username: str, websocket: WebSocket) -> tp.AsyncGenerator[int, None]:
+    while True:
+        queue_status: QueueStatusResponse = await QueueStatusResponse.from_websocket(websocket)
+        if queue_status.status == "rejected":
+            logger.debug(f"Transfer of user {username} was rejected by server.")
+            raise TransferRejectedException("Sorry, too many transfers are running now. Please try again later.")
+        if queue_status.status == "started":
+            return
+        logger.debug(f"Transfer of user {username} is waiting in queue at position {queue_status.position}.")
+        yield queue_status.position
+
+
 async def receive_intermediate_style_transfer_results(chat_id: int, username: str, storage: BaseStorage, websocket: WebSocket) \
         -> tp.Generator[InputMediaPhoto, None, None]:
-    current_completeness: int = 0
-    while current_completeness < 100:
+    while True:
         style_transfer_response: StyleTransferResponse = await StyleTransferResponse.from_websocket(websocket)
-        current_completeness = style_transfer_response.completeness
 
         user_data: dict[str, tp.Any] = await storage.get_data(chat=chat_id, user=username)
         if user_data.get("stop_transfer", False):
@@ -71,10 +91,15 @@ async def receive_intermediate_style_transfer_results(chat_id: int, username: st
             await storage.set_data(chat=chat_id, user=username, data=user_data)
             raise TransferStoppedException("User stopped transfer process.")
 
+        caption: str = f"Completed {style_transfer_response.completeness}%"
+        if style_transfer_response.stop_reason is not None:
+            caption = f"Completed in {style_transfer_response.num_iterations} iterations ({style_transfer_response.stop_reason})"
         yield InputMediaPhoto(
             InputFile(await style_transfer_response.image.to_bytes_stream()),
-            caption=f"Completed {style_transfer_response.completeness}%",
+            caption=caption,
         )
+        if style_transfer_response.stop_reason is not None:
+            return
 
 
 async def start_style_transfer_controller(chat_id: int, username: str, storage: BaseStorage, transfer_message: Message) -> str:
@@ -86,7 +111,7 @@ async def start_style_transfer_controller(chat_id: int, username: str, storage:
     result_message: str = "Transfer completed!"
     try:
         async with websockets.connect(f"ws://localhost:{Config.backend_port}/style_transfer",
-                                      max_size=2**30, read_limit=2**30, write_limit=2**30) as websocket:
+                                      max_size=2**27, read_limit=2**27, write_limit=2**27) as websocket:
             user_data: dict[str, tp.Any] = await storage.get_data(chat=chat_id, user=username)
             request = StartStyleTransferRequest(
                 username=username,
@@ -96,8 +121,18 @@ async def start_style_transfer_controller(chat_id: int, username: str, storage:
                 content_loss_layers_id=user_data.get("content_loss_layers_id", [0, 1, 2, 3, 4]),
                 style_loss_layers_id=user_data.get("style_loss_layers_id", [3, 4]),
                 alpha=user_data.get("alpha", 1.0),
+                optimizer=user_data.get("optimizer", "adam"),
+                engine=user_data.get("engine", "optimization"),
+                fast_style=user_data.get("fast_style", ""),
+                # Telegram throttles edits of messages, so previews are requested rarely and at low resolution
+                preview_max_size=512,
+                preview_fps=0.5,
             )
             await request.to_websocket(websocket)
+            await receive_handshake(username, websocket)
+
+            async for queue_position in wait_for_transfer_start(username, websocket):
+                await transfer_message.edit_caption(f"Waiting in queue, position {queue_position}...")
 
             async for media_photo in receive_intermediate_style_transfer_results(chat_id, username, storage, websocket):
                 await transfer_message.edit_media(media_photo)
@@ -105,6 +140,8 @@ async def start_style_transfer_controller(chat_id: int, username: str, storage:
     except TransferStoppedException:
         logger.debug(f"User {username} successfully interrupted transfer.")
         result_message = "Successfully stopped transfer!"
+    except TransferRejectedException as exc:
+        result_message = str(exc)
     except websockets.ConnectionClosed as exc:
         logger.debug(f"User {username} disconnected!", exc_info=exc)
         result_message = "Sorry, something went wrong during transfer process. Please try again."
@@ -130,6 +167,15 @@ async def set_style_transfer_parameter(chat_id: int, username: str, storage: Bas
             user_data["style_loss_layers_id"] = [int(elem) for elem in message_args.split()]
         elif parameter_name == "num_iteration":
             user_data["num_iteration"] = int(message_args)
+        elif parameter_name == "optimizer":
+            assert message_args.strip() in Config.available_optimizers
+            user_data["optimizer"] = message_args.strip()
+        elif parameter_name == "engine":
+            assert message_args.strip() in Config.available_engines
+            user_data["engine"] = message_args.strip()
+        elif parameter_name == "fast_style":
+            user_data["engine"] = "fast_style"
+            user_data["fast_style"] = message_args.strip()
         logger.debug(f"Successfully set '{parameter_name}' parameter for {username}.")
         await storage.set_data(chat=chat_id, user=username, data=user_data)
         return f"Successfully set '{parameter_name}' parameter."
@@ -6,3 +6,8 @@ class TransferStoppedException(Exception):
 class ContentOrStyleImageNotSetException(Exception):
     def __init__(self, message: str) -> None:
         super().__init__(message)
+
+
+class TransferRejectedException(Exception):
+    def __init__(self, message: str) -> None:
+        super().__init__(message)
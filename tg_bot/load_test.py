@@ -0,0 +1,269 @@
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+import statistics
+import websockets
+import typing as tp
+import multiprocessing
+import urllib.request
+
+from PIL import Image
+from pathlib import Path
+from dataclasses import dataclass, field, asdict, replace
+
+from backend.config import Config
+from tg_bot.websocket_protocols import WebsocketImage, StartStyleTransferRequest, StyleTransferResponse, QueueStatusResponse, HandshakeResponse
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ClientResult:
+    """
+    Timings of one simulated user in seconds. Queueing delay is measured from sending the request to "started" status,
+    time to first frame from "started" status to the first StyleTransferResponse
+    """
+    client_id: int
+    status: str = "failed"
+    queueing_delay: tp.Optional[float] = None
+    time_to_first_frame: tp.Optional[float] = None
+    inter_frame_intervals: list[float] = field(default_factory=list)
+    completion_latency: tp.Optional[float] = None
+    num_frames: int = 0
+    error: tp.Optional[str] = None
+
+    def get_jitter(self) -> tp.Optional[float]:
+        """
+        :return: standard deviation of intervals between frames
+        """
+        if len(self.inter_frame_intervals) < 2:
+            return None
+        return statistics.pstdev(self.inter_frame_intervals)
+
+
+def get_percentiles(values: list[float], percentiles: tp.Sequence[int] = (50, 95, 99)) -> dict[str, tp.Optional[float]]:
+    """
+    :param values: measured values
+    :param percentiles: percentiles from 0 to 100
+    :return: nearest-rank percentiles, None if there are no values
+    """
+    sorted_values: list[float] = sorted(values)
+    return {
+        f"p{percentile}": sorted_values[max(0, math.ceil(percentile * len(sorted_values) / 100) - 1)] if sorted_values else None
+        for percentile in percentiles
+    }
+
+
+def create_test_image(image_size: tuple[int, int], color: tuple[int, int, int]) -> WebsocketImage:
+    """
+    :param image_size: (width, height) of image
+    :param color: base color of gradient
+    :return: raw image with vertical gradient
+    """
+    image: Image.Image = Image.linear_gradient("L").resize(image_size).convert("RGB")
+    image = Image.blend(image, Image.new("RGB", image_size, color), 0.5)
+    return WebsocketImage(image.tobytes(), image_size, "raw")
+
+
+async def run_client(client_id: int, url: str, request: StartStyleTransferRequest) -> ClientResult:
+    """
+    Drives one user through the style transfer protocol
+    :param client_id: index of simulated user
+    :param url: websocket url of /style_transfer
+    :param request: request sent by the user
+    :return: timings of the user
+    """
+    result = ClientResult(client_id)
+    try:
+        async with websockets.connect(url, max_size=2**27, read_limit=2**27, write_limit=2**27) as websocket:
+            start_time: float = time.monotonic()
+            await request.to_websocket(websocket)
+            if not (await HandshakeResponse.from_websocket(websocket)).accepted:
+                result.status = "rejected"
+                return result
+            while True:
+                queue_status: QueueStatusResponse = await QueueStatusResponse.from_websocket(websocket)
+                if queue_status.status != "queued":
+                    break
+            if queue_status.status == "rejected":
+                result.status = "rejected"
+                return result
+            started_time: float = time.monotonic()
+            result.queueing_delay = started_time - start_time
+
+            last_frame_time: tp.Optional[float] = None
+            while True:
+                response: StyleTransferResponse = await StyleTransferResponse.from_websocket(websocket)
+                frame_time: float = time.monotonic()
+                if last_frame_time is None:
+                    result.time_to_first_frame = frame_time - started_time
+                else:
+                    result.inter_frame_intervals.append(frame_time - last_frame_time)
+                last_frame_time = frame_time
+                result.num_frames += 1
+                if response.stop_reason is not None:
+                    break
+            result.completion_latency = time.monotonic() - start_time
+            result.status = "completed"
+    except Exception as exc:
+        logger.warning(f"Client {client_id} failed.", exc_info=exc)
+        result.error = repr(exc)
+    return result
+
+
+async def sample_server_rss(metrics_url: str, interval: float, samples: list[tuple[float, int]], stop_event: asyncio.Event) -> None:
+    """
+    Periodically reads process_resident_memory_bytes from /metrics of the server
+    :param metrics_url: url of /metrics
+    :param interval: interval between samples in seconds
+    :param samples: list to which (time since start, RSS bytes) are appended
+    :param stop_event: sampling stops when it's set
+    """
+    start_time: float = time.monotonic()
+    while not stop_event.is_set():
+        try:
+            metrics: str = await asyncio.get_running_loop().run_in_executor(None, _read_url, metrics_url)
+            for line in metrics.splitlines():
+                if line.startswith("process_resident_memory_bytes "):
+                    samples.append((time.monotonic() - start_time, int(float(line.split()[1]))))
+        except OSError as exc:
+            logger.warning("Failed to read server metrics.", exc_info=exc)
+        try:
+            await asyncio.wait_for(stop_event.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_load_test(num_clients: int, host: str, port: int, request: StartStyleTransferRequest, ramp_up: float = 0.0,
+                        rss_interval: float = 1.0) -> dict[str, tp.Any]:
+    """
+    Starts num_clients users concurrently and summarizes their timings
+    :param num_clients: number of simulated users
+    :param host: host of the server
+    :param port: port of the server
+    :param request: request sent by every user. Username is replaced with a unique one
+    :param ramp_up: users are started evenly during this number of seconds
+    :param rss_interval: interval between samples of server RSS in seconds
+    :return: report with percentiles of timings and RSS of the server over time
+    """
+    rss_samples: list[tuple[float, int]] = []
+    stop_event = asyncio.Event()
+    rss_task: asyncio.Task = asyncio.create_task(sample_server_rss(f"http://{host}:{port}/metrics", rss_interval, rss_samples, stop_event))
+
+    async def start_client(client_id: int) -> ClientResult:
+        await asyncio.sleep(ramp_up * client_id / num_clients)
+        return await run_client(client_id, f"ws://{host}:{port}/style_transfer", replace(request, username=f"load_test_{client_id}"))
+
+    start_time: float = time.monotonic()
+    results: list[ClientResult] = await asyncio.gather(*(start_client(client_id) for client_id in range(num_clients)))
+    duration: float = time.monotonic() - start_time
+    stop_event.set()
+    await rss_task
+
+    completed: list[ClientResult] = [result for result in results if result.status == "completed"]
+    jitters: list[float] = [jitter for jitter in (result.get_jitter() for result in completed) if jitter is not None]
+    return {
+        "num_clients": num_clients,
+        "duration": duration,
+        "num_completed": len(completed),
+        "num_rejected": sum(result.status == "rejected" for result in results),
+        "num_failed": sum(result.status == "failed" for result in results),
+        "queueing_delay": get_percentiles([result.queueing_delay for result in results if result.queueing_delay is not None]),
+        "time_to_first_frame": get_percentiles([result.time_to_first_frame for result in completed]),
+        "inter_frame_jitter": get_percentiles(jitters),
+        "completion_latency": get_percentiles([result.completion_latency for result in completed]),
+        "max_server_rss_bytes": max((rss for _, rss in rss_samples), default=None),
+        "server_rss_bytes": rss_samples,
+        "clients": [asdict(result) for result in results],
+    }
+
+
+def run_server(port: int, working_image_size: tuple[int, int]) -> None:
+    """
+    Runs the app with uvicorn. Called in a separate process, so the server has its own RSS and GIL
+    :param port: port of the server
+    :param working_image_size: working size of the server. Small sizes keep CPU-only runs short
+    """
+    import uvicorn
+
+    Config.working_image_size = working_image_size
+    Config.preloaded_base_models = []
+    uvicorn.run("app.main:app", host="127.0.0.1", port=port, ws_max_size=2**27, log_level="warning")
+
+
+def wait_for_server(host: str, port: int, timeout: float) -> None:
+    """
+    Waits until /metrics of the server responds
+    """
+    deadline: float = time.monotonic() + timeout
+    while True:
+        try:
+            _read_url(f"http://{host}:{port}/metrics")
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Server on port {port} didn't start in {timeout} seconds!")
+            time.sleep(0.5)
+
+
+def _read_url(url: str) -> str:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return response.read().decode()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of style transfer server with concurrent websocket clients.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[5, 20, 50], help="numbers of concurrent clients, one run per number")
+    parser.add_argument("--host", default="127.0.0.1", help="host of the server")
+    parser.add_argument("--port", type=int, default=Config.backend_port, help="port of the server")
+    parser.add_argument("--start-server", action="store_true", help="start the app with uvicorn in a separate process")
+    parser.add_argument("--working-size", type=int, default=64, help="working size of the started server")
+    parser.add_argument("--image-size", type=int, default=64, help="size of content and style images")
+    parser.add_argument("--iterations", type=int, default=10, help="number of iterations of every transfer")
+    parser.add_argument("--preview-fps", type=float, default=Config.max_preview_fps, help="requested frame rate of previews")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="clients are started evenly during this number of seconds")
+    parser.add_argument("--output", type=Path, default=Path("load_test_results.json"), help="path to JSON report")
+    args = parser.parse_args()
+
+    server: tp.Optional[multiprocessing.Process] = None
+    if args.start_server:
+        server = multiprocessing.get_context("spawn").Process(target=run_server, args=(args.port, (args.working_size, args.working_size)))
+        server.start()
+        wait_for_server(args.host, args.port, timeout=60.0)
+
+    image_size: tuple[int, int] = (args.image_size, args.image_size)
+    request = StartStyleTransferRequest(
+        username="load_test",
+        content_image=create_test_image(image_size, (200, 120, 40)),
+        style_image=create_test_image(image_size, (30, 60, 200)),
+        num_iteration=args.iterations,
+        content_loss_layers_id=[1],
+        style_loss_layers_id=[0, 1, 2],
+        alpha=1.0,
+        image_format="jpeg",
+        preview_max_size=args.image_size,
+        preview_fps=args.preview_fps,
+    )
+    reports: list[dict[str, tp.Any]] = []
+    try:
+        for num_clients in args.clients:
+            report: dict[str, tp.Any] = asyncio.run(run_load_test(num_clients, args.host, args.port, request, args.ramp_up))
+            logger.info(f"{num_clients} clients: {report['num_completed']} completed, {report['num_rejected']} rejected, "
+                        f"{report['num_failed']} failed. Queueing delay {report['queueing_delay']}, time to first frame "
+                        f"{report['time_to_first_frame']}, jitter {report['inter_frame_jitter']}, completion latency "
+                        f"{report['completion_latency']}, max server RSS {report['max_server_rss_bytes']} bytes.")
+            reports.append(report)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+    args.output.write_text(json.dumps(reports, indent=2))
+    logger.info(f"Saved load test report to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
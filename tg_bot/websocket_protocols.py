@@ -1,21 +1,70 @@
+import json
+import enum
+import struct
+import asyncio
+import typing as tp
+
 from PIL import Image
 from io import BytesIO
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from aiogram.types import PhotoSize
 from websockets.legacy.client import WebSocketClientProtocol as WebSocket
 
+from backend.config import Config
+
+
+# Every message is one binary frame: fixed header (magic, protocol version, message type, size of JSON header),
+# JSON header with message fields and sizes of binary payloads, and the payloads themselves
+PROTOCOL_MAGIC: bytes = b"NSTP"
+FRAME_HEADER: struct.Struct = struct.Struct("!4sBBI")
+
+
+class MessageType(enum.IntEnum):
+    START_STYLE_TRANSFER_REQUEST = 1
+    QUEUE_STATUS_RESPONSE = 2
+    STYLE_TRANSFER_RESPONSE = 3
+    HANDSHAKE_RESPONSE = 4
+
+
+def encode_frame(message_type: MessageType, header: dict[str, tp.Any], payloads: tp.Sequence[bytes] = (),
+                 protocol_version: int = Config.protocol_version) -> bytes:
+    header_bytes: bytes = json.dumps({**header, "payload_sizes": [len(payload) for payload in payloads]}).encode()
+    return b"".join([FRAME_HEADER.pack(PROTOCOL_MAGIC, protocol_version, message_type, len(header_bytes)), header_bytes, *payloads])
+
+
+def decode_frame(frame: bytes, expected_message_type: MessageType) -> tuple[int, dict[str, tp.Any], list[bytes]]:
+    assert len(frame) >= FRAME_HEADER.size, "Frame is too short!"
+    magic, protocol_version, message_type, header_size = FRAME_HEADER.unpack_from(frame)
+    assert magic == PROTOCOL_MAGIC, "Frame doesn't belong to style transfer protocol!"
+    assert protocol_version <= Config.protocol_version, f"Server replied with unsupported protocol version {protocol_version}!"
+    assert message_type == expected_message_type, f"Expected {expected_message_type.name} message, but {message_type} met!"
+
+    offset: int = FRAME_HEADER.size + header_size
+    header: dict[str, tp.Any] = json.loads(frame[FRAME_HEADER.size:offset])
+    payloads: list[bytes] = []
+    for payload_size in header.pop("payload_sizes"):
+        payloads.append(frame[offset:offset + payload_size])
+        offset += payload_size
+    assert offset == len(frame), "Size of frame doesn't match sizes of its payloads!"
+    return protocol_version, header, payloads
+
 
 @dataclass
 class WebsocketImage:
+    """
+    Image is sent as raw RGB bytes or as encoded JPEG, WebP or PNG file. Its size and format are fields of message header,
+    and bytes are a payload of the frame
+    """
     bytes_array: bytes
     size: tuple[int, int]
+    image_format: str = "raw"
 
     @staticmethod
-    async def from_websocket(websocket: WebSocket) -> "WebsocketImage":
-        size_text: list[str] = (await websocket.recv()).split()
-        size: tuple[int, int] = (int(size_text[0]), int(size_text[1]))
-        bytes_array: bytes = await websocket.recv()
-        return WebsocketImage(bytes_array, size)
+    def from_header(header: dict[str, tp.Any], bytes_array: bytes) -> "WebsocketImage":
+        return WebsocketImage(bytes_array, (int(header["size"][0]), int(header["size"][1])), header["format"])
+
+    def to_header(self) -> dict[str, tp.Any]:
+        return {"size": list(self.size), "format": self.image_format}
 
     @staticmethod
     def from_pil_image(img: Image.Image) -> Image:
@@ -28,28 +77,41 @@ class WebsocketImage:
         stream: BytesIO = BytesIO()
         await photo.download(destination_file=stream)
 
-        bytes_array: bytes = Image.open(stream).tobytes()
+        # Telegram stores photos as JPEG, so they are sent without recompression
         photo_size: tuple[int, int] = (photo.width, photo.height)
-        return WebsocketImage(bytes_array, photo_size)
-
-    async def to_websocket(self, websocket: WebSocket) -> None:
-        await websocket.send(str(self.size[0]) + " " + str(self.size[1]))
-        await websocket.send(self.bytes_array)
+        return WebsocketImage(stream.getvalue(), photo_size, "jpeg")
 
     async def to_bytes_stream(self) -> BytesIO:
-        pil_image: Image.Image = self.to_pil_image()
-        stream: BytesIO = BytesIO()
+        if self.image_format == "jpeg":
+            stream: BytesIO = BytesIO(self.bytes_array)
+        else:
+            stream = await asyncio.get_running_loop().run_in_executor(None, self._to_jpeg_stream)
         stream.name = "img.jpg"
-        pil_image.save(stream, "JPEG")
         stream.seek(0)
         return stream
 
     def to_pil_image(self) -> Image:
-        return Image.frombytes("RGB", self.size, self.bytes_array)
+        if self.image_format == "raw":
+            return Image.frombytes("RGB", self.size, self.bytes_array)
+        with Image.open(BytesIO(self.bytes_array)) as img:
+            return img.convert("RGB")
+
+    def _to_jpeg_stream(self) -> BytesIO:
+        stream: BytesIO = BytesIO()
+        self.to_pil_image().save(stream, "JPEG", quality=Config.image_quality)
+        return stream
 
 
 @dataclass
 class StartStyleTransferRequest:
+    """
+    image_format and image_quality are requested encoding of images in responses. preview_max_size and preview_fps are
+    requested resolution and frame rate of progress previews. profile requests per-stage timings in the final response.
+    precision of optimization is one of Config.available_precisions, empty string selects the default of the server.
+    content_layer_weights and style_layer_weights are weights of loss layers in order of their indexes, empty lists
+    select equal weights. Layers with zero weight are skipped.
+    protocol_version is the latest version supported by the client
+    """
     username: str
     content_image: WebsocketImage
     style_image: WebsocketImage
@@ -57,46 +119,184 @@ class StartStyleTransferRequest:
     content_loss_layers_id: list[int]
     style_loss_layers_id: list[int]
     alpha: float
+    optimizer: str = "adam"
+    engine: str = "optimization"
+    fast_style: str = ""
+    image_format: str = Config.default_image_format
+    image_quality: int = Config.image_quality
+    preview_max_size: int = Config.preview_max_size
+    preview_fps: float = Config.preview_fps
+    profile: bool = False
+    precision: str = ""
+    content_layer_weights: list[float] = field(default_factory=list)
+    style_layer_weights: list[float] = field(default_factory=list)
+    protocol_version: int = Config.protocol_version
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "StartStyleTransferRequest":
+        protocol_version, header, payloads = decode_frame(frame, MessageType.START_STYLE_TRANSFER_REQUEST)
+        return StartStyleTransferRequest(
+            username=header["username"],
+            content_image=WebsocketImage.from_header(header["content_image"], payloads[0]),
+            style_image=WebsocketImage.from_header(header["style_image"], payloads[1]),
+            num_iteration=int(header["num_iteration"]),
+            content_loss_layers_id=[int(elem) for elem in header["content_loss_layers_id"]],
+            style_loss_layers_id=[int(elem) for elem in header["style_loss_layers_id"]],
+            alpha=float(header["alpha"]),
+            optimizer=header.get("optimizer", "adam"),
+            engine=header.get("engine", "optimization"),
+            fast_style=header.get("fast_style", ""),
+            image_format=header.get("image_format", Config.default_image_format),
+            image_quality=int(header.get("image_quality", Config.image_quality)),
+            preview_max_size=int(header.get("preview_max_size", Config.preview_max_size)),
+            preview_fps=float(header.get("preview_fps", Config.preview_fps)),
+            profile=bool(header.get("profile", False)),
+            precision=header.get("precision", ""),
+            content_layer_weights=[float(elem) for elem in header.get("content_layer_weights", [])],
+            style_layer_weights=[float(elem) for elem in header.get("style_layer_weights", [])],
+            protocol_version=protocol_version,
+        )
+
+    def to_frame(self) -> bytes:
+        header: dict[str, tp.Any] = {
+            "username": self.username,
+            "content_image": self.content_image.to_header(),
+            "style_image": self.style_image.to_header(),
+            "num_iteration": self.num_iteration,
+            "content_loss_layers_id": self.content_loss_layers_id,
+            "style_loss_layers_id": self.style_loss_layers_id,
+            "alpha": self.alpha,
+            "optimizer": self.optimizer,
+            "engine": self.engine,
+            "fast_style": self.fast_style,
+            "image_format": self.image_format,
+            "image_quality": self.image_quality,
+            "preview_max_size": self.preview_max_size,
+            "preview_fps": self.preview_fps,
+            "profile": self.profile,
+            "precision": self.precision,
+            "content_layer_weights": self.content_layer_weights,
+            "style_layer_weights": self.style_layer_weights,
+        }
+        payloads: list[bytes] = [self.content_image.bytes_array, self.style_image.bytes_array]
+        return encode_frame(MessageType.START_STYLE_TRANSFER_REQUEST, header, payloads, self.protocol_version)
 
     @staticmethod
     async def from_websocket(websocket: WebSocket) -> "StartStyleTransferRequest":
-        username: str = await websocket.recv()
-        content_image: WebsocketImage = await WebsocketImage.from_websocket(websocket)
-        style_image: WebsocketImage = await WebsocketImage.from_websocket(websocket)
-        num_iteration: int = int(await websocket.recv())
-        content_loss_layers_id = [int(elem) for elem in (await websocket.recv()).split()]
-        style_loss_layers_id = [int(elem) for elem in (await websocket.recv()).split()]
-        alpha = float(await websocket.recv())
-        return StartStyleTransferRequest(username, content_image, style_image, num_iteration, content_loss_layers_id, style_loss_layers_id, alpha)
+        return StartStyleTransferRequest.from_frame(await websocket.recv())
 
     async def to_websocket(self, websocket: WebSocket) -> None:
-        await websocket.send(self.username)
-        await self.content_image.to_websocket(websocket)
-        await self.style_image.to_websocket(websocket)
-        await websocket.send(str(self.num_iteration))
-        await websocket.send(" ".join(map(str, self.content_loss_layers_id)))
-        await websocket.send(" ".join(map(str, self.style_loss_layers_id)))
-        await websocket.send(str(self.alpha))
+        await websocket.send(self.to_frame())
+
+
+@dataclass
+class HandshakeResponse:
+    """
+    The first answer of the server. protocol_version is the negotiated version of all following messages. Rejected
+    clients get the range of versions supported by the server and the reason
+    """
+    accepted: bool
+    protocol_version: int
+    min_protocol_version: int
+    max_protocol_version: int
+    reason: str = ""
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "HandshakeResponse":
+        _, header, _ = decode_frame(frame, MessageType.HANDSHAKE_RESPONSE)
+        return HandshakeResponse(bool(header["accepted"]), int(header["protocol_version"]), int(header["min_protocol_version"]),
+                                 int(header["max_protocol_version"]), header.get("reason", ""))
+
+    def to_frame(self, protocol_version: int = Config.protocol_version) -> bytes:
+        header: dict[str, tp.Any] = {
+            "accepted": self.accepted,
+            "protocol_version": self.protocol_version,
+            "min_protocol_version": self.min_protocol_version,
+            "max_protocol_version": self.max_protocol_version,
+            "reason": self.reason,
+        }
+        return encode_frame(MessageType.HANDSHAKE_RESPONSE, header, protocol_version=protocol_version)
+
+    @staticmethod
+    async def from_websocket(websocket: WebSocket) -> "HandshakeResponse":
+        return HandshakeResponse.from_frame(await websocket.recv())
+
+
+@dataclass
+class QueueStatusResponse:
+    status: str
+    position: int = 0
+    job_id: tp.Optional[int] = None
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "QueueStatusResponse":
+        _, header, _ = decode_frame(frame, MessageType.QUEUE_STATUS_RESPONSE)
+        return QueueStatusResponse(header["status"], int(header["position"]), header.get("job_id"))
+
+    def to_frame(self, protocol_version: int = Config.protocol_version) -> bytes:
+        return encode_frame(MessageType.QUEUE_STATUS_RESPONSE, {"status": self.status, "position": self.position, "job_id": self.job_id},
+                            protocol_version=protocol_version)
+
+    @staticmethod
+    async def from_websocket(websocket: WebSocket) -> "QueueStatusResponse":
+        return QueueStatusResponse.from_frame(await websocket.recv())
+
+    async def to_websocket(self, websocket: WebSocket, protocol_version: int = Config.protocol_version) -> None:
+        await websocket.send(self.to_frame(protocol_version))
 
 
 @dataclass
 class StyleTransferResponse:
+    """
+    stop_reason is set only in the final response
+    """
     image: WebsocketImage
     completeness: int
+    num_iterations: int = 0
+    stop_reason: tp.Optional[str] = None
+    # [iteration, content loss, style loss, total loss] read back since the previous response
+    losses: list[list[float]] = field(default_factory=list)
+    # Per-stage timings of profiled job: stage name to its total_seconds, count and mean_seconds
+    stage_timings: dict[str, dict[str, float]] = field(default_factory=dict)
+    # Peak memory usage of the job in bytes, set only in the final response. 0 if it isn't measured
+    peak_memory_bytes: int = 0
+
+    @staticmethod
+    def from_frame(frame: bytes) -> "StyleTransferResponse":
+        _, header, payloads = decode_frame(frame, MessageType.STYLE_TRANSFER_RESPONSE)
+        return StyleTransferResponse(
+            WebsocketImage.from_header(header["image"], payloads[0]),
+            int(header["completeness"]),
+            int(header["num_iterations"]),
+            header.get("stop_reason"),
+            header.get("losses", []),
+            header.get("stage_timings", {}),
+            int(header.get("peak_memory_bytes", 0)),
+        )
+
+    def to_frame(self, protocol_version: int = Config.protocol_version) -> bytes:
+        header: dict[str, tp.Any] = {
+            "image": self.image.to_header(),
+            "completeness": self.completeness,
+            "num_iterations": self.num_iterations,
+            "stop_reason": self.stop_reason,
+            "losses": self.losses,
+            "stage_timings": self.stage_timings,
+            "peak_memory_bytes": self.peak_memory_bytes,
+        }
+        return encode_frame(MessageType.STYLE_TRANSFER_RESPONSE, header, [self.image.bytes_array], protocol_version)
 
     @staticmethod
     async def from_websocket(websocket: WebSocket) -> "StyleTransferResponse":
-        image: WebsocketImage = await WebsocketImage.from_websocket(websocket)
-        completeness: int = int(await websocket.recv())
-        return StyleTransferResponse(image, completeness)
+        return StyleTransferResponse.from_frame(await websocket.recv())
 
-    async def to_websocket(self, websocket: WebSocket) -> None:
-        await self.image.to_websocket(websocket)
-        await websocket.send(str(self.completeness))
+    async def to_websocket(self, websocket: WebSocket, protocol_version: int = Config.protocol_version) -> None:
+        await websocket.send(self.to_frame(protocol_version))
 
     @staticmethod
-    def from_pil_image(img: Image.Image, completeness: int = 0) -> "StyleTransferResponse":
-        return StyleTransferResponse(WebsocketImage.from_pil_image(img), completeness)
+    def from_pil_image(img: Image.Image, completeness: int = 0, num_iterations: int = 0,
+                       stop_reason: tp.Optional[str] = None) -> "StyleTransferResponse":
+        return StyleTransferResponse(WebsocketImage.from_pil_image(img), completeness, num_iterations, stop_reason)
 
     def to_pil_image(self) -> Image.Image:
         return self.image.to_pil_image()